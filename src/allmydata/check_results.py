@@ -1,4 +1,6 @@
 
+import time
+from collections import deque
 from zope.interface import implements
 from allmydata.interfaces import ICheckResults, ICheckAndRepairResults, \
      IDeepCheckResults, IDeepCheckAndRepairResults, IURI, IDisplayableServer
@@ -169,6 +171,171 @@ class CheckAndRepairResults:
         return self.post_repair_results
 
 
+def dump_check_results(r):
+    """Return a dict of strings, numbers and lists (so it can be encoded as
+    JSON) that holds the CheckResults 'r', for load_check_results(). The
+    servermap and the share problems (which hold Failures) are left out."""
+    def _ids(servers):
+        return [base32.b2a(s.get_serverid()) for s in servers]
+    def _locators(shares):
+        return [(base32.b2a(s.get_serverid()), base32.b2a(si), shnum)
+                for (s, si, shnum) in shares]
+    return {"uri": r.get_uri().to_string(),
+            "storage-index": r.get_storage_index_string(),
+            "healthy": r.is_healthy(),
+            "recoverable": r.is_recoverable(),
+            "count-happiness": r.get_happiness(),
+            "count-shares-needed": r.get_encoding_needed(),
+            "count-shares-expected": r.get_encoding_expected(),
+            "count-shares-good": r.get_share_counter_good(),
+            "count-good-share-hosts": r.get_host_counter_good_shares(),
+            "count-recoverable-versions": r.get_version_counter_recoverable(),
+            "count-unrecoverable-versions": r.get_version_counter_unrecoverable(),
+            "servers-responding": _ids(r.get_servers_responding()),
+            "sharemap": [(shnum, _ids(servers))
+                         for (shnum, servers) in r.get_sharemap().items()],
+            "count-wrong-shares": r.get_share_counter_wrong(),
+            "list-corrupt-shares": _locators(r.get_corrupt_shares()),
+            "list-incompatible-shares": _locators(r.get_incompatible_shares()),
+            "summary": r.get_summary(),
+            "report": r.get_report(),
+            }
+
+def load_check_results(data, storage_broker):
+    """Rebuild the CheckResults that dump_check_results() turned into
+    'data'. Servers that are not connected any more are represented by
+    StubServers."""
+    from allmydata.uri import from_string
+    def _servers(ids):
+        return [storage_broker.get_stub_server(base32.a2b(str(serverid)))
+                for serverid in ids]
+    def _locators(shares):
+        return [(storage_broker.get_stub_server(base32.a2b(str(serverid))),
+                 base32.a2b(str(si)), shnum)
+                for (serverid, si, shnum) in shares]
+    corrupt = _locators(data["list-corrupt-shares"])
+    incompatible = _locators(data["list-incompatible-shares"])
+    return CheckResults(from_string(str(data["uri"])),
+                        base32.a2b(str(data["storage-index"])),
+                        healthy=data["healthy"],
+                        recoverable=data["recoverable"],
+                        count_happiness=data["count-happiness"],
+                        count_shares_needed=data["count-shares-needed"],
+                        count_shares_expected=data["count-shares-expected"],
+                        count_shares_good=data["count-shares-good"],
+                        count_good_share_hosts=data["count-good-share-hosts"],
+                        count_recoverable_versions=data["count-recoverable-versions"],
+                        count_unrecoverable_versions=data["count-unrecoverable-versions"],
+                        servers_responding=_servers(data["servers-responding"]),
+                        sharemap=dict([(shnum, _servers(ids))
+                                       for (shnum, ids) in data["sharemap"]]),
+                        count_wrong_shares=data["count-wrong-shares"],
+                        list_corrupt_shares=corrupt,
+                        count_corrupt_shares=len(corrupt),
+                        list_incompatible_shares=incompatible,
+                        count_incompatible_shares=len(incompatible),
+                        summary=str(data["summary"]),
+                        report=[str(line) for line in data["report"]],
+                        share_problems=[],
+                        servermap=None)
+
+def dump_check_and_repair_results(r):
+    """Like dump_check_results(), for a CheckAndRepairResults."""
+    data = {"storage-index": r.get_storage_index_string(),
+            "repair-attempted": r.get_repair_attempted(),
+            "pre-repair-results": dump_check_results(r.get_pre_repair_results()),
+            "post-repair-results": dump_check_results(r.get_post_repair_results()),
+            }
+    if r.get_repair_attempted():
+        data["repair-successful"] = r.get_repair_successful()
+    return data
+
+def load_check_and_repair_results(data, storage_broker):
+    crr = CheckAndRepairResults(base32.a2b(str(data["storage-index"])))
+    crr.repair_attempted = data["repair-attempted"]
+    if crr.repair_attempted:
+        crr.repair_successful = data["repair-successful"]
+    crr.pre_repair_results = load_check_results(data["pre-repair-results"],
+                                                storage_broker)
+    crr.post_repair_results = load_check_results(data["post-repair-results"],
+                                                 storage_broker)
+    return crr
+
+
+class CheckResultsCache:
+    """I remember the results of recent checks that found a file to be
+    healthy, for up to 'ttl' seconds, so that checking the file again can
+    skip asking the storage servers. I am shared by all the filenodes that a
+    NodeMaker creates, and indexed by storage index.
+
+    A result from a verifying check can stand in for a non-verifying one,
+    but not the other way around. Checks that add leases always go to the
+    servers. Filenodes discard their entry when they repair or publish the
+    file, but changes made by other clients (or shares that are lost) will
+    not be noticed until the entry expires. I hold at most MAX_ENTRIES
+    results, discarding the oldest first.
+    """
+    MAX_ENTRIES = 10000
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._results = {} # storage_index -> (when, verified, results)
+        self._order = deque() # (when, storage_index), oldest first
+
+    def get(self, storage_index, verify, now=None):
+        """Return the cached ICheckResults for this storage index, or None
+        if there is no fresh enough one (or it was not verified and
+        'verify' is True)."""
+        now = now or time.time()
+        if storage_index not in self._results:
+            return None
+        (when, verified, results) = self._results[storage_index]
+        if now - when >= self._ttl:
+            del self._results[storage_index]
+            return None
+        if verify and not verified:
+            return None
+        return results
+
+    def get_check_and_repair(self, storage_index, verify, now=None):
+        """Like get(), but return an ICheckAndRepairResults in which no
+        repair was attempted."""
+        results = self.get(storage_index, verify, now)
+        if results is None:
+            return None
+        crr = CheckAndRepairResults(storage_index)
+        crr.pre_repair_results = results
+        crr.post_repair_results = results
+        return crr
+
+    def add(self, results, verified, now=None):
+        """Remember 'results' if they are healthy. I return 'results', so I
+        can be used as a callback."""
+        if results is None or not results.is_healthy():
+            return results
+        now = now or time.time()
+        storage_index = results.get_storage_index()
+        self._results[storage_index] = (now, verified, results)
+        self._order.append( (now, storage_index) )
+        self._prune(now)
+        return results
+
+    def discard(self, storage_index, res=None):
+        self._results.pop(storage_index, None)
+        return res
+
+    def _prune(self, now):
+        while self._order:
+            (when, storage_index) = self._order[0]
+            if (now - when < self._ttl
+                and len(self._order) <= self.MAX_ENTRIES):
+                break
+            self._order.popleft()
+            # only drop the result if it was not replaced by a later one
+            if self._results.get(storage_index, (None,))[0] == when:
+                del self._results[storage_index]
+
+
 class DeepResultsBase:
 
     def __init__(self, root_storage_index):
@@ -186,10 +353,14 @@ class DeepResultsBase:
         self.all_results = {}
         self.all_results_by_storage_index = {}
         self.stats = {}
+        self.resumed = False
 
     def update_stats(self, new_stats):
         self.stats.update(new_stats)
 
+    def is_resumed(self):
+        return self.resumed
+
     def get_root_storage_index_string(self):
         return self.root_storage_index_s
 
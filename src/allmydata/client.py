@@ -17,11 +17,15 @@ from allmydata.storage.backends.cloud.cloud_backend import configure_cloud_backe
 from allmydata.storage.backends.cloud.mock_cloud import configure_mock_cloud_backend
 from allmydata.storage.expiration import ExpirationPolicy
 from allmydata import storage_client
+from allmydata.perfdb import PerformanceDB
+from allmydata.deepcheckjournal import DeepCheckJournal
+from allmydata.check_results import CheckResultsCache
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
-from allmydata.util import hashutil, base32, pollmixin, log, keyutil, idlib
+from allmydata.util import hashutil, base32, pollmixin, log, keyutil, idlib, \
+     fileutil
 from allmydata.util.encodingutil import get_filesystem_encoding, quote_output, \
      from_utf8_or_none
 from allmydata.util.fileutil import abspath_expanduser_unicode
@@ -57,14 +61,34 @@ class SecretHolder:
     def get_convergence_secret(self):
         return self._convergence_secret
 
-class KeyGenerator:
+class KeyGenerator(service.Service):
     """I create RSA keys for mutable files. Each call to generate() returns a
     single keypair. The keysize is specified first by the keysize= argument
     to generate(), then with a default set by set_default_keysize(), then
-    with a built-in default of 2048 bits."""
-    def __init__(self):
+    with a built-in default of 2048 bits.
+
+    When there is no remote key generator, I hand out keys of the default
+    size from a local pool. Once the pool drops below low_water keys, I
+    refill it up to high_water keys, but only after pool_refresh_delay
+    seconds have passed without a request (the same policy as
+    allmydata.key_generator.KeyGenerator). Each key is generated in the
+    reactor thread, one per reactor turn, so the node is still busy for a
+    second or two per key: the pool moves that cost to a time when nobody
+    is waiting for a mutable file, it does not remove it. The keys left in the
+    pool when the node stops are saved in poolfile, and used up after the
+    next start. If high_water is 0, I do not keep a pool."""
+    pool_refresh_delay = 6 # no. sec to wait after a fetch before generating new keys
+
+    def __init__(self, poolfile=None, low_water=0, high_water=0):
         self._remote = None
         self.default_keysize = 2048
+        self._poolfile = poolfile
+        self.low_water = low_water
+        self.high_water = high_water
+        self.keypool = [] # (verifier, signer) pairs of default_keysize bits
+        self._refilling = False
+        self.last_fetch = 0
+        self.timer = None
 
     def set_remote_generator(self, keygen):
         self._remote = keygen
@@ -75,8 +99,91 @@ class KeyGenerator:
         default size is 2048 bits. Test cases should call this method once
         during setup, to cause me to create smaller keys, so the unit tests
         run faster."""
+        if keysize != self.default_keysize:
+            self.keypool = []
         self.default_keysize = keysize
 
+    def startService(self):
+        service.Service.startService(self)
+        self._load_pool()
+        self._schedule_refill()
+
+    def stopService(self):
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        self._save_pool()
+        return service.Service.stopService(self)
+
+    def _load_pool(self):
+        if not (self._poolfile and os.path.exists(self._poolfile)):
+            return
+        try:
+            for line in fileutil.read(self._poolfile).splitlines():
+                keysize, signing_key = line.split()
+                if int(keysize) == self.default_keysize:
+                    signer = rsa.create_signing_key_from_string(base32.a2b(signing_key))
+                    self.keypool.append( (signer.get_verifying_key(), signer) )
+        except Exception:
+            log.err(None, "unable to load RSA key pool",
+                    facility="tahoe.keygen", level=log.UNUSUAL, umid="xQ4Gkw")
+        # never hand out the same key twice, even if we crash before saving
+        fileutil.remove(self._poolfile)
+
+    def _save_pool(self):
+        if not (self._poolfile and self.keypool):
+            return
+        lines = ["%d %s\n" % (self.default_keysize, base32.b2a(signer.serialize()))
+                 for (verifier, signer) in self.keypool]
+        fileutil.write(self._poolfile, "".join(lines), mode="")
+        self.keypool = []
+
+    def _schedule_refill(self):
+        self.last_fetch = time.time()
+        if not self.high_water or not self.running:
+            return
+        if self.timer and self.timer.active():
+            self.timer.reset(self.pool_refresh_delay)
+        else:
+            self.timer = reactor.callLater(self.pool_refresh_delay,
+                                           self._maybe_refill_pool)
+
+    def _maybe_refill_pool(self):
+        self.timer = None
+        if self._remote or not self.running:
+            # the remote generator makes our keys
+            return
+        if len(self.keypool) < self.low_water:
+            self._refilling = True
+        if not self._refilling or len(self.keypool) >= self.high_water:
+            self._refilling = False
+            return
+        if self.last_fetch + self.pool_refresh_delay > time.time():
+            # somebody is busy creating mutable files: don't get in the way
+            self.timer = reactor.callLater(self.pool_refresh_delay,
+                                           self._maybe_refill_pool)
+            return
+        try:
+            self.keypool.append(self._generate_locally(self.default_keysize))
+        except Exception:
+            self._refilling = False
+            log.err(None, "unable to generate an RSA key for the pool",
+                    facility="tahoe.keygen", level=log.UNUSUAL, umid="Yd3TlA")
+            return
+        if len(self.keypool) >= self.high_water:
+            self._refilling = False
+        else:
+            # one key per turn, so that requests which arrive meanwhile are
+            # served (and push the next key back by pool_refresh_delay)
+            self.timer = reactor.callLater(0, self._maybe_refill_pool)
+
+    def _generate_locally(self, keysize):
+        # RSA key generation for a 2048 bit key takes between 0.8 and 3.2
+        # secs
+        signer = rsa.generate(keysize)
+        verifier = signer.get_verifying_key()
+        return (verifier, signer)
+
     def generate(self, keysize=None):
         """I return a Deferred that fires with a (verifyingkey, signingkey)
         pair. I accept a keysize in bits (2048 bit keys are standard, smaller
@@ -94,11 +201,12 @@ class KeyGenerator:
             d.addCallback(make_key_objs)
             return d
         else:
-            # RSA key generation for a 2048 bit key takes between 0.8 and 3.2
-            # secs
-            signer = rsa.generate(keysize)
-            verifier = signer.get_verifying_key()
-            return defer.succeed( (verifier, signer) )
+            if keysize == self.default_keysize and self.keypool:
+                keypair = self.keypool.pop(0)
+            else:
+                keypair = self._generate_locally(keysize)
+            self._schedule_refill()
+            return defer.succeed(keypair)
 
 class Terminator(service.Service):
     def __init__(self):
@@ -134,6 +242,10 @@ class Client(node.Node, pollmixin.PollMixin):
                                    "max_segment_size": 128*KiB,
                                    }
 
+    deep_check_journal = None
+    deep_check_skip_healthy_within = None
+    directory_cache = None
+
     def __init__(self, basedir="."):
         node.Node.__init__(self, basedir)
         self.started_timestamp = time.time()
@@ -148,7 +260,7 @@ class Client(node.Node, pollmixin.PollMixin):
         self.helper = None
         if self.get_config("helper", "enabled", False, boolean=True):
             self.init_helper()
-        self._key_generator = KeyGenerator()
+        self.init_key_pool()
         key_gen_furl = self.get_config("client", "key_generator.furl", None)
         if key_gen_furl:
             self.init_key_gen(key_gen_furl)
@@ -368,6 +480,7 @@ class Client(node.Node, pollmixin.PollMixin):
                                   self.history))
         self.init_blacklist()
         self.init_nodemaker()
+        self.init_deep_check_journal()
 
     def get_auth_token(self):
         """
@@ -396,9 +509,21 @@ class Client(node.Node, pollmixin.PollMixin):
         # (and everybody else who wants to use storage servers)
         ps = self.get_config("client", "peers.preferred", "").split(",")
         preferred_peers = tuple([p.strip() for p in ps if p != ""])
-        sb = storage_client.StorageFarmBroker(self.tub, permute_peers=True, preferred_peers=preferred_peers)
+        demote_slow = self.get_config("client", "peers.demote_slow",
+                                      default=False, boolean=True)
+        sb = storage_client.StorageFarmBroker(self.tub, permute_peers=True, preferred_peers=preferred_peers,
+                                              demote_slow_servers=demote_slow)
         self.storage_broker = sb
 
+        # remember how quickly each server responds across restarts
+        if self.get_config("client", "peers.remember_performance",
+                           default=True, boolean=True):
+            dbfile = os.path.join(self.basedir, "private",
+                                  "server_performance.sqlite")
+            perfdb = PerformanceDB(dbfile, sb)
+            perfdb.setServiceParent(self)
+            sb.use_performance_db(perfdb)
+
         # load static server specifications from tahoe.cfg, if any.
         # Not quite ready yet.
         #if self.config.has_section("client-server-selection"):
@@ -439,6 +564,24 @@ class Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        servermap_ttl = float(self.get_config("client", "mutable.servermap_ttl", 0))
+        if servermap_ttl < 0:
+            raise InvalidValueError("[client]mutable.servermap_ttl must not be negative")
+        servermap_revalidate = self.get_config("client",
+                                               "mutable.servermap_revalidate",
+                                               False, boolean=True)
+        check_cache_ttl = float(self.get_config("client", "check.cache_ttl", 0))
+        if check_cache_ttl < 0:
+            raise InvalidValueError("[client]check.cache_ttl must not be negative")
+        check_results_cache = None
+        if check_cache_ttl:
+            check_results_cache = CheckResultsCache(check_cache_ttl)
+        verify_sample = self.get_config("client", "check.verify_sample", None)
+        if verify_sample is not None:
+            verify_sample = float(verify_sample)
+            if not 0 < verify_sample <= 1:
+                raise InvalidValueError("[client]check.verify_sample must be"
+                                        " greater than 0 and at most 1")
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -447,7 +590,29 @@ class Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   servermap_ttl, servermap_revalidate,
+                                   check_results_cache, verify_sample)
+
+    def init_deep_check_journal(self):
+        # remember the progress of deep-checks across restarts
+        if self.get_config("client", "deep-check.journal",
+                           default=True, boolean=True):
+            dbfile = os.path.join(self.basedir, "private", "deepcheck.sqlite")
+            self.deep_check_journal = DeepCheckJournal(dbfile)
+            self.deep_check_journal.setServiceParent(self)
+        s_h_w = self.get_config("client", "deep-check.skip_healthy_within", None)
+        if s_h_w is not None:
+            self.deep_check_skip_healthy_within = parse_duration(s_h_w)
+
+    def get_deep_check_journal(self):
+        return self.deep_check_journal
+
+    def get_directory_cache(self):
+        return self.directory_cache
+
+    def get_check_results_cache(self):
+        return self.nodemaker.check_results_cache
 
     def get_history(self):
         return self.history
@@ -481,6 +646,20 @@ class Client(node.Node, pollmixin.PollMixin):
         d.addErrback(log.err, facility="tahoe.init",
                      level=log.BAD, umid="K0mW5w")
 
+    def init_key_pool(self):
+        low_water = int(self.get_config("client", "keypool.low_water", 1))
+        high_water = int(self.get_config("client", "keypool.high_water", 4))
+        if high_water < low_water:
+            raise InvalidValueError("[client]keypool.high_water must not be "
+                                    "smaller than [client]keypool.low_water")
+        if self.get_config("client", "key_generator.furl", None):
+            # keys come from the remote key generator, so a pool of our own
+            # would never be used
+            low_water = high_water = 0
+        poolfile = os.path.join(self.basedir, "private", "rsa_keypool")
+        self._key_generator = KeyGenerator(poolfile, low_water, high_water)
+        self._key_generator.setServiceParent(self)
+
     def init_key_gen(self, key_gen_furl):
         d = self.when_tub_ready()
         def _subscribe(self):
@@ -503,7 +682,12 @@ class Client(node.Node, pollmixin.PollMixin):
         self.log("init_web(webport=%s)", args=(webport,))
 
         from allmydata.webish import WebishServer
+        from allmydata.web.dircache import DirectoryCache
         nodeurl_path = os.path.join(self.basedir, "node.url")
+        cache_size = self.get_config_size("node", "web.directory_cache_size",
+                                          "0")
+        if cache_size:
+            self.directory_cache = DirectoryCache(cache_size)
         staticdir_config = self.get_config("node", "web.static", "public_html").decode("utf-8")
         staticdir = abspath_expanduser_unicode(staticdir_config, base=self.basedir)
         ws = WebishServer(self, webport, nodeurl_path, staticdir)
@@ -602,7 +786,11 @@ class Client(node.Node, pollmixin.PollMixin):
         # may get an opaque node if there were any problems.
         return self.nodemaker.create_from_cap(write_uri, read_uri, deep_immutable=deep_immutable, name=name)
 
-    def create_dirnode(self, initial_children={}, version=None):
+    def create_dirnode(self, initial_children={}, version=None, shards=None):
+        if shards:
+            return self.nodemaker.create_new_sharded_directory(initial_children,
+                                                               shards=shards,
+                                                               version=version)
         d = self.nodemaker.create_new_mutable_directory(initial_children, version=version)
         return d
 
@@ -0,0 +1,268 @@
+
+import time, simplejson
+
+from twisted.application import service
+from twisted.application.internet import TimerService
+
+from allmydata.util import dbutil, log
+
+
+DEEP_CHECK_JOURNAL_SCHEMA_V1 = """
+CREATE TABLE `version`
+(
+ version INTEGER -- contains one row, set to 1
+);
+
+CREATE TABLE `operations`
+(
+ `ophandle` VARCHAR PRIMARY KEY,
+ `root_cap` VARCHAR not null,    -- the directory being checked
+ `verify` INTEGER not null,
+ `repair` INTEGER not null,
+ `add_lease` INTEGER not null,
+ `started` INTEGER not null,     -- seconds since epoch
+ `finished` INTEGER              -- NULL until the walk is complete
+);
+
+CREATE TABLE `pending_directories`
+(
+ `ophandle` VARCHAR not null,
+ `verifycap` VARCHAR not null,
+ `seq` INTEGER not null,         -- the order in which they were found
+ `writecap` VARCHAR,
+ `readcap` VARCHAR,
+ `path` VARCHAR not null,        -- JSON list of child names
+ PRIMARY KEY (`ophandle`, `verifycap`)
+);
+
+CREATE TABLE `visited`
+(
+ `ophandle` VARCHAR not null,
+ `verifycap` VARCHAR not null,   -- checked by this operation
+ PRIMARY KEY (`ophandle`, `verifycap`)
+);
+
+CREATE TABLE `problems`
+(
+ `ophandle` VARCHAR not null,
+ `verifycap` VARCHAR not null,
+ `path` VARCHAR not null,        -- JSON list of child names
+ `results` VARCHAR not null,     -- JSON, see check_results.dump_check_results
+ PRIMARY KEY (`ophandle`, `verifycap`)
+);
+
+CREATE TABLE `checked`
+(
+ `verifycap` VARCHAR PRIMARY KEY,
+ `last_checked` INTEGER not null, -- seconds since epoch
+ `healthy` INTEGER not null,
+ `lease_added` INTEGER not null
+);
+"""
+
+
+class DeepCheckJournal(service.MultiService):
+    """I record the progress of deep-check (and deep-check-and-repair)
+    operations that were started with an ophandle, so that they can carry on
+    where they left off after the node is restarted. I also remember when
+    each object was last found to be healthy, so that deep-checks can skip
+    objects that were checked recently.
+
+    For each operation I keep the directories that have been found but not
+    yet completely walked, the verify-caps of the objects it has checked
+    (which are treated as already visited when it is resumed), and the
+    results for those that were unhealthy or repaired, so that the report
+    of a resumed operation still lists them.
+
+    My changes are committed every COMMIT_INTERVAL seconds, when an
+    operation finishes, and when the node shuts down, so a crash may cause
+    the last few objects to be checked a second time.
+    """
+    COMMIT_INTERVAL = 10
+
+    def __init__(self, dbfile):
+        service.MultiService.__init__(self)
+        self._dbfile = dbfile
+        self._db = None
+        self._open_db()
+        t = TimerService(self.COMMIT_INTERVAL, self.commit)
+        t.setServiceParent(self)
+
+    def _open_db(self):
+        if self._db is None:
+            (self._sqlite,
+             self._db) = dbutil.get_db(self._dbfile,
+                                       create_version=(DEEP_CHECK_JOURNAL_SCHEMA_V1, 1),
+                                       dbname="deepcheckjournal")
+            self._cursor = self._db.cursor()
+
+    def _close_db(self):
+        try:
+            self._cursor.close()
+        finally:
+            self._cursor = None
+        self._db.close()
+        self._db = None
+
+    def startService(self):
+        self._open_db()
+        return service.MultiService.startService(self)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        def _stopped(res):
+            self.commit()
+            self._close_db()
+            return res
+        d.addBoth(_stopped)
+        return d
+
+    def commit(self):
+        if self._db is not None:
+            self._db.commit()
+
+    def start_operation(self, ophandle, root, verify, repair, add_lease,
+                        now=None):
+        """Return a JournaledOperation for a deep-check of the directory
+        'root'. If an unfinished operation with the same ophandle, root and
+        options is on record, it is resumed. Otherwise any old record for the
+        ophandle is replaced."""
+        now = int(now or time.time())
+        root_cap = root.get_uri()
+        options = (int(bool(verify)), int(bool(repair)), int(bool(add_lease)))
+        self._cursor.execute("SELECT `root_cap`, `verify`, `repair`, `add_lease`,"
+                             " `started`, `finished`"
+                             " FROM `operations` WHERE `ophandle` = ?",
+                             (ophandle,))
+        row = self._cursor.fetchone()
+        if row is not None:
+            (old_root_cap, old_verify, old_repair, old_add_lease,
+             started, finished) = row
+            if (old_root_cap == root_cap and finished is None and
+                (old_verify, old_repair, old_add_lease) == options):
+                log.msg(format="resuming deep-check %(ophandle)s",
+                        ophandle=ophandle, level=log.OPERATIONAL)
+                return JournaledOperation(self, ophandle, True)
+            self._forget_operation(ophandle)
+        self._cursor.execute("INSERT INTO `operations`"
+                             " VALUES (?,?,?,?,?,?,NULL)",
+                             (ophandle, root_cap) + options + (now,))
+        self.commit()
+        return JournaledOperation(self, ophandle, False)
+
+    def _forget_progress(self, ophandle):
+        for table in ("pending_directories", "visited", "problems"):
+            self._cursor.execute("DELETE FROM `%s` WHERE `ophandle` = ?" % table,
+                                 (ophandle,))
+
+    def _forget_operation(self, ophandle):
+        self._forget_progress(ophandle)
+        self._cursor.execute("DELETE FROM `operations`"
+                             " WHERE `ophandle` = ?", (ophandle,))
+
+    def recently_healthy(self, verifycap, max_age, add_lease, now=None):
+        """Return True if the object with the given verify-cap was found to
+        be healthy within the last max_age seconds (and, if add_lease is
+        True, had its leases renewed at the same time)."""
+        now = now or time.time()
+        self._cursor.execute("SELECT `last_checked`, `healthy`, `lease_added`"
+                             " FROM `checked` WHERE `verifycap` = ?",
+                             (verifycap,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return False
+        (last_checked, healthy, lease_added) = row
+        if not healthy or now - last_checked > max_age:
+            return False
+        if add_lease and not lease_added:
+            return False
+        return True
+
+    def record_checked(self, verifycap, healthy, lease_added, now=None):
+        now = int(now or time.time())
+        self._cursor.execute("INSERT OR REPLACE INTO `checked`"
+                             " VALUES (?,?,?,?)",
+                             (verifycap, now, int(bool(healthy)),
+                              int(bool(lease_added))))
+
+
+class JournaledOperation:
+    """I am the DeepCheckJournal's record of a single deep-check. The
+    DeepTraversal tells me which directories it has found and finished
+    with, and the DeepChecker tells me about each object it has checked."""
+
+    def __init__(self, journal, ophandle, resumed):
+        self._journal = journal
+        self._cursor = journal._cursor
+        self._ophandle = ophandle
+        self.resumed = resumed
+        self._cursor.execute("SELECT MAX(`seq`) FROM `pending_directories`"
+                             " WHERE `ophandle` = ?", (ophandle,))
+        (seq,) = self._cursor.fetchone()
+        self._seq = seq or 0
+
+    def get_visited(self):
+        """Return the set of verify-caps (as strings) that the walk has
+        already dealt with, including the pending directories."""
+        self._cursor.execute("SELECT `verifycap` FROM `visited`"
+                             " WHERE `ophandle` = ?", (self._ophandle,))
+        visited = set([str(vc) for (vc,) in self._cursor.fetchall()])
+        self._cursor.execute("SELECT `verifycap` FROM `pending_directories`"
+                             " WHERE `ophandle` = ?", (self._ophandle,))
+        visited.update([str(vc) for (vc,) in self._cursor.fetchall()])
+        return visited
+
+    def get_pending_directories(self):
+        """Return a list of (writecap, readcap, path) tuples for the
+        directories still to be walked, in the order they were found."""
+        self._cursor.execute("SELECT `writecap`, `readcap`, `path`"
+                             " FROM `pending_directories` WHERE `ophandle` = ?"
+                             " ORDER BY `seq`", (self._ophandle,))
+        return [(writecap and str(writecap), readcap and str(readcap),
+                 simplejson.loads(path))
+                for (writecap, readcap, path) in self._cursor.fetchall()]
+
+    def directory_found(self, verifycap, writecap, readcap, path):
+        self._seq += 1
+        self._cursor.execute("INSERT OR REPLACE INTO `pending_directories`"
+                             " VALUES (?,?,?,?,?,?)",
+                             (self._ophandle, verifycap, self._seq,
+                              writecap, readcap, simplejson.dumps(path)))
+
+    def directory_done(self, verifycap):
+        self._cursor.execute("DELETE FROM `pending_directories`"
+                             " WHERE `ophandle` = ? AND `verifycap` = ?",
+                             (self._ophandle, verifycap))
+
+    def recently_healthy(self, verifycap, max_age, add_lease):
+        return self._journal.recently_healthy(verifycap, max_age, add_lease)
+
+    def node_checked(self, verifycap, healthy, lease_added):
+        self._journal.record_checked(verifycap, healthy, lease_added)
+        self._cursor.execute("INSERT OR IGNORE INTO `visited` VALUES (?,?)",
+                             (self._ophandle, verifycap))
+
+    def problem_found(self, verifycap, path, results):
+        """Remember the results (a dict from
+        check_results.dump_check_results or dump_check_and_repair_results)
+        of an object at 'path' that was unhealthy or was repaired."""
+        self._cursor.execute("INSERT OR REPLACE INTO `problems`"
+                             " VALUES (?,?,?,?)",
+                             (self._ophandle, verifycap, simplejson.dumps(path),
+                              simplejson.dumps(results)))
+
+    def get_problems(self):
+        """Return a list of (path, results) for the objects given to
+        problem_found(), in the order they were found."""
+        self._cursor.execute("SELECT `path`, `results` FROM `problems`"
+                             " WHERE `ophandle` = ? ORDER BY `rowid`",
+                             (self._ophandle,))
+        return [(simplejson.loads(path), simplejson.loads(results))
+                for (path, results) in self._cursor.fetchall()]
+
+    def finish(self):
+        self._journal._forget_progress(self._ophandle)
+        self._cursor.execute("UPDATE `operations` SET `finished` = ?"
+                             " WHERE `ophandle` = ?",
+                             (int(time.time()), self._ophandle))
+        self._journal.commit()
@@ -1,9 +1,11 @@
 
-import time, math, unicodedata
+import time, math, struct, unicodedata
+from UserDict import DictMixin
 
 from zope.interface import implements
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from twisted.python import failure
+from foolscap.api import eventually
 import simplejson
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
@@ -12,15 +14,20 @@ from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
      MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
-from allmydata.check_results import DeepCheckResults, \
-     DeepCheckAndRepairResults
-from allmydata.monitor import Monitor
+from allmydata.check_results import CheckResults, CheckAndRepairResults, \
+     DeepCheckResults, DeepCheckAndRepairResults, dump_check_results, \
+     load_check_results, dump_check_and_repair_results, \
+     load_check_and_repair_results
+from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata.util import hashutil, mathutil, base32, log
 from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
 from allmydata.util.netstring import netstring, split_netstring
 from allmydata.util.consumer import download_to_data
-from allmydata.uri import LiteralFileURI, from_string, wrap_dirnode_cap
+from allmydata.util.fileutil import EncryptedTemporaryFile
+from allmydata.util.deferredutil import gatherResults
+from allmydata.uri import LiteralFileURI, from_string, wrap_dirnode_cap, \
+     wrap_sharded_dirnode_cap
 from pycryptopp.cipher.aes import AES
 from allmydata.util.dictutil import AuxValueDict
 
@@ -71,6 +78,19 @@ def update_metadata(metadata, new_metadata, now):
 def normalize(namex):
     return unicodedata.normalize('NFC', namex)
 
+# a sharded directory spreads its children over this many shards unless told
+# otherwise, and never over more than MAX_DIRECTORY_SHARDS (each of which is
+# a mutable file that needs an RSA key of its own)
+DEFAULT_DIRECTORY_SHARDS = 16
+MAX_DIRECTORY_SHARDS = 256
+
+def shard_for_name(name, num_shards):
+    """Return the number of the shard that holds the child with the given
+    (normalized) name, in a sharded directory with num_shards shards."""
+    h = hashutil.dirnode_shard_hash(name.encode("utf-8"))
+    (value,) = struct.unpack(">Q", h[:8])
+    return value % num_shards
+
 # TODO: {Deleter,MetadataSetter,Adder}.modify all start by unpacking the
 # contents and end by repacking them. It might be better to apply them to
 # the unpacked contents.
@@ -203,9 +223,11 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
          children[unicode_nfc_name] = (IFileSystemNode, metadata_dict)
     and pack it into a single string, for use as the contents of the backing
     file. This is the same format as is returned by _unpack_contents. I also
-    accept an AuxValueDict, in which case I'll use the auxilliary cached data
-    as the pre-packed entry, which is faster than re-packing everything each
-    time.
+    accept an AuxValueDict (or the LazyChildren that _unpack_contents
+    returns), in which case I'll use the auxilliary cached data as the
+    pre-packed entry, which is faster than re-packing everything each time.
+    The entries of LazyChildren that were never created (and so cannot have
+    been changed) are copied without creating or checking those children.
 
     If writekey is provided then I will superencrypt the child's writecap with
     writekey.
@@ -215,17 +237,30 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
     """
     precondition((writekey is None) or isinstance(writekey, str), writekey)
 
-    has_aux = isinstance(children, AuxValueDict)
+    has_aux = isinstance(children, (AuxValueDict, LazyChildren))
+    # the packed entries of a mutable directory hold encrypted writecaps, so
+    # they cannot be copied into an immutable one
+    lazy = isinstance(children, LazyChildren) and not deep_immutable
+    if lazy:
+        names = children.keys_without_creating()
+    else:
+        names = children.keys()
     entries = []
-    for name in sorted(children.keys()):
+    for name in sorted(names):
         assert isinstance(name, unicode)
+        if lazy:
+            entry = children.get_packed(name)
+            if entry:
+                entries.append(netstring(entry))
+                continue
         entry = None
         (child, metadata) = children[name]
         child.raise_error()
         if deep_immutable and not child.is_allowed_in_immutable_directory():
             raise MustBeDeepImmutableError("child %s is not allowed in an immutable directory" %
                                            quote_output(name, encoding='utf-8'), name)
-        if has_aux:
+        if has_aux and not deep_immutable:
+            # an unchanged child can reuse the entry it was unpacked from
             entry = children.get_aux(name)
         if not entry:
             assert IFilesystemNode.providedBy(child), (name,child)
@@ -253,6 +288,93 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
         entries.append(netstring(entry))
     return "".join(entries)
 
+class LazyChildren(DictMixin):
+    """I am the dict-like object that DirectoryNode._unpack_contents returns.
+    I hold each child as its packed entry until its value is first needed,
+    so that looking up or testing for a few children of a large directory
+    does not have to decrypt, parse and create nodes for all of them. I keep
+    the packed entry of each child that has been created as its auxvalue in
+    an AuxValueDict, so that repacking the directory can copy the entries
+    of unchanged children.
+
+    Creating a child can reveal that its entry is unusable, in which case
+    I drop it, as _unpack_contents does. Anything that needs all the keys
+    (including keys(), len() and iteration) creates every child first, so
+    that unusable entries are never seen. The exception is repacking, which
+    copies the entries of children that were never created unchanged.
+    """
+
+    def __init__(self, unpack_entry):
+        self._children = AuxValueDict()
+        self._unpack_entry = unpack_entry
+        self._packed = {} # key -> entry, for children not created yet
+
+    def set_packed(self, key, entry):
+        self._packed[key] = entry
+
+    def _materialize(self, key):
+        entry = self._packed.pop(key, None)
+        if entry is not None:
+            value = self._unpack_entry(key, entry)
+            if value is not None:
+                self._children.set_with_aux(key, value, entry)
+
+    def materialize_all(self):
+        """Create every child that has not been created yet, and return
+        myself."""
+        for key in sorted(self._packed):
+            self._materialize(key)
+        return self
+
+    def __getitem__(self, key):
+        self._materialize(key)
+        return self._children[key]
+
+    def __contains__(self, key):
+        self._materialize(key)
+        return key in self._children
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        self._packed.pop(key, None)
+        self._children[key] = value
+
+    def __delitem__(self, key):
+        self._materialize(key)
+        del self._children[key]
+
+    def keys(self):
+        return self.materialize_all()._children.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys_without_creating(self):
+        """Return the names of all my children, without creating any. Some
+        of them may turn out to be unusable, see get_packed()."""
+        return self._packed.keys() + self._children.keys()
+
+    def get_packed(self, key):
+        """Return the packed entry of the child called 'key' if it has not
+        been created (or replaced) yet, otherwise None."""
+        return self._packed.get(key)
+
+    def get_aux(self, key, default=None):
+        return self._children.get_aux(key, default)
+
+    def set_with_aux(self, key, value, auxilliary):
+        self._packed.pop(key, None)
+        self._children.set_with_aux(key, value, auxilliary)
+
+    def copy(self):
+        new = AuxValueDict()
+        for key in self.keys():
+            new.set_with_aux(key, self._children[key], self._children.get_aux(key))
+        return new
+
 class DirectoryNode:
     implements(IDirectoryNode, ICheckable, IDeepCheckable)
     filenode_class = MutableFileNode
@@ -321,57 +443,67 @@ class DirectoryNode:
         # The rwcapdata is formatted as:
         # pack("16ss32s", iv, AES(H(writekey+iv), plaintext_rw_uri), mac)
         assert isinstance(data, str), (repr(data), type(data))
+        children = LazyChildren(self._unpack_entry)
         # an empty directory is serialized as an empty string
         if data == "":
-            return AuxValueDict()
-        writeable = not self.is_readonly()
+            return children
         mutable = self.is_mutable()
-        children = AuxValueDict()
         position = 0
         while position < len(data):
             entries, position = split_netstring(data, 1, position)
             entry = entries[0]
-            (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
-            if not mutable and len(rwcapdata) > 0:
-                raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
+            if mutable:
+                # only the name is needed now, see _unpack_entry
+                (namex_utf8,), subpos = split_netstring(entry, 1)
+            else:
+                (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+                if len(rwcapdata) > 0:
+                    raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
 
             # A name containing characters that are unassigned in one version of Unicode might
             # not be normalized wrt a later version. See the note in section 'Normalization Stability'
             # at <http://unicode.org/policies/stability_policy.html>.
             # Therefore we normalize names going both in and out of directories.
             name = normalize(namex_utf8.decode("utf-8"))
+            children.set_packed(name, entry)
 
-            rw_uri = ""
-            if writeable:
-                rw_uri = self._decrypt_rwcapdata(rwcapdata)
-
-            # Since the encryption uses CTR mode, it currently leaks the length of the
-            # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
-            # dirnode is writeable (ticket #925). By stripping trailing spaces in
-            # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
-            # ro_uri is treated in the same way for consistency.
-            # rw_uri and ro_uri will be either None or a non-empty string.
+        return children
 
-            rw_uri = rw_uri.rstrip(' ') or None
-            ro_uri = ro_uri.rstrip(' ') or None
+    def _unpack_entry(self, name, entry):
+        """I turn the packed entry for the child called name into a (node,
+        metadata) tuple, or return None if it cannot be used."""
+        (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+        mutable = self.is_mutable()
 
-            try:
-                child = self._create_and_validate_node(rw_uri, ro_uri, name)
-                if mutable or child.is_allowed_in_immutable_directory():
-                    metadata = simplejson.loads(metadata_s)
-                    assert isinstance(metadata, dict)
-                    children[name] = (child, metadata)
-                    children.set_with_aux(name, (child, metadata), auxilliary=entry)
-                else:
-                    log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
-                                   name=quote_output(name, encoding='utf-8'),
-                                   facility="tahoe.webish", level=log.UNUSUAL)
-            except CapConstraintError, e:
-                log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
-                               "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+        rw_uri = ""
+        if not self.is_readonly():
+            rw_uri = self._decrypt_rwcapdata(rwcapdata)
+
+        # Since the encryption uses CTR mode, it currently leaks the length of the
+        # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
+        # dirnode is writeable (ticket #925). By stripping trailing spaces in
+        # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
+        # ro_uri is treated in the same way for consistency.
+        # rw_uri and ro_uri will be either None or a non-empty string.
+
+        rw_uri = rw_uri.rstrip(' ') or None
+        ro_uri = ro_uri.rstrip(' ') or None
+
+        try:
+            child = self._create_and_validate_node(rw_uri, ro_uri, name)
+            if mutable or child.is_allowed_in_immutable_directory():
+                metadata = simplejson.loads(metadata_s)
+                assert isinstance(metadata, dict)
+                return (child, metadata)
+            else:
+                log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
+                               name=quote_output(name, encoding='utf-8'),
                                facility="tahoe.webish", level=log.UNUSUAL)
-
-        return children
+        except CapConstraintError, e:
+            log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
+                           "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+                           facility="tahoe.webish", level=log.UNUSUAL)
+        return None
 
     def _pack_contents(self, children):
         # expects children in the same format as _unpack_contents returns
@@ -429,7 +561,24 @@ class DirectoryNode:
     def list(self):
         """I return a Deferred that fires with a dictionary mapping child
         name to a tuple of (IFilesystemNode, metadata)."""
-        return self._read()
+        d = self._read()
+        d.addCallback(lambda children: children.materialize_all())
+        return d
+
+    def get_best_version(self):
+        """I return a Deferred that fires with the IReadable version of my
+        backing file that list() would read (for a mutable directory, an
+        IMutableFileVersion), to be passed to list_version(). Directories
+        whose children are not all held in that one file fire with None."""
+        return self._node.get_best_readable_version()
+
+    def list_version(self, version):
+        """Like list(), but read my children from 'version', as returned by
+        get_best_version()."""
+        d = download_to_data(version)
+        d.addCallback(self._unpack_contents)
+        d.addCallback(lambda children: children.materialize_all())
+        return d
 
     def has_child(self, namex):
         """I return a Deferred that fires with a boolean, True if there
@@ -632,10 +781,7 @@ class DirectoryNode:
             assert mutable_version is None
             d = self._nodemaker.create_immutable_directory(initial_children)
         def _created(child):
-            entries = {name: (child, metadata)}
-            a = Adder(self, entries, overwrite=overwrite,
-                      create_readonly_node=self._create_readonly_node)
-            d = self._node.modify(a.modify)
+            d = self.set_nodes({name: (child, metadata)}, overwrite=overwrite)
             d.addCallback(lambda res: child)
             return d
         d.addCallback(_created)
@@ -677,7 +823,7 @@ class DirectoryNode:
         return d
 
 
-    def deep_traverse(self, walker):
+    def deep_traverse(self, walker, journal=None):
         """Perform a recursive walk, using this dirnode as a root, notifying
         the 'walker' instance of everything I encounter.
 
@@ -698,6 +844,11 @@ class DirectoryNode:
         directory structure, this may appear to under-count or miss some of
         them.
 
+        If 'journal' is provided (a JournaledOperation from
+        allmydata.deepcheckjournal), I record my progress in it, and if it is
+        resumed I carry on from where the earlier walk stopped instead of
+        starting again at the root.
+
         I return a Monitor which can be used to wait for the operation to
         finish, learn about its progress, or cancel the operation.
         """
@@ -707,73 +858,23 @@ class DirectoryNode:
         # fanout to 10 simultaneous operations, but the memory load of the
         # queued operations was excessive (in one case, with 330k dirnodes,
         # it caused the process to run into the 3.0GB-ish per-process 32bit
-        # linux memory limit, and crashed). So we use a single big Deferred
-        # chain, and do a strict depth-first traversal, one node at a time.
-        # This can be slower, because we aren't pipelining directory reads,
-        # but it brought the memory footprint down by roughly 50%.
+        # linux memory limit, and crashed). Then we used a single big
+        # Deferred chain and a strict depth-first traversal, one node at a
+        # time, which was frugal but very slow. DeepTraversal gets both: it
+        # only queues the caps of directories it has yet to read (spilling
+        # them to disk when there are many), and it starts a bounded number
+        # of directory reads and walker operations at a time.
 
         monitor = Monitor()
         walker.set_monitor(monitor)
 
-        found = set([self.get_verify_cap()])
-        d = self._deep_traverse_dirnode(self, [], walker, monitor, found)
+        d = DeepTraversal(self, walker, monitor, journal).start()
         d.addCallback(lambda ignored: walker.finish())
         d.addBoth(monitor.finish)
         d.addErrback(lambda f: None)
 
         return monitor
 
-    def _deep_traverse_dirnode(self, node, path, walker, monitor, found):
-        # process this directory, then walk its children
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.add_node, node, path)
-        d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
-        return d
-
-    def _deep_traverse_dirnode_children(self, children, parent, path,
-                                        walker, monitor, found):
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.enter_directory, parent, children)
-        # we process file-like children first, so we can drop their FileNode
-        # objects as quickly as possible. Tests suggest that a FileNode (held
-        # in the client's nodecache) consumes about 2440 bytes. dirnodes (not
-        # in the nodecache) seem to consume about 2000 bytes.
-        dirkids = []
-        filekids = []
-        for name, (child, metadata) in sorted(children.iteritems()):
-            childpath = path + [name]
-            if isinstance(child, UnknownNode):
-                walker.add_node(child, childpath)
-                continue
-            verifier = child.get_verify_cap()
-            # allow LIT files (for which verifier==None) to be processed
-            if (verifier is not None) and (verifier in found):
-                continue
-            found.add(verifier)
-            if IDirectoryNode.providedBy(child):
-                dirkids.append( (child, childpath) )
-            else:
-                filekids.append( (child, childpath) )
-        for i, (child, childpath) in enumerate(filekids):
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          walker.add_node(child, childpath))
-            # to work around the Deferred tail-recursion problem
-            # (specifically the defer.succeed flavor) requires us to avoid
-            # doing more than 158 LIT files in a row. We insert a turn break
-            # once every 100 files (LIT or CHK) to preserve some stack space
-            # for other code. This is a different expression of the same
-            # Twisted problem as in #237.
-            if i % 100 == 99:
-                d.addCallback(lambda ignored: fireEventually())
-        for (child, childpath) in dirkids:
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          self._deep_traverse_dirnode(child, childpath,
-                                                      walker, monitor,
-                                                      found))
-        return d
-
 
     def build_manifest(self):
         """Return a Monitor, with a ['status'] that will be a list of (path,
@@ -787,12 +888,528 @@ class DirectoryNode:
         # children for which we've got both a write-cap and a read-cap
         return self.deep_traverse(DeepStats(self))
 
-    def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
+    def start_deep_check(self, verify=False, add_lease=False, journal=None,
+                         skip_healthy_within=None, force=False):
+        walker = DeepChecker(self, verify, repair=False, add_lease=add_lease,
+                             journal=journal,
+                             skip_healthy_within=skip_healthy_within,
+                             force=force)
+        return self.deep_traverse(walker, journal)
+
+    def start_deep_check_and_repair(self, verify=False, add_lease=False,
+                                    journal=None, skip_healthy_within=None,
+                                    force=False):
+        walker = DeepChecker(self, verify, repair=True, add_lease=add_lease,
+                             journal=journal,
+                             skip_healthy_within=skip_healthy_within,
+                             force=force)
+        return self.deep_traverse(walker, journal)
+
+
+
+class ShardedDirectoryNode(DirectoryNode):
+    """I am a mutable directory whose children are spread over a number of
+    ordinary mutable directories (the 'shards'), chosen by a hash of each
+    child's name. My own mutable file only holds an index of the shards, which
+    is written once when I am created. Adding, removing or changing a child
+    therefore only republishes the one shard that holds it, rather than a
+    single blob holding every child.
+
+    Operations that touch several children (set_children, set_nodes) are
+    applied to each affected shard separately, so they are not atomic.
+    """
+
+    def __init__(self, filenode, nodemaker, uploader):
+        DirectoryNode.__init__(self, filenode, nodemaker, uploader)
+        self._uri = wrap_sharded_dirnode_cap(filenode.get_cap())
+        # the index is never modified, so the shard list can be remembered
+        self._shards = None
+
+    def _get_shards(self):
+        if self._shards is not None:
+            return defer.succeed(self._shards)
+        d = DirectoryNode._read(self)
+        def _got_index(index):
+            shards = []
+            for i in range(len(index)):
+                entry = index.get(unicode(i))
+                if (entry is None or not IDirectoryNode.providedBy(entry[0])
+                    or not entry[0].is_mutable()):
+                    raise ValueError("malformed sharded directory index")
+                shards.append(entry[0])
+            if not shards:
+                raise ValueError("sharded directory index has no shards")
+            self._shards = shards
+            return shards
+        d.addCallback(_got_index)
+        return d
+
+    def _call_shard(self, name, methname, *args, **kwargs):
+        d = self._get_shards()
+        def _got_shards(shards):
+            shard = shards[shard_for_name(name, len(shards))]
+            return getattr(shard, methname)(*args, **kwargs)
+        d.addCallback(_got_shards)
+        return d
+
+    def _call_shards(self, entries, methname, *args, **kwargs):
+        # entries maps (possibly unnormalized) child names to anything.
+        # Each shard's method is called with the subset of entries it holds.
+        d = self._get_shards()
+        def _got_shards(shards):
+            groups = {}
+            for (namex, e) in entries.iteritems():
+                shardnum = shard_for_name(normalize(namex), len(shards))
+                groups.setdefault(shardnum, {})[namex] = e
+            return gatherResults([getattr(shards[i], methname)(group, *args, **kwargs)
+                                  for (i, group) in groups.iteritems()])
+        d.addCallback(_got_shards)
+        d.addCallback(lambda ign: self)
+        return d
+
+    def _read(self):
+        d = self._get_shards()
+        d.addCallback(lambda shards: gatherResults([s.list() for s in shards]))
+        def _merge(listings):
+            children = {}
+            for listing in listings:
+                children.update(listing)
+            return children
+        d.addCallback(_merge)
+        return d
+
+    def get_known_shards(self):
+        """Return the list of my shard dirnodes if I have read my index
+        already, otherwise None. This returns synchronously."""
+        return self._shards
+
+    def check(self, monitor, verify=False, add_lease=False):
+        d = self._check_with_shards(
+            lambda n: n.check(monitor, verify, add_lease),
+            lambda r: r.is_recoverable())
+        d.addCallback(lambda (index_results, shard_results):
+                      self._merge_check_results(index_results, shard_results))
+        return d
+
+    def check_and_repair(self, monitor, verify=False, add_lease=False):
+        d = self._check_with_shards(
+            lambda n: n.check_and_repair(monitor, verify, add_lease),
+            lambda r: r.get_post_repair_results().is_recoverable())
+        def _merge( (index_results, shard_results) ):
+            if not shard_results:
+                return index_results
+            all_results = [index_results] + shard_results
+            crr = CheckAndRepairResults(self.get_storage_index())
+            attempted = [r for r in all_results if r.get_repair_attempted()]
+            crr.repair_attempted = bool(attempted)
+            crr.repair_successful = bool(attempted) and \
+                                    all([r.get_repair_successful() for r in attempted])
+            crr.pre_repair_results = self._merge_check_results(
+                index_results.get_pre_repair_results(),
+                [r.get_pre_repair_results() for r in shard_results])
+            crr.post_repair_results = self._merge_check_results(
+                index_results.get_post_repair_results(),
+                [r.get_post_repair_results() for r in shard_results])
+            return crr
+        d.addCallback(_merge)
+        return d
+
+    def _check_with_shards(self, check, is_recoverable):
+        # Check the index and then every shard, so that leases are added to
+        # all of them. I fire with (index_results, shard_results). The
+        # shards cannot be found if the index is unrecoverable, in which case
+        # shard_results is empty.
+        d = check(self._node)
+        def _checked_index(index_results):
+            if not is_recoverable(index_results):
+                return (index_results, [])
+            d = self._get_shards()
+            d.addCallback(lambda shards: gatherResults([check(s) for s in shards]))
+            d.addCallback(lambda shard_results: (index_results, shard_results))
+            return d
+        d.addCallback(_checked_index)
+        return d
+
+    def _merge_check_results(self, index_results, shard_results):
+        """Combine the CheckResults for my index and for each of my shards
+        into one that describes the whole directory, under my own storage
+        index. I am only as healthy (or recoverable) as the worst of them,
+        and the share counts are those of the worst one. The report lists
+        every shard that is not healthy, with its storage index."""
+        if not shard_results:
+            return index_results
+        all_results = [index_results] + shard_results
+        worst = index_results
+        for r in all_results:
+            if not r.is_recoverable():
+                worst = r
+                break
+            if worst.is_healthy() and not r.is_healthy():
+                worst = r
+        healthy = all([r.is_healthy() for r in all_results])
+        recoverable = all([r.is_recoverable() for r in all_results])
+
+        summary = index_results.get_summary()
+        report = list(index_results.get_report())
+        share_problems = list(index_results.get_share_problems())
+        for (shardnum, r) in enumerate(shard_results):
+            share_problems.extend(r.get_share_problems())
+            if r.is_healthy():
+                continue
+            report.append("shard %d (SI %s): %s" %
+                          (shardnum, r.get_storage_index_string(),
+                           r.get_summary()))
+            report.extend(["  " + line for line in r.get_report()])
+            if r is worst:
+                summary = "shard %d: %s" % (shardnum, r.get_summary())
+
+        return CheckResults(self._uri, self.get_storage_index(),
+                            healthy=healthy, recoverable=recoverable,
+                            count_happiness=worst.get_happiness(),
+                            count_shares_needed=worst.get_encoding_needed(),
+                            count_shares_expected=worst.get_encoding_expected(),
+                            count_shares_good=worst.get_share_counter_good(),
+                            count_good_share_hosts=worst.get_host_counter_good_shares(),
+                            count_recoverable_versions=worst.get_version_counter_recoverable(),
+                            count_unrecoverable_versions=worst.get_version_counter_unrecoverable(),
+                            servers_responding=worst.get_servers_responding(),
+                            sharemap=worst.get_sharemap(),
+                            count_wrong_shares=worst.get_share_counter_wrong(),
+                            list_corrupt_shares=worst.get_corrupt_shares(),
+                            count_corrupt_shares=len(worst.get_corrupt_shares()),
+                            list_incompatible_shares=worst.get_incompatible_shares(),
+                            count_incompatible_shares=len(worst.get_incompatible_shares()),
+                            summary=summary,
+                            report=report,
+                            share_problems=share_problems,
+                            servermap=worst.get_servermap())
+
+    def list(self):
+        """I return a Deferred that fires with a dictionary mapping child
+        name to a tuple of (IFilesystemNode, metadata)."""
+        return self._read()
+
+    def get_best_version(self):
+        # my children are spread over several files, so no single version
+        # of one of them describes them all
+        return defer.succeed(None)
 
-    def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
+    def has_child(self, namex):
+        name = normalize(namex)
+        return self._call_shard(name, "has_child", name)
 
+    def get(self, namex):
+        name = normalize(namex)
+        return self._call_shard(name, "get", name)
+
+    def get_child_and_metadata(self, namex):
+        name = normalize(namex)
+        return self._call_shard(name, "get_child_and_metadata", name)
+
+    def get_metadata_for(self, namex):
+        name = normalize(namex)
+        return self._call_shard(name, "get_metadata_for", name)
+
+    def set_metadata_for(self, namex, metadata):
+        name = normalize(namex)
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        d = self._call_shard(name, "set_metadata_for", name, metadata)
+        d.addCallback(lambda res: self)
+        return d
+
+    def set_children(self, entries, overwrite=True):
+        return self._call_shards(entries, "set_children", overwrite=overwrite)
+
+    def set_node(self, namex, child, metadata=None, overwrite=True):
+        precondition(IFilesystemNode.providedBy(child), child)
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        name = normalize(namex)
+        return self._call_shard(name, "set_node", name, child, metadata,
+                                overwrite=overwrite)
+
+    def set_nodes(self, entries, overwrite=True):
+        precondition(isinstance(entries, dict), entries)
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        return self._call_shards(entries, "set_nodes", overwrite=overwrite)
+
+    def delete(self, namex, must_exist=True, must_be_directory=False, must_be_file=False):
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        name = normalize(namex)
+        return self._call_shard(name, "delete", name, must_exist=must_exist,
+                                must_be_directory=must_be_directory,
+                                must_be_file=must_be_file)
+
+
+def get_directory_shards(dirnode):
+    """Return the shard dirnodes of a sharded directory whose children have
+    been read, or an empty list for any other directory."""
+    if isinstance(dirnode, ShardedDirectoryNode):
+        return dirnode.get_known_shards() or []
+    return []
+
+
+class _SpillingStack:
+    """I am a stack of JSON-serializable items that keeps no more than
+    'threshold' of them in memory. When I grow beyond that, the older half of
+    my in-memory items is appended to an EncryptedTemporaryFile (the items may
+    contain caps), and read back once the newer ones have been popped.
+    """
+
+    def __init__(self, threshold):
+        self._threshold = max(threshold, 2)
+        self._items = []
+        self._spilled = [] # (offset, length, count) for each chunk on disk
+        self._spilled_count = 0
+        self._file = None
+        self._end = 0
+
+    def __len__(self):
+        return len(self._items) + self._spilled_count
+
+    def push(self, item):
+        self._items.append(item)
+        if len(self._items) > self._threshold:
+            self._spill()
+
+    def _spill(self):
+        count = len(self._items) // 2
+        data = simplejson.dumps(self._items[:count])
+        del self._items[:count]
+        if self._file is None:
+            self._file = EncryptedTemporaryFile()
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._spilled.append( (self._end, len(data), count) )
+        self._spilled_count += count
+        self._end += len(data)
+
+    def pop(self):
+        if not self._items:
+            (offset, length, count) = self._spilled.pop()
+            self._file.seek(offset)
+            self._items = simplejson.loads(self._file.read(length))
+            self._spilled_count -= count
+            # the space can be reused by the next chunk we spill
+            self._end = offset
+        return self._items.pop()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _NodeBatch:
+    def __init__(self, nodes):
+        self.nodes = iter(nodes)
+        self.exhausted = False
+        self.outstanding = 0
+        self.failure = None
+        self.done = defer.Deferred()
+
+
+class DeepTraversal:
+    """I perform the walk for DirectoryNode.deep_traverse().
+
+    I read up to MAX_DIRECTORY_READS directories at a time, and keep up to
+    MAX_NODE_OPERATIONS calls to walker.add_node() (which may be checks or
+    repairs) outstanding at a time. Directories that I have found but not yet
+    read are held as (writecap, readcap, path) tuples in a stack that spills
+    to disk once it holds more than MAX_QUEUED_DIRECTORIES of them. My memory
+    use is therefore governed by these limits and by the size of the
+    directories being read, rather than by the size of the whole tree. The
+    exception is the set of verify-caps I have already seen, which is needed
+    to avoid loops.
+
+    If I am given a journal, I tell it about each directory I find and each
+    one I finish with, and when the journal is resumed I start from its
+    pending directories rather than from the root.
+    """
+    MAX_DIRECTORY_READS = 10
+    MAX_NODE_OPERATIONS = 10
+    MAX_QUEUED_DIRECTORIES = 1000
+    # give the reactor a turn after starting this many walker operations
+    TURN_LENGTH = 100
+
+    def __init__(self, root, walker, monitor, journal=None):
+        self._root = root
+        self._journal = journal
+        self._nodemaker = root._nodemaker
+        self._walker = walker
+        self._monitor = monitor
+        self._found = set()
+        self._directories = _SpillingStack(self.MAX_QUEUED_DIRECTORIES)
+        self._reading = 0
+        self._operations = 0
+        self._batches = []
+        self._pump_scheduled = False
+        self._finished = False
+        self._done = defer.Deferred()
+
+    def start(self):
+        """I return a Deferred that fires when the walk is complete."""
+        if self._journal and self._journal.resumed:
+            self._found = self._journal.get_visited()
+            # the most recently found directories are read first, as usual
+            for directory in self._journal.get_pending_directories():
+                self._directories.push(directory)
+            if len(self._directories):
+                self._read_more_directories()
+            else:
+                self._finish()
+            return self._done
+        self._found.add(self._root.get_verify_cap().to_string())
+        if self._journal:
+            self._journal.directory_found(self._journal_key(self._root),
+                                          self._root.get_write_uri(),
+                                          self._root.get_readonly_uri(), [])
+        self._read_directory(self._root, [])
+        return self._done
+
+    def _journal_key(self, node):
+        # LIT directories have no verify-cap, but their readcap is harmless
+        verifier = node.get_verify_cap()
+        if verifier is None:
+            return node.get_readonly_uri()
+        return verifier.to_string()
+
+    def _read_directory(self, node, path):
+        self._reading += 1
+        d = self._add_nodes([(node, path)])
+        if IDirectoryNode.providedBy(node):
+            d.addCallback(lambda ign: node.list())
+            d.addCallback(self._got_children, node, path)
+        d.addCallbacks(self._read_done, self._fail, callbackArgs=(node,))
+
+    def _got_children(self, children, parent, path):
+        self._monitor.raise_if_cancelled()
+        d = defer.maybeDeferred(self._walker.enter_directory, parent, children)
+        def _entered(ign):
+            # we process file-like children as soon as we can, so we can drop
+            # their FileNode objects. Subdirectories are only remembered by
+            # their caps until a reader is free to take them.
+            nodes = []
+            subdirs = []
+            for name, (child, metadata) in sorted(children.iteritems()):
+                childpath = path + [name]
+                if isinstance(child, UnknownNode):
+                    nodes.append( (child, childpath) )
+                    continue
+                verifier = child.get_verify_cap()
+                # allow LIT files (for which verifier==None) to be processed
+                if verifier is not None:
+                    verifier = verifier.to_string()
+                    if verifier in self._found:
+                        continue
+                    self._found.add(verifier)
+                if IDirectoryNode.providedBy(child):
+                    subdirs.append( (child, (child.get_write_uri(),
+                                             child.get_readonly_uri(),
+                                             childpath)) )
+                else:
+                    nodes.append( (child, childpath) )
+            # push in reverse, so they are read in name order
+            for (child, subdir) in reversed(subdirs):
+                if self._journal:
+                    self._journal.directory_found(self._journal_key(child),
+                                                  *subdir)
+                self._directories.push(subdir)
+            return self._add_nodes(nodes)
+        d.addCallback(_entered)
+        return d
+
+    def _read_done(self, ign, node):
+        self._reading -= 1
+        if self._journal:
+            self._journal.directory_done(self._journal_key(node))
+        if len(self._directories):
+            # go through the reactor, so that a tree full of synchronous
+            # directories does not recurse
+            eventually(self._read_more_directories)
+        elif not self._reading and not self._batches:
+            self._finish()
+
+    def _read_more_directories(self):
+        while (not self._finished and len(self._directories)
+               and self._reading < self.MAX_DIRECTORY_READS):
+            if self._monitor.is_cancelled():
+                self._fail(failure.Failure(OperationCancelledError()))
+                return
+            (rw_uri, ro_uri, path) = self._directories.pop()
+            node = self._nodemaker.create_from_cap(rw_uri and str(rw_uri),
+                                                   ro_uri and str(ro_uri))
+            self._read_directory(node, path)
+
+    def _add_nodes(self, nodes):
+        """I call walker.add_node() for each (node, path) pair, and return a
+        Deferred that fires when all of those calls have finished."""
+        batch = _NodeBatch(nodes)
+        self._batches.append(batch)
+        self._schedule_pump()
+        return batch.done
+
+    def _schedule_pump(self):
+        if not self._pump_scheduled:
+            self._pump_scheduled = True
+            eventually(self._pump)
+
+    def _pump(self):
+        self._pump_scheduled = False
+        started = 0
+        while (not self._finished and self._batches
+               and self._operations < self.MAX_NODE_OPERATIONS):
+            if self._monitor.is_cancelled():
+                self._fail(failure.Failure(OperationCancelledError()))
+                return
+            if started >= self.TURN_LENGTH:
+                self._schedule_pump()
+                return
+            batch = self._batches[0]
+            try:
+                (node, path) = batch.nodes.next()
+            except StopIteration:
+                self._batches.pop(0)
+                batch.exhausted = True
+                self._maybe_batch_done(batch)
+                continue
+            started += 1
+            self._operations += 1
+            batch.outstanding += 1
+            d = defer.maybeDeferred(self._walker.add_node, node, path)
+            d.addBoth(self._operation_done, batch)
+
+    def _operation_done(self, res, batch):
+        self._operations -= 1
+        batch.outstanding -= 1
+        if isinstance(res, failure.Failure) and batch.failure is None:
+            batch.failure = res
+        self._maybe_batch_done(batch)
+        self._schedule_pump()
+
+    def _maybe_batch_done(self, batch):
+        if batch.exhausted and not batch.outstanding:
+            if batch.failure:
+                batch.done.errback(batch.failure)
+            else:
+                batch.done.callback(None)
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self._directories.close()
+            if self._journal:
+                self._journal.finish()
+            self._done.callback(None)
+
+    def _fail(self, f):
+        if not self._finished:
+            self._finished = True
+            self._directories.close()
+            self._done.errback(f)
 
 
 class DeepStats:
@@ -852,6 +1469,9 @@ class DeepStats:
     def enter_directory(self, parent, children):
         dirsize_bytes = parent.get_size()
         if dirsize_bytes is not None:
+            # a sharded directory's children are stored in its shards
+            for shard in get_directory_shards(parent):
+                dirsize_bytes += shard.get_size() or 0
             self.add("size-directories", dirsize_bytes)
             self.max("largest-directory", dirsize_bytes)
         dirsize_children = len(children)
@@ -916,6 +1536,14 @@ class ManifestWalker(DeepStats):
             self.verifycaps.add(v.to_string())
         return DeepStats.add_node(self, node, path)
 
+    def enter_directory(self, parent, children):
+        # the shards of a sharded directory have no path of their own, but
+        # their shares need leases and checks just like the directory's
+        for shard in get_directory_shards(parent):
+            self.storage_index_strings.add(base32.b2a(shard.get_storage_index()))
+            self.verifycaps.add(shard.get_verify_cap().to_string())
+        return DeepStats.enter_directory(self, parent, children)
+
     def get_results(self):
         stats = DeepStats.get_results(self)
         return {"manifest": self.manifest,
@@ -926,7 +1554,8 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker:
-    def __init__(self, root, verify, repair, add_lease):
+    def __init__(self, root, verify, repair, add_lease, journal=None,
+                 skip_healthy_within=None, force=False):
         root_si = root.get_storage_index()
         if root_si:
             root_si_base32 = base32.b2a(root_si)
@@ -938,10 +1567,34 @@ class DeepChecker:
         self._verify = verify
         self._repair = repair
         self._add_lease = add_lease
+        # with a journal, I record the outcome of each check, and may skip
+        # files that were found healthy less than skip_healthy_within
+        # seconds ago
+        self._journal = journal
+        self._skip_healthy_within = skip_healthy_within
+        # with force=True, recent results from the nodemaker's check-results
+        # cache are thrown away rather than reused
+        self._forget_results = None
+        if force:
+            self._forget_results = root._nodemaker.check_results_cache
         if repair:
             self._results = DeepCheckAndRepairResults(root_si)
         else:
             self._results = DeepCheckResults(root_si)
+        # the journal only remembers the unhealthy (or repaired) objects
+        # among those checked before a restart, so the healthy ones (and the
+        # stats) of a resumed operation only cover the rest of the walk
+        self._results.resumed = bool(journal and journal.resumed)
+        if self._results.resumed:
+            storage_broker = root._nodemaker.storage_broker
+            for (path, data) in journal.get_problems():
+                if repair:
+                    self._results.add_check_and_repair(
+                        load_check_and_repair_results(data, storage_broker),
+                        path)
+                else:
+                    self._results.add_check(
+                        load_check_results(data, storage_broker), path)
         self._stats = DeepStats(root)
 
     def set_monitor(self, monitor):
@@ -949,15 +1602,50 @@ class DeepChecker:
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        if self._forget_results and node.get_storage_index():
+            self._forget_results.discard(node.get_storage_index())
+        verifier = node.get_verify_cap()
+        if verifier is not None and self._journal:
+            verifier = verifier.to_string()
+            if (self._skip_healthy_within is not None
+                and not IDirectoryNode.providedBy(node)
+                and self._journal.recently_healthy(verifier,
+                                                   self._skip_healthy_within,
+                                                   self._add_lease)):
+                self._stats.add_node(node, childpath)
+                return
         if self._repair:
             d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
+            if verifier is not None and self._journal:
+                d.addCallback(self._record_check_and_repair, verifier,
+                              childpath)
             d.addCallback(self._results.add_check_and_repair, childpath)
         else:
             d = node.check(self.monitor, self._verify, self._add_lease)
+            if verifier is not None and self._journal:
+                d.addCallback(self._record_check, verifier, childpath)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
+    def _record_check(self, cr, verifier, childpath):
+        if cr is not None:
+            if not cr.is_healthy():
+                self._journal.problem_found(verifier, list(childpath),
+                                            dump_check_results(cr))
+            self._journal.node_checked(verifier, cr.is_healthy(), self._add_lease)
+        return cr
+
+    def _record_check_and_repair(self, crr, verifier, childpath):
+        if crr is not None:
+            if (crr.get_repair_attempted()
+                or not crr.get_pre_repair_results().is_healthy()):
+                self._journal.problem_found(verifier, list(childpath),
+                                            dump_check_and_repair_results(crr))
+            post = crr.get_post_repair_results()
+            self._journal.node_checked(verifier, post.is_healthy(), self._add_lease)
+        return crr
+
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
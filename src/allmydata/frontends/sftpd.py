@@ -1,5 +1,6 @@
 
 import heapq, traceback, array, stat, struct
+from collections import OrderedDict
 from types import NoneType
 from stat import S_IFREG, S_IFDIR
 from time import time, strftime, localtime
@@ -28,9 +29,10 @@ from allmydata.util import deferredutil
 
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.util.consumer import download_to_data
+from allmydata.util.observer import OneShotObserverList
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.interfaces import IFileNode, IDirectoryNode, ExistingChildError, \
-     NoSuchChildError, ChildOfWrongTypeError
+     NoSuchChildError, ChildOfWrongTypeError, MDMF_VERSION
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.immutable.upload import FileHandle
@@ -644,6 +646,143 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
         return defer.execute(_denied)
 
 
+READ_BLOCK_SIZE = 128*1024
+READ_CACHE_BLOCKS = 8
+
+
+class RandomAccessReadOnlySFTPFile(PrefixingLogMixin):
+    implements(ISFTPFile)
+    """I represent a file handle to a particular file on an SFTP connection.
+    I am used for immutable and MDMF files that are opened in read-only mode
+    and are too large for a ShortReadOnlySFTPFile. Rather than downloading the
+    whole file, I satisfy each read request by reading just the blocks of
+    READ_BLOCK_SIZE bytes that it covers from the best version of the file
+    that was available when I was opened.
+
+    The most recently used READ_CACHE_BLOCKS blocks are kept in memory, and
+    when reads are sequential the block after the current one is fetched
+    ahead of time, so that a client reading the file in small chunks does
+    not have to wait for the grid on every request."""
+
+    def __init__(self, userpath, filenode, metadata):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
+        if noisy: self.log(".__init__(%r, %r, %r)" % (userpath, filenode, metadata), level=NOISY)
+
+        precondition(isinstance(userpath, str) and IFileNode.providedBy(filenode),
+                     userpath=userpath, filenode=filenode)
+        self.filenode = filenode
+        self.metadata = metadata
+        self.version = OneShotObserverList()
+        d = filenode.get_best_readable_version()
+        d.addBoth(self.version.fire)
+        self.closed = False
+        self._blocks = OrderedDict()  # blocknum -> data, least recently used first
+        self._pending = {}            # blocknum -> OneShotObserverList
+        self._next_offset = None
+
+    def readChunk(self, offset, length):
+        request = ".readChunk(%r, %r)" % (offset, length)
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise SFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
+            return defer.execute(_closed)
+
+        d = self.version.when_fired()
+        def _read(version):
+            size = version.get_size()
+            if noisy: self.log("_read(<version of size %r>) in readChunk(%r, %r)" % (size, offset, length), level=NOISY)
+
+            # We respond with an EOF error iff offset is already at EOF
+            # (see the comment in ShortReadOnlySFTPFile.readChunk).
+            if offset >= size:
+                raise SFTPError(FX_EOF, "read at or past end of file")
+
+            end = min(offset + length, size)
+            if end <= offset:
+                return ""
+
+            first = offset // READ_BLOCK_SIZE
+            last = (end - 1) // READ_BLOCK_SIZE
+            sequential = (offset == self._next_offset)
+            self._next_offset = end
+
+            d2 = defer.gatherResults([self._get_block(version, blocknum)
+                                      for blocknum in range(first, last+1)],
+                                     consumeErrors=True)
+            def _got_blocks(blocks):
+                data = "".join(blocks)
+                start = offset - first*READ_BLOCK_SIZE
+                return data[start:start + end - offset]
+            d2.addCallback(_got_blocks)
+
+            if (sequential and (last+1)*READ_BLOCK_SIZE < size and
+                last+1 not in self._blocks):
+                self._fetch_block(version, last+1)
+            return d2
+        d.addCallback(_read)
+        d.addBoth(_convert_error, request)
+        return d
+
+    def _get_block(self, version, blocknum):
+        if blocknum in self._blocks:
+            data = self._blocks.pop(blocknum)
+            self._blocks[blocknum] = data
+            return defer.succeed(data)
+        return self._fetch_block(version, blocknum).when_fired()
+
+    def _fetch_block(self, version, blocknum):
+        if blocknum in self._pending:
+            return self._pending[blocknum]
+        observer = OneShotObserverList()
+        self._pending[blocknum] = observer
+        start = blocknum*READ_BLOCK_SIZE
+        size = min(READ_BLOCK_SIZE, version.get_size() - start)
+        if noisy: self.log("fetching block %r (%r bytes at offset %r)" % (blocknum, size, start), level=NOISY)
+
+        d = download_to_data(version, start, size)
+        def _done(res):
+            del self._pending[blocknum]
+            if isinstance(res, str) and not self.closed:
+                self._blocks[blocknum] = res
+                while len(self._blocks) > READ_CACHE_BLOCKS:
+                    self._blocks.popitem(last=False)
+            observer.fire(res)
+        d.addBoth(_done)
+        return observer
+
+    def writeChunk(self, offset, data):
+        self.log(".writeChunk(%r, <data of length %r>) denied" % (offset, len(data)), level=OPERATIONAL)
+
+        def _denied(): raise SFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+    def close(self):
+        self.log(".close()", level=OPERATIONAL)
+
+        self.closed = True
+        self._blocks.clear()
+        return defer.succeed(None)
+
+    def getAttrs(self):
+        request = ".getAttrs()"
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise SFTPError(FX_BAD_MESSAGE, "cannot get attributes for a closed file handle")
+            return defer.execute(_closed)
+
+        d = self.version.when_fired()
+        d.addCallback(lambda version: _populate_attrs(self.filenode, self.metadata, size=version.get_size()))
+        d.addBoth(_convert_error, request)
+        return d
+
+    def setAttrs(self, attrs):
+        self.log(".setAttrs(%r) denied" % (attrs,), level=OPERATIONAL)
+        def _denied(): raise SFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+
 class GeneralSFTPFile(PrefixingLogMixin):
     implements(ISFTPFile)
     """I represent a file handle to a particular file on an SFTP connection.
@@ -1269,6 +1408,11 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() <= SIZE_THRESHOLD:
             d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+        elif (not writing and (flags & FXF_READ) and filenode and
+              (not filenode.is_mutable() or filenode.get_version() == MDMF_VERSION)):
+            # SDMF files can only be downloaded as a whole, so they are still
+            # read via a GeneralSFTPFile.
+            d.addCallback(lambda ign: RandomAccessReadOnlySFTPFile(userpath, filenode, metadata))
         else:
             close_notify = None
             if writing:
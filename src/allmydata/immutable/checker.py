@@ -1,3 +1,4 @@
+import math, random
 from zope.interface import implements
 from twisted.internet import defer
 from foolscap.api import DeadReferenceError, RemoteException
@@ -8,6 +9,7 @@ from allmydata.check_results import CheckResults
 from allmydata.uri import CHKFileVerifierURI
 from allmydata.util.assertutil import precondition
 from allmydata.util import base32, deferredutil, dictutil, log, mathutil
+from allmydata.util.limiter import ConcurrencyLimiter
 from allmydata.util.hashutil import file_renewal_secret_hash, \
      file_cancel_secret_hash, bucket_renewal_secret_hash, \
      bucket_cancel_secret_hash, uri_extension_hash, CRYPTO_VAL_SIZE, \
@@ -449,6 +451,13 @@ class Checker(log.PrefixingLogMixin):
     cryptographic integrity check on all of it. If not, I just ask each
     server 'Which shares do you have?' and believe its answer.
 
+    When verifying, I keep up to MAX_BLOCK_FETCHES_PER_SHARE block requests
+    outstanding for each share. If 'sample' is given (a fraction between 0
+    and 1), I only download and check a random selection of that fraction
+    of the blocks of each share (at least one), although all of the hashes
+    are still fetched and checked. This catches a share that has lost many
+    blocks with high probability, but may miss damage to just a few of them.
+
     In either case, I wait until I have gotten responses from all servers.
     This fact -- that I wait -- means that an ill-behaved server which fails
     to answer my questions will make me wait indefinitely. If it is
@@ -461,8 +470,10 @@ class Checker(log.PrefixingLogMixin):
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
     """
+    MAX_BLOCK_FETCHES_PER_SHARE = 4
+
     def __init__(self, verifycap, servers, verify, add_lease, secret_holder,
-                 monitor):
+                 monitor, sample=None):
         assert precondition(isinstance(verifycap, CHKFileVerifierURI), verifycap, type(verifycap))
 
         prefix = "%s" % base32.b2a_l(verifycap.get_storage_index()[:8], 60)
@@ -474,6 +485,9 @@ class Checker(log.PrefixingLogMixin):
         self._servers = servers
         self._verify = verify # bool: verify what the servers claim, or not?
         self._add_lease = add_lease
+        if sample is not None:
+            precondition(0 < sample <= 1, sample)
+        self._sample = sample
 
         frs = file_renewal_secret_hash(secret_holder.get_renewal_secret(),
                                        self._verifycap.get_storage_index())
@@ -505,7 +519,7 @@ class Checker(log.PrefixingLogMixin):
                                  renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        d = s.get_buckets(storageindex)
         def _wrap_results(res):
             return (res, True)
 
@@ -618,19 +632,30 @@ class Checker(log.PrefixingLogMixin):
             return None
 
         def _get_blocks(vrbp):
-            def _get_block(ign, blocknum):
+            # the hash trees are complete by now, so blocks can be validated
+            # in any order, and several can be in flight at once
+            limiter = ConcurrencyLimiter(self.MAX_BLOCK_FETCHES_PER_SHARE)
+            failed = []
+            def _get_block(blocknum):
+                if failed:
+                    return None
+                self._monitor.raise_if_cancelled()
                 db = vrbp.get_block(blocknum)
                 db.addCallback(_discard_result)
+                db.addErrback(_block_failed)
                 return db
+            def _block_failed(f):
+                failed.append(f)
+                return f
 
-            dbs = defer.succeed(None)
-            for blocknum in range(veup.num_segments):
-                dbs.addCallback(_get_block, blocknum)
+            dbs = [limiter.add(_get_block, blocknum)
+                   for blocknum in self._choose_blocks(veup.num_segments)]
 
-            # The Deferred we return will fire after every block of this
-            # share has been downloaded and verified successfully, or else it
-            # will errback as soon as the first error is observed.
-            return dbs
+            # The Deferred we return will fire after every chosen block of
+            # this share has been downloaded and verified successfully, or
+            # else it will errback as soon as the first error is observed.
+            # Blocks that were waiting for their turn are then skipped.
+            return deferredutil.gatherResults(dbs)
 
         d.addCallback(_get_blocks)
 
@@ -663,6 +688,12 @@ class Checker(log.PrefixingLogMixin):
 
         return d
 
+    def _choose_blocks(self, num_blocks):
+        if self._sample is None or self._sample >= 1:
+            return range(num_blocks)
+        count = max(1, int(math.ceil(num_blocks * self._sample)))
+        return sorted(random.sample(xrange(num_blocks), count))
+
     def _verify_server_shares(self, s):
         """ Return a deferred which eventually fires with a tuple of
         (set(sharenum), server, set(corruptsharenum),
@@ -778,6 +809,11 @@ class Checker(log.PrefixingLogMixin):
 
         count_happiness = servers_of_happiness(verifiedshares)
 
+        report = []
+        if self._verify and self._sample is not None and self._sample < 1:
+            report.append("verified a random %d%% of the blocks of each share"
+                          % int(math.ceil(self._sample * 100)))
+
         cr = CheckResults(self._verifycap, SI,
                           healthy=healthy, recoverable=bool(recoverable),
                           count_happiness=count_happiness,
@@ -795,7 +831,7 @@ class Checker(log.PrefixingLogMixin):
                           list_incompatible_shares=incompatibleshare_locators,
                           count_incompatible_shares=len(incompatibleshare_locators),
                           summary=summary,
-                          report=[],
+                          report=report,
                           share_problems=[],
                           servermap=None)
 
@@ -1,5 +1,6 @@
 
 from twisted.python.failure import Failure
+from twisted.internet import reactor
 from foolscap.api import eventually
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
 from allmydata.util import log
@@ -20,14 +21,25 @@ class SegmentFetcher:
     If I am unable to provide enough blocks, I will call my parent's
     fetch_failed() method with (self, f). After either of these events, I
     will shut down and do no further work. My parent can also call my stop()
-    method to have me shut down early."""
+    method to have me shut down early.
+
+    I prefer shares on servers that have recently been fast, according to
+    the performance model that each IServer maintains. If a request takes
+    longer than that server's HEDGE_PERCENTILE response time, I treat it as
+    OVERDUE, which causes me to send a hedge request for the same segment to
+    another share while the original request continues."""
+
+    HEDGE_PERCENTILE = 0.95
+    MIN_HEDGE_DELAY = 0.5 # never hedge requests younger than this (seconds)
 
     def __init__(self, node, segnum, k, logparent):
         self._node = node # _Node
         self.segnum = segnum
         self._k = k
         self._shares = [] # unused Share instances, sorted by "goodness"
-                          # (RTT), then shnum. This is populated when DYHB
+                          # (expected time to fetch a block from the
+                          # server, or DYHB RTT if we have no history for
+                          # it), then shnum. This is populated when DYHB
                           # responses arrive, or (for later segments) at
                           # startup. We remove shares from it when we call
                           # sh.get_block() on them.
@@ -45,6 +57,7 @@ class SegmentFetcher:
         self._lp = logparent
         self._share_observers = {} # maps Share to EventStreamObserver for
                                    # active ones
+        self._hedge_timers = {} # maps active Share to IDelayedCall
         self._blocks = {} # maps shnum to validated block data
         self._no_more_shares = False
         self._last_failure = None
@@ -67,7 +80,7 @@ class SegmentFetcher:
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        self._sort_shares()
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -77,6 +90,19 @@ class SegmentFetcher:
 
     # internal methods
 
+    def _sort_shares(self):
+        self._shares.sort(key=lambda s: (self._expected_block_time(s),
+                                         s._shnum) )
+
+    def _expected_block_time(self, share):
+        perf = share._server.get_performance()
+        t = perf.estimate_time(self._node.block_size or 0)
+        if t is None:
+            # we haven't heard from this server before, so the DYHB response
+            # time is the best guess we have
+            return share._dyhb_rtt
+        return t
+
     def loop(self):
         try:
             # if any exception occurs here, kill the download
@@ -188,6 +214,9 @@ class SegmentFetcher:
     def _find_and_use_share(self):
         sent_something = False
         want_more_diversity = False
+        # the servers' performance may have changed since the shares were
+        # added, e.g. as earlier blocks arrived
+        self._sort_shares()
         for sh in self._shares: # find one good share to fetch
             shnum = sh._shnum ; server = sh._server # XXX
             if shnum in self._blocks:
@@ -206,6 +235,7 @@ class SegmentFetcher:
             self._active_share_map[shnum] = sh
             self._shares_from_server.add(server, sh)
             self._start_share(sh, shnum)
+            self._schedule_hedge(sh, shnum)
             sent_something = True
             break
         return (sent_something, want_more_diversity)
@@ -214,6 +244,31 @@ class SegmentFetcher:
         self._share_observers[share] = o = share.get_block(self.segnum)
         o.subscribe(self._block_request_activity, share=share, shnum=shnum)
 
+    def _schedule_hedge(self, share, shnum):
+        perf = share._server.get_performance()
+        deadline = perf.get_latency_percentile(self.HEDGE_PERCENTILE)
+        if deadline is None:
+            return # not enough history to know what "late" means
+        delay = max(deadline, self.MIN_HEDGE_DELAY)
+        self._hedge_timers[share] = reactor.callLater(delay, self._hedge,
+                                                      share, shnum)
+
+    def _cancel_hedge(self, share):
+        t = self._hedge_timers.pop(share, None)
+        if t:
+            t.cancel()
+
+    def _hedge(self, share, shnum):
+        del self._hedge_timers[share]
+        if self._active_share_map.get(shnum) is not share:
+            return
+        log.msg("SegmentFetcher(%s) %s is late, hedging" %
+                (self._node._si_prefix, repr(share)),
+                level=log.NOISY, parent=self._lp, umid="n4D6cQ")
+        # the request stays outstanding, and may still complete, but we now
+        # behave as if it were OVERDUE and start using another share
+        self._block_request_activity(share, shnum, OVERDUE)
+
     def _ask_for_more_shares(self):
         if not self._no_more_shares:
             self._node.want_more_shares()
@@ -224,6 +279,9 @@ class SegmentFetcher:
         for o in self._share_observers.values():
             o.cancel()
         self._share_observers = {}
+        for t in self._hedge_timers.values():
+            t.cancel()
+        self._hedge_timers = {}
 
     def _block_request_activity(self, share, shnum, state, block=None, f=None):
         # called by Shares, in response to our s.send_request() calls.
@@ -236,6 +294,7 @@ class SegmentFetcher:
         # from all our tracking lists.
         if state in (COMPLETE, CORRUPT, DEAD, BADSEGNUM):
             self._share_observers.pop(share, None)
+            self._cancel_hedge(share)
             server = share._server # XXX
             self._shares_from_server.discard(server, share)
             if self._active_share_map.get(shnum) is share:
@@ -248,6 +307,7 @@ class SegmentFetcher:
 
         if state is OVERDUE:
             # no longer active, but still might complete
+            self._cancel_hedge(share)
             del self._active_share_map[shnum]
             self._overdue_share_map.add(shnum, share)
             # OVERDUE is not terminal: it will eventually transition to
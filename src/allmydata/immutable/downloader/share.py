@@ -32,6 +32,11 @@ class Share:
     # this is a specific implementation of IShare for tahoe's native storage
     # servers. A different backend would use a different class.
 
+    # Spans that are separated by no more than this many bytes are fetched
+    # with a single read, and the bytes in between are discarded. This
+    # trades a little bandwidth for fewer (and larger) requests.
+    READ_COALESCE_GAP = 1000
+
     def __init__(self, rref, server, verifycap, commonshare, node,
                  download_status, shnum, dyhb_rtt, logparent):
         self._rref = rref
@@ -84,6 +89,10 @@ class Share:
         v = server.get_version()
         ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver["tolerates-immutable-read-overrun"]
+        # Servers that advertise has-immutable-readv let us fetch several
+        # spans (offsets, hashes, block) with a single RPC. Older servers
+        # get one "read" per (coalesced) span.
+        self._readv_ok = ver.get("has-immutable-readv", False)
         # If _overrun_ok and we guess the offsets correctly, we can get
         # everything in one RTT. If _overrun_ok and we guess wrong, we might
         # need two RTT (but we could get lucky and do it in one). If overrun
@@ -731,9 +740,10 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
-        for (start, length) in ask:
-            # TODO: quantize to reasonably-large blocks
-            self._pending.add(start, length)
+        reads = []
+        for (start, length, wanted) in self._coalesce(ask):
+            for (w_start, w_length) in wanted:
+                self._pending.add(w_start, w_length)
             lp = log.msg(format="%(share)s._send_request"
                          " [%(start)d:+%(length)d]",
                          share=repr(self),
@@ -741,38 +751,106 @@ class Share:
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            reads.append( (start, length, wanted, block_ev, lp) )
+        if not reads:
+            return
+
+        if self._readv_ok and len(reads) > 1:
+            # one round trip for everything: the server returns a list of
+            # strings, in the same order as our read vector
+            d = self._send_readv([(r_start, r_length)
+                                  for (r_start, r_length, r_wanted, r_ev, r_lp)
+                                  in reads])
+            d.addCallback(self._record_performance, now())
+            d.addCallback(self._got_readv_data, reads)
+            d.addErrback(self._got_readv_error, reads)
+            self._finish_request(d)
+            return
+
+        for (start, length, wanted, block_ev, lp) in reads:
             d = self._send_request(start, length)
-            d.addCallback(self._got_data, start, length, block_ev, lp)
+            d.addCallback(self._record_performance, now())
+            d.addCallback(self._got_data, start, length, wanted, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
-            d.addCallback(self._trigger_loop)
-            d.addErrback(lambda f:
-                         log.err(format="unhandled error during send_request",
-                                 failure=f, parent=self._lp,
-                                 level=log.WEIRD, umid="qZu0wg"))
+            self._finish_request(d)
+
+    def _coalesce(self, ask):
+        """Merge the spans in 'ask' that lie within READ_COALESCE_GAP bytes
+        of each other. I return a list of (start, length, wanted) tuples,
+        where 'wanted' is the list of (start, length) spans from 'ask' that
+        the merged read covers. The bytes in the gaps are fetched but
+        thrown away when the response arrives."""
+        reads = []
+        for (start, length) in ask:
+            if reads:
+                (r_start, r_length, wanted) = reads[-1]
+                if start - (r_start + r_length) <= self.READ_COALESCE_GAP:
+                    reads[-1] = (r_start, start + length - r_start, wanted)
+                    wanted.append( (start, length) )
+                    continue
+            reads.append( (start, length, [(start, length)]) )
+        return reads
+
+    def _finish_request(self, d):
+        d.addCallback(self._trigger_loop)
+        d.addErrback(lambda f:
+                     log.err(format="unhandled error during send_request",
+                             failure=f, parent=self._lp,
+                             level=log.WEIRD, umid="qZu0wg"))
 
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
-    def _got_data(self, data, start, length, block_ev, lp):
+    def _send_readv(self, read_vector):
+        return self._rref.callRemote("readv", read_vector)
+
+    def _record_performance(self, res, started):
+        # feed the server's performance model, which SegmentFetchers use to
+        # rank servers and to decide when a request is late
+        if isinstance(res, list):
+            received = sum([len(data) for data in res])
+        else:
+            received = len(res)
+        self._server.get_performance().record_transfer(received,
+                                                       now() - started)
+        return res
+
+    def _got_readv_data(self, datav, reads):
+        for (data, (start, length, wanted, block_ev, lp)) in zip(datav, reads):
+            self._got_data(data, start, length, wanted, block_ev, lp)
+
+    def _got_readv_error(self, f, reads):
+        for (start, length, wanted, block_ev, lp) in reads:
+            block_ev.error(now())
+        (start, length, wanted, block_ev, lp) = reads[0]
+        end = reads[-1][0] + reads[-1][1]
+        self._got_error(f, start, end - start, None, lp)
+
+    def _got_data(self, data, start, length, wanted, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
             return
         log.msg(format="%(share)s._got_data [%(start)d:+%(length)d] -> %(datalen)d",
                 share=repr(self), start=start, length=length, datalen=len(data),
                 level=log.NOISY, parent=lp, umid="5Qn6VQ")
-        self._pending.remove(start, length)
-        self._received.add(start, data)
-
-        # if we ask for [a:c], and we get back [a:b] (b<c), that means we're
-        # never going to get [b:c]. If we really need that data, this block
-        # will never complete. The easiest way to get into this situation is
-        # to hit a share with a corrupted offset table, or one that's somehow
-        # been truncated. On the other hand, when overrun_ok is true, we ask
-        # for data beyond the end of the share all the time (it saves some
-        # RTT when we don't know the length of the share ahead of time). So
-        # not every asked-for-but-not-received byte is fatal.
-        if len(data) < length:
-            self._unavailable.add(start+len(data), length-len(data))
+        for (w_start, w_length) in wanted:
+            w_data = data[w_start-start:w_start-start+w_length]
+            self._pending.remove(w_start, w_length)
+            if w_data:
+                self._received.add(w_start, w_data)
+
+            # if we ask for [a:c], and we get back [a:b] (b<c), that means
+            # we're never going to get [b:c]. If we really need that data,
+            # this block will never complete. The easiest way to get into
+            # this situation is to hit a share with a corrupted offset table,
+            # or one that's somehow been truncated. On the other hand, when
+            # overrun_ok is true, we ask for data beyond the end of the share
+            # all the time (it saves some RTT when we don't know the length
+            # of the share ahead of time). So not every
+            # asked-for-but-not-received byte is fatal.
+            if len(w_data) < w_length:
+                self._unavailable.add(w_start+len(w_data),
+                                      w_length-len(w_data))
 
         # XXX if table corruption causes our sections to overlap, then one
         # consumer (i.e. block hash tree) will pop/remove the data that
@@ -797,7 +875,8 @@ class Share:
         # the offset table arrives, it's all "needed".
 
     def _got_error(self, f, start, length, block_ev, lp):
-        block_ev.error(now())
+        if block_ev:
+            block_ev.error(now())
         log.msg(format="error requesting %(start)d+%(length)d"
                 " from %(server)s for si %(si)s",
                 start=start, length=length,
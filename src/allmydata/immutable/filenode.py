@@ -32,6 +32,16 @@ class CiphertextFileNode:
         self._history = history
         self._download_status = None
         self._node = None # created lazily, on read()
+        self._check_results_cache = None
+        self._verify_sample = None
+
+    def set_check_results_cache(self, cache):
+        self._check_results_cache = cache
+
+    def set_verify_sample(self, sample):
+        """Make verifying checks look at a random 'sample' fraction of the
+        blocks of each share, instead of all of them."""
+        self._verify_sample = sample
 
     def _maybe_create_download_node(self):
         if not self._download_status:
@@ -91,12 +101,21 @@ class CiphertextFileNode:
         return False
 
     def check_and_repair(self, monitor, verify=False, add_lease=False):
+        cache = self._check_results_cache
+        if cache and not add_lease:
+            crr = cache.get_check_and_repair(self._verifycap.storage_index,
+                                             verify)
+            if crr:
+                return defer.succeed(crr)
         c = Checker(verifycap=self._verifycap,
                     servers=self._storage_broker.get_connected_servers(),
                     verify=verify, add_lease=add_lease,
                     secret_holder=self._secret_holder,
-                    monitor=monitor)
+                    monitor=monitor, sample=self._verify_sample)
         d = c.start()
+        if cache:
+            # a sampled verification does not count as a full one
+            d.addCallback(cache.add, verify and not self._verify_sample)
         d.addCallback(self._maybe_repair, monitor)
         return d
 
@@ -109,6 +128,8 @@ class CiphertextFileNode:
 
         crr.repair_attempted = True
         crr.repair_successful = False # until proven successful
+        if self._check_results_cache:
+            self._check_results_cache.discard(self._verifycap.storage_index)
         def _repair_error(f):
             # as with mutable repair, I'm not sure if I want to pass
             # through a failure or not. TODO
@@ -173,14 +194,22 @@ class CiphertextFileNode:
 
     def check(self, monitor, verify=False, add_lease=False):
         verifycap = self._verifycap
+        cache = self._check_results_cache
+        if cache and not add_lease:
+            cr = cache.get(verifycap.storage_index, verify)
+            if cr:
+                return defer.succeed(cr)
         sb = self._storage_broker
         servers = sb.get_connected_servers()
         sh = self._secret_holder
 
         v = Checker(verifycap=verifycap, servers=servers,
                     verify=verify, add_lease=add_lease, secret_holder=sh,
-                    monitor=monitor)
-        return v.start()
+                    monitor=monitor, sample=self._verify_sample)
+        d = v.start()
+        if cache:
+            d.addCallback(cache.add, verify and not self._verify_sample)
+        return d
 
 class DecryptingConsumer:
     """I sit between a CiphertextDownloader (which acts as a Producer) and
@@ -316,6 +345,12 @@ class ImmutableFileNode:
     def check(self, monitor, verify=False, add_lease=False):
         return self._cnode.check(monitor, verify, add_lease)
 
+    def set_check_results_cache(self, cache):
+        self._cnode.set_check_results_cache(cache)
+
+    def set_verify_sample(self, sample):
+        self._cnode.set_verify_sample(sample)
+
     def get_best_readable_version(self):
         """
         Return an IReadable of the best version of this file. Since
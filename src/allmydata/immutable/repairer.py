@@ -1,39 +1,75 @@
+import time
 from zope.interface import implements
 from twisted.internet import defer
+from allmydata import codec, uri
+from allmydata.hashtree import HashTree, IncompleteHashTree, \
+     BadHashError, NotEnoughHashesError, empty_leaf_hash, pair_hash
 from allmydata.storage.server import si_b2a
-from allmydata.util import log, consumer
+from allmydata.util import consumer, deferredutil, dictutil, log
 from allmydata.util.assertutil import precondition
+from allmydata.util.hashutil import block_hash, crypttext_segment_hash, \
+     uri_extension_hash
 from allmydata.interfaces import IEncryptedUploadable
 
-from allmydata.immutable import upload
+from allmydata.immutable import layout, upload
+from allmydata.immutable.checker import ValidatedExtendedURIProxy
+
+def fill_in_padding_hashes(sht, num_leaves):
+    """The leaves of a share hash tree beyond the last share hold fixed
+    'empty leaf' hashes. Put those into the (otherwise empty)
+    IncompleteHashTree 'sht', along with every node above them that does not
+    depend on a real leaf, so they need not be learned from the surviving
+    shares."""
+    for i in reversed(range(len(sht))):
+        if i >= sht.first_leaf_num:
+            leafnum = i - sht.first_leaf_num
+            if leafnum >= num_leaves:
+                sht[i] = empty_leaf_hash(leafnum)
+        else:
+            left = sht[sht.lchild(i)]
+            right = sht[sht.rchild(i)]
+            if left is not None and right is not None:
+                sht[i] = pair_hash(left, right)
+
+class RegenerationError(Exception):
+    """The missing shares could not be regenerated from the hashes stored in
+    the surviving ones, so the file must be re-encoded from scratch."""
 
 class Repairer(log.PrefixingLogMixin):
     implements(IEncryptedUploadable)
     """I generate any shares which were not available and upload them to
     servers.
 
-    Which servers? Well, I just use the normal upload process, so any servers
-    that will take shares. In fact, I even believe servers if they say that
-    they already have shares even if attempts to download those shares would
-    fail because the shares are corrupted.
-
-    My process of uploading replacement shares proceeds in a segment-wise
-    fashion -- first I ask servers if they can hold the new shares, and wait
-    until enough have agreed then I download the first segment of the file
-    and upload the first block of each replacement share, and only after all
-    those blocks have been uploaded do I download the second segment of the
-    file and upload the second block of each replacement share to its
-    respective server. (I do it this way in order to minimize the amount of
-    downloading I have to do and the amount of memory I have to use at any
-    one time.)
+    Which servers? Well, I use the normal upload server-selection process, so
+    any servers that will take shares. In fact, I even believe servers if
+    they say that they already have shares even if attempts to download those
+    shares would fail because the shares are corrupted.
+
+    I start by asking every server which shares it holds, and by fetching
+    the URI extension block and the share hash chains from those shares.
+    Then I ask servers to hold the shares that are missing, and regenerate
+    only those: I download the file one segment at a time, erasure-code each
+    segment into just the missing blocks, and upload the first block of each
+    replacement share before moving on to the second segment (while the next
+    segment is already being downloaded). The ciphertext hash tree and the
+    URI extension block are taken from the surviving shares, and each new
+    share's block hash tree is checked against the share root hash in the URI
+    extension block before the share is closed. This way I only need to hold
+    a couple of segments in memory at any one time, and I only have to
+    encode and push the shares that were lost.
+
+    If the surviving shares do not give me what I need to finish the new
+    shares (or the result does not match the original share hash tree), I
+    abandon them and fall back to re-encoding the whole file with the
+    regular uploader (for which I am the IEncryptedUploadable).
 
     If any of the servers to which I am uploading replacement shares fails to
     accept the blocks during this process, then I just stop using that
     server, abandon any share-uploads that were going to that server, and
     proceed to finish uploading the remaining shares to their respective
     servers. At the end of my work, I produce an object which satisfies the
-    ICheckAndRepairResults interface (by firing the deferred that I returned
-    from start() and passing that check-and-repair-results object).
+    IUploadResults interface (by firing the deferred that I returned from
+    start() and passing that upload-results object).
 
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
@@ -49,23 +85,373 @@ class Repairer(log.PrefixingLogMixin):
         self._secret_holder = secret_holder
         self._monitor = monitor
         self._offset = 0
+        self._verifycap = filenode.get_verify_cap()
+        self._storage_index = filenode.get_storage_index()
+        self._landlords = {} # shnum -> IStorageBucketWriter
+        self._pending_fetch = None
 
     def start(self):
         self.log("starting repair")
+        self._started = time.time()
         d = self._filenode.get_segment_size()
         def _got_segsize(segsize):
-            vcap = self._filenode.get_verify_cap()
+            vcap = self._verifycap
             k = vcap.needed_shares
             N = vcap.total_shares
             # Per ticket #1212
             # (http://tahoe-lafs.org/trac/tahoe-lafs/ticket/1212)
             happy = 0
             self._encodingparams = (k, happy, N, segsize)
-            ul = upload.CHKUploader(self._storage_broker, self._secret_holder)
-            return ul.start(self) # I am the IEncryptedUploadable
         d.addCallback(_got_segsize)
+        d.addCallback(lambda ign: self._regenerate())
+        def _regeneration_failed(f):
+            f.trap(RegenerationError)
+            self.log("unable to regenerate only the missing shares, "
+                     "re-encoding the whole file instead",
+                     failure=f, level=log.UNUSUAL)
+            return self._reencode()
+        d.addErrback(_regeneration_failed)
+        return d
+
+    def _reencode(self):
+        ul = upload.CHKUploader(self._storage_broker, self._secret_holder)
+        return ul.start(self) # I am the IEncryptedUploadable
+
+    def _regenerate(self):
+        self._times = {"cumulative_encoding": 0.0,
+                       "cumulative_sending": 0.0,
+                       }
+        self._ciphertext_fetched = 0
+        d = self._find_shares()
+        d.addCallback(self._get_ueb)
+        d.addCallback(self._get_share_hashes)
+        d.addCallback(lambda ign: self._locate_shareholders())
+        d.addCallback(self._set_shareholders)
+        d.addCallback(self._push_shares)
+        d.addCallback(lambda ign: self._build_results())
+        d.addErrback(self._abort)
+        return d
+
+    def _find_shares(self):
+        """Ask every server which shares of this file it holds. I fire with
+        a list of (shnum, server, ReadBucketProxy) tuples."""
+        si = self._storage_index
+        servers = self._storage_broker.get_servers_for_psi(si)
+        dl = []
+        for s in servers:
+            d = s.get_buckets(si)
+            def _got(buckets, s=s):
+                return [(shnum, s, layout.ReadBucketProxy(bucket, s, si))
+                        for (shnum, bucket) in buckets.items()]
+            def _failed(f, s=s):
+                self.log("failure from server %s on 'get_buckets'"
+                         % (s.get_name(),), failure=f, level=log.UNUSUAL)
+                return []
+            d.addCallbacks(_got, _failed)
+            dl.append(d)
+        d = deferredutil.gatherResults(dl)
+        d.addCallback(lambda results: sorted(sum(results, []),
+                                             key=lambda r: r[0]))
+        return d
+
+    def _get_ueb(self, readers):
+        """Fetch the URI extension block from the first share that has a
+        valid one, and remember both its parsed form and its raw bytes."""
+        if not readers:
+            raise RegenerationError("no shares were found")
+        self._readers = readers
+        remaining = list(readers)
+        def _try_next(f=None, rbp=None):
+            if f is not None:
+                self.log("unable to use the URI extension block from %s"
+                         % (rbp,), failure=f, level=log.UNUSUAL)
+            if not remaining:
+                raise RegenerationError("no valid URI extension block was "
+                                        "found")
+            (shnum, server, rbp) = remaining.pop(0)
+            vup = ValidatedExtendedURIProxy(rbp, self._verifycap)
+            d = vup.start()
+            def _validated(vup):
+                self._vup = vup
+                return rbp.get_uri_extension()
+            d.addCallback(_validated)
+            def _got_data(data):
+                if uri_extension_hash(data) != self._verifycap.uri_extension_hash:
+                    raise RegenerationError("URI extension block changed")
+                self._uri_extension = data
+                return readers
+            d.addCallback(_got_data)
+            d.addErrback(_try_next, rbp)
+            return d
+        return _try_next()
+
+    def _get_share_hashes(self, readers):
+        """Fetch share hash chains from some of the surviving shares, and
+        check them against the share root hash from the URI extension block.
+        For each missing share I only need the chain of the nearest
+        surviving share (the one whose leaf shares the deepest ancestor with
+        it): together with the leaves of the missing shares, which I
+        compute myself, that provides every hash in the new share's
+        chain."""
+        N = self._verifycap.total_shares
+        sht = IncompleteHashTree(N)
+        fill_in_padding_hashes(sht, N)
+        sht.set_hashes({0: self._vup.share_root_hash})
+        self._share_hash_tree = sht
+        self._present_shares = dictutil.DictOfSets() # shnum -> servers
+        first_reader = {}
+        for (shnum, server, rbp) in readers:
+            if 0 <= shnum < N:
+                self._present_shares.add(shnum, server)
+                first_reader.setdefault(shnum, rbp)
+        self._missing_shares = [shnum for shnum in range(N)
+                                if shnum not in self._present_shares]
+        sources = set()
+        for missing in self._missing_shares:
+            nearest = min(first_reader,
+                          key=lambda shnum: ((shnum ^ missing).bit_length(),
+                                             shnum))
+            sources.add(nearest)
+        dl = []
+        for shnum in sorted(sources):
+            rbp = first_reader[shnum]
+            d = rbp.get_share_hashes()
+            d.addCallback(self._add_share_hashes, shnum)
+            def _failed(f, rbp=rbp):
+                self.log("unable to get the share hashes from %s" % (rbp,),
+                         failure=f, level=log.UNUSUAL)
+            d.addErrback(_failed)
+            dl.append(d)
+        return deferredutil.gatherResults(dl)
+
+    def _add_share_hashes(self, hashes, shnum):
+        try:
+            self._share_hash_tree.set_hashes(hashes=dict(hashes))
+        except (BadHashError, NotEnoughHashesError, IndexError), e:
+            self.log("share hash chain for sh%d was bad: %s" % (shnum, e),
+                     level=log.UNUSUAL)
+
+    def _locate_shareholders(self):
+        vup = self._vup
+        vcap = self._verifycap
+        upload_id = si_b2a(self._storage_index)[:5]
+        lp = self.log("locating shareholders", level=log.NOISY)
+        upload_status = upload.UploadStatus()
+        upload_status.set_storage_index(self._storage_index)
+        upload_status.set_size(vcap.size)
+        selector = upload.Tahoe2ServerSelector(upload_id, lp, upload_status)
+        started = time.time()
+        d = selector.get_shareholders(self._storage_broker,
+                                      self._secret_holder,
+                                      self._storage_index,
+                                      vup.share_size, vup.block_size,
+                                      vup.num_segments,
+                                      vcap.total_shares, vcap.needed_shares,
+                                      0) # ticket #1212, as above
+        def _done(res):
+            self._times["peer_selection"] = time.time() - started
+            return res
+        d.addCallback(_done)
+        return d
+
+    def _set_shareholders(self, (upload_trackers, already_serverids)):
+        self._count_preexisting_shares = len(already_serverids)
+        self._server_trackers = {} # shnum -> ServerTracker
+        for tracker in upload_trackers:
+            for (shnum, bucket) in tracker.buckets.items():
+                self._landlords[shnum] = bucket
+                self._server_trackers[shnum] = tracker
+        # Every missing share is encoded, even one that no server would
+        # take, because its block hash tree root may be needed for the share
+        # hash chains of the others.
+        self._shnums = sorted(set(self._landlords) |
+                              set(self._missing_shares))
+        self._block_hashes = dict([(shnum, []) for shnum in self._shnums])
+        self._crypttext_hashes = []
+        self.log("regenerating shares %s, pushing %s"
+                 % (self._shnums, sorted(self._landlords)),
+                 level=log.OPERATIONAL)
+        dl = []
+        for shnum in list(self._landlords):
+            d = self._landlords[shnum].put_header()
+            d.addErrback(self._remove_shareholder, shnum, "put_header")
+            dl.append(d)
+        return deferredutil.gatherResults(dl)
+
+    def _push_shares(self, ign):
+        if not self._landlords:
+            self.log("no shares need to be pushed", level=log.OPERATIONAL)
+            return
+        d = self._encode_segments()
+        d.addCallback(lambda ign: self._finish_shares())
+        return d
+
+    def _remove_shareholder(self, f, shnum, where):
+        self.log(format="error while sending %(method)s to shareholder=%(shnum)d",
+                 method=where, shnum=shnum, failure=f, level=log.UNUSUAL)
+        if shnum in self._landlords:
+            self._landlords.pop(shnum).abort()
+
+    def _fetch_segment(self, segnum):
+        self._monitor.raise_if_cancelled()
+        (d, c) = self._filenode.get_segment(segnum)
+        self._pending_fetch = c
+        def _got((offset, data, decodetime)):
+            self._pending_fetch = None
+            assert offset == segnum * self._vup.segment_size, (offset, segnum)
+            self._ciphertext_fetched += len(data)
+            return data
+        d.addCallback(_got)
+        return d
+
+    def _encode_segments(self):
+        vup = self._vup
+        k = self._verifycap.needed_shares
+        N = self._verifycap.total_shares
+        self._codec = codec.CRSEncoder()
+        self._codec.set_params(vup.segment_size, k, N)
+        self._tail_codec = codec.CRSEncoder()
+        self._tail_codec.set_params(vup.tail_segment_size, k, N)
+        d = self._fetch_segment(0)
+        for segnum in range(vup.num_segments):
+            d.addCallback(self._encode_and_send_segment, segnum)
+        return d
+
+    def _encode_and_send_segment(self, data, segnum):
+        # Start downloading the next segment while this one is being
+        # encoded and pushed, so we hold at most two segments at a time.
+        if segnum + 1 < self._vup.num_segments:
+            next_d = self._fetch_segment(segnum + 1)
+        else:
+            next_d = defer.succeed(None)
+        start = time.time()
+        self._crypttext_hashes.append(crypttext_segment_hash(data))
+        if segnum == self._vup.num_segments - 1:
+            codec = self._tail_codec
+        else:
+            codec = self._codec
+        piece_size = codec.get_block_size()
+        k = self._verifycap.needed_shares
+        data += "\x00" * (piece_size * k - len(data))
+        pieces = [data[i:i+piece_size]
+                  for i in range(0, len(data), piece_size)]
+        del data
+        d = codec.encode(pieces, self._shnums)
+        def _encoded((blocks, shnums)):
+            self._times["cumulative_encoding"] += time.time() - start
+            return self._send_blocks(blocks, shnums, segnum)
+        d.addCallback(_encoded)
+        def _failed(f):
+            # stop the download of the next segment, nobody wants it now
+            if self._pending_fetch:
+                self._pending_fetch.cancel()
+                self._pending_fetch = None
+            return f
+        d.addCallbacks(lambda ign: next_d, _failed)
         return d
 
+    def _send_blocks(self, blocks, shnums, segnum):
+        start = time.time()
+        dl = []
+        for (shnum, block) in zip(shnums, blocks):
+            self._block_hashes[shnum].append(block_hash(block))
+            if shnum in self._landlords:
+                d = self._landlords[shnum].put_block(segnum, block)
+                d.addErrback(self._remove_shareholder, shnum,
+                             "segnum=%d" % segnum)
+                dl.append(d)
+        d = deferredutil.gatherResults(dl)
+        def _sent(res):
+            self._times["cumulative_sending"] += time.time() - start
+            self.log("pushed segment %d of %d" % (segnum+1,
+                                                   self._vup.num_segments),
+                     level=log.NOISY)
+            return res
+        d.addCallback(_sent)
+        return d
+
+    def _finish_shares(self):
+        start = time.time()
+        vup = self._vup
+        t = HashTree(self._crypttext_hashes)
+        if t[0] != vup.crypttext_root_hash:
+            raise RegenerationError("crypttext root hash mismatch")
+        crypttext_hashes = list(t)
+
+        block_hash_trees = {}
+        leaves = {}
+        for shnum in self._shnums:
+            block_hash_trees[shnum] = bht = HashTree(self._block_hashes[shnum])
+            leaves[shnum] = bht[0]
+        sht = self._share_hash_tree
+        try:
+            sht.set_hashes(leaves=leaves)
+        except (BadHashError, NotEnoughHashesError), e:
+            raise RegenerationError("new shares do not match the share hash "
+                                    "tree: %s" % (e,))
+
+        dl = []
+        for shnum in list(self._landlords):
+            bucket = self._landlords[shnum]
+            leafnum = sht.first_leaf_num + shnum
+            # (the same set, in the same order, as HashTree.needed_hashes)
+            needed = set(sht.needed_for(leafnum))
+            needed.add(leafnum)
+            share_hashes = [(hi, sht[hi]) for hi in needed]
+            if None in [h for (hi, h) in share_hashes]:
+                raise RegenerationError("incomplete share hash chain for "
+                                        "sh%d" % shnum)
+            d = bucket.put_crypttext_hashes(crypttext_hashes)
+            d.addCallback(lambda ign, bucket=bucket, shnum=shnum:
+                          bucket.put_block_hashes(list(block_hash_trees[shnum])))
+            d.addCallback(lambda ign, bucket=bucket, share_hashes=share_hashes:
+                          bucket.put_share_hashes(share_hashes))
+            d.addCallback(lambda ign, bucket=bucket:
+                          bucket.put_uri_extension(self._uri_extension))
+            d.addCallback(lambda ign, bucket=bucket: bucket.close())
+            d.addErrback(self._remove_shareholder, shnum, "finish")
+            dl.append(d)
+        d = deferredutil.gatherResults(dl)
+        def _done(res):
+            self._times["hashes_and_close"] = time.time() - start
+            return res
+        d.addCallback(_done)
+        return d
+
+    def _build_results(self):
+        sharemap = dictutil.DictOfSets()
+        servermap = dictutil.DictOfSets()
+        for shnum in self._landlords:
+            server = self._server_trackers[shnum].get_server()
+            sharemap.add(shnum, server)
+            servermap.add(server, shnum)
+        timings = self._times.copy()
+        timings["total"] = time.time() - self._started
+        ueb_data = uri.unpack_extension(self._uri_extension)
+        self.log("repair done: pushed %s" % (sorted(self._landlords),),
+                 level=log.OPERATIONAL)
+        vcap = self._verifycap
+        return upload.UploadResults(file_size=vcap.size,
+                                    ciphertext_fetched=self._ciphertext_fetched,
+                                    preexisting_shares=self._count_preexisting_shares,
+                                    pushed_shares=len(self._landlords),
+                                    sharemap=sharemap,
+                                    servermap=servermap,
+                                    timings=timings,
+                                    uri_extension_data=ueb_data,
+                                    uri_extension_hash=vcap.uri_extension_hash,
+                                    verifycapstr=vcap.to_string())
+
+    def _abort(self, f):
+        # tell the servers to delete any partial shares, so that someone
+        # else (or the fallback re-encoding) can upload them again
+        for shnum in list(self._landlords):
+            self._landlords.pop(shnum).abort()
+        if self._pending_fetch:
+            self._pending_fetch.cancel()
+            self._pending_fetch = None
+        return f
+
 
     # methods to satisfy the IEncryptedUploader interface
     # (From the perspective of an uploader I am an IEncryptedUploadable.)
@@ -153,6 +153,7 @@ class ServerTracker:
 
     def query(self, sharenums):
         rref = self._server.get_rref()
+        started = time.time()
         d = rref.callRemote("allocate_buckets",
                             self.storage_index,
                             self.renew_secret,
@@ -160,12 +161,16 @@ class ServerTracker:
                             sharenums,
                             self.allocated_size,
                             canary=Referenceable())
+        d.addCallback(self._record_rtt, started)
         d.addCallback(self._got_reply)
         return d
 
+    def _record_rtt(self, res, started):
+        self._server.get_performance().record_rtt(time.time() - started)
+        return res
+
     def ask_about_existing_shares(self):
-        rref = self._server.get_rref()
-        return rref.callRemote("get_buckets", self.storage_index)
+        return self._server.get_buckets(self.storage_index)
 
     def _got_reply(self, (alreadygot, buckets)):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
@@ -455,23 +460,38 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     return self._failed("%s (%s)" % (failmsg, self._get_progress_message()))
 
         if self.first_pass_trackers:
-            tracker = self.first_pass_trackers.pop(0)
+            # Ask one server for each homeless share, all at the same time,
+            # rather than waiting for each answer before asking the next
+            # server. In the common case (servers with space and no existing
+            # shares) this places every share in a single round trip. The
+            # answers are handled in permuted order once they have all
+            # arrived, so the resulting placement is the same as if we had
+            # asked one server at a time, except that a share may now be
+            # allocated on a server before we learn that another server
+            # already holds it: _abort_superfluous_buckets cleans that up.
+            num_trackers = min(len(self.homeless_shares),
+                               len(self.first_pass_trackers))
+            trackers = self.first_pass_trackers[:num_trackers]
+            del self.first_pass_trackers[:num_trackers]
             # TODO: don't pre-convert all serverids to ServerTrackers
-            assert isinstance(tracker, ServerTracker)
-
-            shares_to_ask = set(sorted(self.homeless_shares)[:1])
-            self.homeless_shares -= shares_to_ask
-            self.query_count += 1
-            self.num_servers_contacted += 1
+            queries = []
+            for (tracker, shnum) in zip(trackers, sorted(self.homeless_shares)):
+                assert isinstance(tracker, ServerTracker)
+                shares_to_ask = set([shnum])
+                self.homeless_shares -= shares_to_ask
+                self.query_count += 1
+                self.num_servers_contacted += 1
+                queries.append((tracker, shares_to_ask))
             if self._status:
                 self._status.set_status("Contacting Servers [%s] (first query),"
                                         " %d shares left.."
-                                        % (tracker.get_name(),
+                                        % (", ".join([t.get_name() for t in trackers]),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
-            d.addBoth(self._got_response, tracker, shares_to_ask,
-                      self.second_pass_trackers)
-            return d
+            dl = defer.DeferredList([t.query(shnums)
+                                     for (t, shnums) in queries],
+                                    consumeErrors=True)
+            dl.addCallback(self._got_first_pass_responses, queries)
+            return dl
         elif self.second_pass_trackers:
             # ask a server that we've already asked.
             if not self._started_second_pass:
@@ -523,7 +543,46 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.log(msg, level=log.OPERATIONAL)
                 return (self.use_trackers, self.preexisting_shares)
 
+    def _got_first_pass_responses(self, results, queries):
+        for ((success, res), (tracker, shares_to_ask)) in zip(results, queries):
+            self._handle_response(res, tracker, shares_to_ask,
+                                  self.second_pass_trackers)
+        self._abort_superfluous_buckets()
+        return self._loop()
+
+    def _abort_superfluous_buckets(self):
+        """
+        I abort any bucket we allocated for a share that some other server
+        turned out to hold already, as long as doing so does not reduce the
+        happiness of the placement. The tracker is then free to take a
+        homeless share in the second pass.
+        """
+        merged = merge_servers(self.preexisting_shares, self.use_trackers)
+        happiness = servers_of_happiness(merged)
+        # visit the servers in a fixed order, so that the same shares are
+        # kept for the same grid
+        for tracker in sorted(self.use_trackers,
+                              key=lambda t: t.get_serverid()):
+            for shnum in sorted(tracker.buckets):
+                if shnum not in self.preexisting_shares:
+                    continue
+                bucket = tracker.buckets.pop(shnum)
+                merged = merge_servers(self.preexisting_shares, self.use_trackers)
+                if servers_of_happiness(merged) < happiness:
+                    tracker.buckets[shnum] = bucket
+                    continue
+                self.log("aborting superfluous share %d on server %s"
+                         % (shnum, tracker.get_name()), level=log.NOISY)
+                bucket.abort()
+            if not tracker.buckets:
+                self.use_trackers.discard(tracker)
+
     def _got_response(self, res, tracker, shares_to_ask, put_tracker_here):
+        self._handle_response(res, tracker, shares_to_ask, put_tracker_here)
+        # now loop
+        return self._loop()
+
+    def _handle_response(self, res, tracker, shares_to_ask, put_tracker_here):
         if isinstance(res, failure.Failure):
             # This is unusual, and probably indicates a bug or a network
             # problem.
@@ -600,9 +659,6 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # willing to accept even more.
                 put_tracker_here.append(tracker)
 
-        # now loop
-        return self._loop()
-
 
     def _failed(self, msg):
         """
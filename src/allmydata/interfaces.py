@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_BULK_STORAGE_INDEXES = 100 # per get_buckets_bulk() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -50,10 +51,28 @@ class RIBucketWriter(RemoteInterface):
         return None
 
 
+ReadVector = ListOf(TupleOf(Offset, ReadSize))
+ReadData = ListOf(ShareData)
+# returns data[offset:offset+length] for each element of TestVector
+
+
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(read_vector=ReadVector):
+        """Read several spans of this share in a single round trip. I return
+        a list with one string for each (offset, length) pair in
+        read_vector, in the same order. As with read(), reads that extend
+        beyond the end of the share data are truncated.
+
+        Servers that implement this method advertise a true value for the
+        'has-immutable-readv' key (under
+        'http://allmydata.org/tahoe/protocols/storage/v1') in their version
+        information.
+        """
+        return ReadData
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -79,9 +98,6 @@ TestAndWriteVectorsForShares = DictOf(int,
                                               DataVector,
                                               ChoiceOf(None, Offset), # new_length
                                               ))
-ReadVector = ListOf(TupleOf(Offset, ReadSize))
-ReadData = ListOf(ShareData)
-# returns data[offset:offset+length] for each element of TestVector
 
 
 class RIStorageServer(RemoteInterface):
@@ -172,6 +188,20 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_bulk(storage_indexes=ListOf(StorageIndex,
+                                                maxLength=MAX_BULK_STORAGE_INDEXES)):
+        """Do get_buckets() for several storage indexes in a single round
+        trip. Returns a dictionary that maps each storage index for which I
+        hold at least one share to the same {shnum: RIBucketReader}
+        dictionary that get_buckets() would return for it. Storage indexes
+        for which I hold no shares are omitted.
+
+        Servers that implement this method set 'has-bulk-get-buckets' in
+        their version dictionary.
+        """
+        return DictOf(StorageIndex, DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BULK_STORAGE_INDEXES)
+
     def slot_readv(storage_index=StorageIndex,
                    shares=ListOf(int), readv=ReadVector):
         """Read a vector from the numbered shares associated with the given
@@ -760,6 +790,22 @@ class IServer(IDisplayableServer):
         once the connection is lost.
         """
 
+    def get_performance():
+        """Return an object that records the round-trip times and throughput
+        observed for requests to this server (see
+        allmydata.storage_client.ServerPerformance). It outlives individual
+        connections, and is shared by every upload and download that uses
+        this server.
+        """
+
+    def get_buckets(storage_index):
+        """Ask this server which shares of the given storage index it holds.
+        Returns a Deferred that fires with the same {shnum: RIBucketReader}
+        dictionary as RIStorageServer.get_buckets(). Concurrent lookups may
+        be coalesced into a single get_buckets_bulk() request, if the server
+        supports it.
+        """
+
 
 class IMutableSlotWriter(Interface):
     """
@@ -1051,6 +1097,17 @@ class IMutableFileVersion(IReadable):
     def get_sequence_number():
         """Return the sequence number of this version."""
 
+    def get_root_hash():
+        """Return the root hash of this version's share hash tree. Together
+        with the sequence number, this identifies the version."""
+
+    def is_current():
+        """Return a Deferred that fires with True if the shares that held
+        this version when it was found still hold it, or False if the file
+        may have been modified since then. This is much cheaper than
+        updating a servermap, but it will not notice a newer version that
+        was only written to other servers."""
+
     def get_servermap():
         """Return the IMutableFileServerMap instance that was used to create
         this object.
@@ -1499,6 +1556,17 @@ class IDirectoryNode(IFilesystemNode):
         'node' is an IFilesystemNode and 'metadata_dict' is a dictionary of
         metadata."""
 
+    def get_best_version():
+        """I return a Deferred that fires with the IReadable version of my
+        backing file that list() would read, or with None if my children
+        are not all held in a single file (as for sharded directories).
+        For a mutable directory this is an IMutableFileVersion, whose
+        is_current() method tells whether it has been replaced."""
+
+    def list_version(version):
+        """Like list(), but read the children from 'version', which must
+        have been returned by my get_best_version() method."""
+
     def has_child(name):
         """I return a Deferred that fires with a boolean, True if there
         exists a child of the given name, False if not. The child name must
@@ -2434,11 +2502,23 @@ class ICheckable(Interface):
 
 
 class IDeepCheckable(Interface):
-    def start_deep_check(verify=False, add_lease=False):
+    def start_deep_check(verify=False, add_lease=False, journal=None,
+                         skip_healthy_within=None, force=False):
         """Check upon the health of me and everything I can reach.
 
         This is a recursive form of check(), useable only on dirnodes.
 
+        If 'journal' is provided (a JournaledOperation, from
+        DeepCheckJournal.start_operation), the progress of the check is
+        recorded in it, and an operation that was interrupted earlier is
+        resumed rather than started again. If skip_healthy_within is also
+        provided, files that the journal says were healthy less than that
+        many seconds ago are not checked again (but are still counted).
+
+        If force=True, results remembered by the nodemaker's check-results
+        cache are discarded instead of being reused, so every object is
+        checked with the storage servers.
+
         I return a Monitor, with results that are an IDeepCheckResults
         object.
 
@@ -2449,12 +2529,15 @@ class IDeepCheckable(Interface):
         failure.
         """
 
-    def start_deep_check_and_repair(verify=False, add_lease=False):
+    def start_deep_check_and_repair(verify=False, add_lease=False,
+                                    journal=None, skip_healthy_within=None,
+                                    force=False):
         """Check upon the health of me and everything I can reach. Repair
         anything that isn't healthy.
 
         This is a recursive form of check_and_repair(), useable only on
-        dirnodes.
+        dirnodes. 'journal', 'skip_healthy_within' and 'force' are as for
+        start_deep_check().
 
         I return a Monitor, with results that are an
         IDeepCheckAndRepairResults object.
@@ -2639,6 +2722,12 @@ class IDeepCheckResults(Interface):
         """Return a dictionary with the same keys as
         IDirectoryNode.deep_stats()."""
 
+    def is_resumed():
+        """Return True if this operation was resumed from a journal after
+        the node restarted. Apart from the objects that were found to be
+        unhealthy (or were repaired) before the restart, the counters, stats
+        and lists then only cover the objects that were checked after it."""
+
 
 class IDeepCheckAndRepairResults(Interface):
     """I contain the results of a deep-check-and-repair operation.
@@ -2830,6 +2919,13 @@ class INodeMaker(Interface):
         (childnode, metadata_dict) tuples), the directory will be populated
         with those children, otherwise it will be empty."""
 
+    def create_new_sharded_directory(initial_children={}, shards=16):
+        """I create a new mutable directory whose children are spread over
+        'shards' separate mutable files, so that changing one child only
+        republishes the file that holds it. I return a Deferred that fires
+        with the IDirectoryNode instance. initial_children= is treated as for
+        create_new_mutable_directory()."""
+
 
 class IClientStatus(Interface):
     def list_all_uploads():
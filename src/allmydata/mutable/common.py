@@ -1,3 +1,4 @@
+from collections import OrderedDict
 
 MODE_CHECK = "MODE_CHECK" # query all peers
 MODE_ANYTHING = "MODE_ANYTHING" # one recoverable version
@@ -57,3 +58,96 @@ class CorruptShareError(BadShareError):
 
 class UnknownVersionError(BadShareError):
     """The share we received was of a version we don't recognize."""
+
+
+def _lru_get(table, key):
+    # 'table' is an OrderedDict, kept in least-recently-used-first order
+    value = table.pop(key, None)
+    if value is not None:
+        table[key] = value
+    return value
+
+def _lru_add(table, key, value, max_entries):
+    table.pop(key, None)
+    table[key] = value
+    while len(table) > max_entries:
+        table.popitem(last=False)
+
+
+class VerificationCache(object):
+    """I remember the outcome of public-key operations on mutable files, so
+    that repeated mapupdates of an unchanged file do not have to parse the
+    same verification key or check the same signature again.
+
+    Both tables are bounded; the least-recently-used entry is evicted once
+    more than 'max_entries' are held. The results are pure functions of
+    their keys, so a single instance is shared by every node in the process.
+    """
+    def __init__(self, max_entries=1000):
+        self._max_entries = max_entries
+        self._verifiers = OrderedDict() # fingerprint -> verifier
+        self._verified = OrderedDict() # (si, fingerprint, verinfo, sig) -> True
+
+    def get_verifier(self, fingerprint, pubkey_s, deserialize):
+        """Return the parsed verification key for 'pubkey_s', calling
+        deserialize(pubkey_s) if it is not already cached. The caller must
+        already have checked that 'pubkey_s' hashes to 'fingerprint'."""
+        verifier = _lru_get(self._verifiers, fingerprint)
+        if verifier is None:
+            verifier = deserialize(pubkey_s)
+            _lru_add(self._verifiers, fingerprint, verifier,
+                     self._max_entries)
+        return verifier
+
+    def is_verified(self, storage_index, fingerprint, verinfo, signature):
+        """Return True if 'signature' has already been found to be a valid
+        signature of the given version of this file."""
+        key = (storage_index, fingerprint, verinfo, signature)
+        return _lru_get(self._verified, key) is not None
+
+    def add_verified(self, storage_index, fingerprint, verinfo, signature):
+        key = (storage_index, fingerprint, verinfo, signature)
+        _lru_add(self._verified, key, True, self._max_entries)
+
+    def clear(self):
+        self._verifiers.clear()
+        self._verified.clear()
+
+verification_cache = VerificationCache()
+
+
+class ShareSizeHints(object):
+    """I remember how large the shares of recently-seen mutable files were,
+    so that the next mapupdate of the same file can read the whole share in
+    its first query. Retrieve can then decode a small file or directory
+    from the data the servermap already holds, without another round trip.
+
+    Hints are only given for shares of up to 'max_read_size' bytes, and are
+    padded a little to leave room for a directory that has grown by a few
+    entries since it was last read.
+    """
+    def __init__(self, max_entries=1000, max_read_size=64*1024):
+        self._max_entries = max_entries
+        self._max_read_size = max_read_size
+        self._sizes = OrderedDict() # storage index -> share size
+
+    def get_read_size(self, storage_index, default):
+        """Return the number of bytes that the first query for a share of
+        'storage_index' should read: 'default', or more if we expect that
+        to be enough for the whole share."""
+        size = _lru_get(self._sizes, storage_index)
+        if size is None:
+            return default
+        padded = size + max(1000, size // 10)
+        return max(default, min(padded, self._max_read_size))
+
+    def observe(self, storage_index, share_size):
+        if share_size > self._max_read_size:
+            self._sizes.pop(storage_index, None)
+            return
+        _lru_add(self._sizes, storage_index, share_size, self._max_entries)
+
+    def clear(self):
+        self._sizes.clear()
+
+share_size_hints = ShareSizeHints()
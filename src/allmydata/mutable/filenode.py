@@ -1,9 +1,10 @@
 
-import random
+import random, time
 
 from zope.interface import implements
 from twisted.internet import defer, reactor
-from foolscap.api import eventually
+from twisted.python import failure
+from foolscap.api import eventually, fireEventually
 from allmydata.interfaces import IMutableFileNode, ICheckable, ICheckResults, \
      NotEnoughSharesError, MDMF_VERSION, SDMF_VERSION, IMutableUploadable, \
      IMutableFileVersion, IWriteable
@@ -18,7 +19,8 @@ from allmydata.mutable.publish import Publish, MutableData,\
                                       TransformingUploadable
 from allmydata.mutable.common import MODE_READ, MODE_WRITE, MODE_CHECK, UnrecoverableFileError, \
      UncoordinatedWriteError
-from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.mutable.servermap import ServerMap, ServermapUpdater, \
+     ServermapRevalidator
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.checker import MutableChecker, MutableCheckAndRepairer
 from allmydata.mutable.repairer import Repairer
@@ -79,11 +81,35 @@ class MutableFileNode:
         # forever without consuming more and more memory.
         self._serializer = defer.succeed(None)
 
+        # modify() calls that are waiting for the serializer, and will be
+        # applied together by one publish: [(modifier, Deferred)]. This
+        # batch is closed (set to None) as soon as any other operation is
+        # queued behind it, or it starts being applied, so that later
+        # modify() calls cannot overtake them.
+        self._pending_modifiers = None
+
         # Starting with MDMF, we can get these from caps if they're
         # there. Leave them alone for now; they'll be filled in by my
         # init_from_cap method if necessary.
         self._downloader_hints = {}
 
+        # reads may reuse a recent MODE_READ servermap, if our nodemaker
+        # asks for that with set_servermap_freshness(). The generation
+        # counter lets us refuse to remember a servermap that was fetched
+        # while we were publishing.
+        self._servermap_ttl = 0
+        self._servermap_revalidate = False
+        self._recent_servermap = None
+        self._servermap_generation = 0
+
+        # (verinfo, blockhashes, tail segment) of the last MDMF version that
+        # we published, so that we can append to it cheaply.
+        self._update_data = None
+
+        # shared with the other nodes from our nodemaker, if it has one. Our
+        # entry is discarded whenever we publish.
+        self._check_results_cache = None
+
     def __repr__(self):
         if hasattr(self, '_uri'):
             return "<%s %x %s %s>" % (self.__class__.__name__, id(self), self.is_readonly() and 'RO' or 'RW', self._uri.abbrev())
@@ -291,14 +317,35 @@ class MutableFileNode:
     # ICheckable
 
     def check(self, monitor, verify=False, add_lease=False):
+        cache = self._check_results_cache
+        if cache and not add_lease:
+            cr = cache.get(self.get_storage_index(), verify)
+            if cr:
+                return defer.succeed(cr)
         checker = MutableChecker(self, self._storage_broker,
                                  self._history, monitor)
-        return checker.check(verify, add_lease)
+        d = checker.check(verify, add_lease)
+        if cache:
+            d.addCallback(cache.add, verify)
+        return d
 
     def check_and_repair(self, monitor, verify=False, add_lease=False):
+        cache = self._check_results_cache
+        if cache and not add_lease:
+            crr = cache.get_check_and_repair(self.get_storage_index(), verify)
+            if crr:
+                return defer.succeed(crr)
         checker = MutableCheckAndRepairer(self, self._storage_broker,
                                           self._history, monitor)
-        return checker.check(verify, add_lease)
+        d = checker.check(verify, add_lease)
+        if cache:
+            d.addCallback(self._remember_check_and_repair, verify)
+        return d
+
+    def _remember_check_and_repair(self, crr, verify):
+        if not crr.get_repair_attempted():
+            self._check_results_cache.add(crr.get_pre_repair_results(), verify)
+        return crr
 
     #################################
     # IRepairable
@@ -388,6 +435,8 @@ class MutableFileNode:
         # XXX: wording ^^^^
         if servermap and servermap.get_last_update()[0] == mode:
             d = defer.succeed(servermap)
+        elif mode == MODE_READ and not servermap:
+            d = self._get_read_servermap()
         else:
             d = self._get_servermap(mode)
 
@@ -428,6 +477,7 @@ class MutableFileNode:
         # with a servermap that was last updated in MODE_WRITE, as we
         # want. If this fails, then we give up.
         def _maybe_retry(failure):
+            self._forget_recent_servermap()
             failure.trap(NotEnoughSharesError)
 
             d = self.get_best_mutable_version()
@@ -566,9 +616,25 @@ class MutableFileNode:
         modify on the result of get_best_mutable_version. I return a
         Deferred that eventually fires with an UploadResults instance
         describing this process.
+
+        Modifiers without a backoffer of their own are not applied one at
+        a time: all of those that are waiting for the same turn, with no
+        other operation on this node queued between them, are run one
+        after another against the same version, and their combined result
+        is published once. A modifier that raises an exception is
+        left out of that publish, and only its own Deferred errbacks.
         """
         # TODO: Update downloader hints.
-        return self._do_serialized(self._modify, modifier, backoffer)
+        if backoffer is not None:
+            return self._do_serialized(self._modify, modifier, backoffer)
+        d = defer.Deferred()
+        pending = self._pending_modifiers
+        if pending is None:
+            pending = []
+            self._do_serialized(self._modify_pending, pending)
+            self._pending_modifiers = pending
+        pending.append((modifier, d))
+        return d
 
 
     def _modify(self, modifier, backoffer):
@@ -580,6 +646,58 @@ class MutableFileNode:
         return d
 
 
+    def _modify_pending(self, pending):
+        """
+        I am the serialized sibling of modify for modifiers that use the
+        default backoffer. I wait for one turn of the reactor, so that a
+        burst of modify() calls can join the ones that queued up behind
+        earlier operations, and then apply all of them with a single
+        modify.
+        """
+        d = fireEventually()
+        d.addCallback(lambda ignored: self._apply_pending_modifiers(pending))
+        return d
+
+
+    def _apply_pending_modifiers(self, pending):
+        if self._pending_modifiers is pending:
+            self._pending_modifiers = None
+        failures = {} # index into pending -> Failure
+        def _combined_modifier(old_contents, servermap, first_time):
+            contents = old_contents
+            for (i, (modifier, ignored)) in enumerate(pending):
+                if i in failures:
+                    # it failed during an earlier attempt
+                    continue
+                try:
+                    new_contents = modifier(contents, servermap, first_time)
+                    precondition((isinstance(new_contents, str) or
+                                  new_contents is None),
+                                 "Modifier function must return a string "
+                                 "or None")
+                except UncoordinatedWriteError:
+                    # modifiers may raise this to ask for a retry, which
+                    # applies to the whole batch
+                    raise
+                except Exception:
+                    failures[i] = failure.Failure()
+                    continue
+                if new_contents is not None:
+                    contents = new_contents
+            return contents
+        d = self._modify(_combined_modifier, None)
+        def _done(res):
+            for (i, (ignored, d2)) in enumerate(pending):
+                if i in failures:
+                    eventually(d2.errback, failures[i])
+                elif isinstance(res, failure.Failure):
+                    eventually(d2.errback, res)
+                else:
+                    eventually(d2.callback, res)
+        d.addBoth(_done)
+        return d
+
+
     def download_version(self, servermap, version, fetch_privkey=False):
         """
         Download the specified version of this mutable file. I return a
@@ -627,6 +745,93 @@ class MutableFileNode:
         return servermap
 
 
+    def set_servermap_freshness(self, ttl, revalidate=False):
+        """
+        I allow reads to reuse a MODE_READ servermap for up to ttl
+        seconds after it was updated, instead of updating a new one each
+        time. If revalidate is True, an older servermap is first checked
+        with ServermapRevalidator, which only reads the signed prefix of
+        each of its shares, before falling back to a full update. A ttl
+        of 0 (the default) disables both.
+
+        Writes made through this node always discard the reused
+        servermap, but writes made by other clients will not be noticed
+        until it expires.
+        """
+        self._servermap_ttl = ttl
+        self._servermap_revalidate = revalidate
+        self._forget_recent_servermap()
+
+
+    def set_check_results_cache(self, cache):
+        """
+        I make check() and check_and_repair() reuse recent healthy
+        results from 'cache' (a CheckResultsCache), and record new ones
+        in it.
+        """
+        self._check_results_cache = cache
+
+
+    def _remember_update_data(self, res, publish):
+        update_data = publish.get_update_data()
+        if update_data:
+            self._update_data = update_data
+        return res
+
+    def _get_update_data(self, verinfo):
+        """
+        If verinfo is the version that I published most recently, I
+        return the (verinfo, blockhashes, tail segment) that its Publish
+        left behind. Otherwise I return None.
+        """
+        if self._update_data and self._update_data[0][:8] == verinfo[:8]:
+            return self._update_data
+        return None
+
+
+    def _forget_recent_servermap(self, res=None):
+        self._recent_servermap = None
+        self._servermap_generation += 1
+        # this is called around every publish, which also makes any
+        # remembered check results out of date
+        if self._check_results_cache:
+            self._check_results_cache.discard(self.get_storage_index())
+        return res
+
+
+    def _get_read_servermap(self):
+        """
+        I return a Deferred that fires with a MODE_READ servermap, which
+        might be a copy of a recent one if my freshness policy allows it.
+        """
+        recent = self._recent_servermap
+        if not self._servermap_ttl:
+            return self._get_servermap(MODE_READ)
+        if recent is None:
+            d = defer.succeed(False)
+        elif time.time() - recent.get_last_update()[1] < self._servermap_ttl:
+            d = defer.succeed(True)
+        elif self._servermap_revalidate:
+            r = ServermapRevalidator(self, self._storage_broker, recent)
+            d = r.revalidate()
+        else:
+            d = defer.succeed(False)
+        def _maybe_update(fresh):
+            if fresh and recent is self._recent_servermap:
+                return recent.copy()
+            generation = self._servermap_generation
+            d2 = self._get_servermap(MODE_READ)
+            def _remember(servermap):
+                if (generation == self._servermap_generation
+                    and servermap.best_recoverable_version()):
+                    self._recent_servermap = servermap.copy()
+                return servermap
+            d2.addCallback(_remember)
+            return d2
+        d.addCallback(_maybe_update)
+        return d
+
+
     def _update_servermap(self, servermap, mode):
         u = ServermapUpdater(self, self._storage_broker, Monitor(), servermap,
                              mode)
@@ -654,6 +859,9 @@ class MutableFileNode:
         # MutableFileNode. The callable should be a bound method of this same
         # MFN instance.
         d = defer.Deferred()
+        # anything queued from now on must wait until after this operation,
+        # so close the batch of modify() calls that it follows
+        self._pending_modifiers = None
         self._serializer.addCallback(lambda ignore: cb(*args, **kwargs))
         # we need to put off d.callback until this Deferred is finished being
         # processed. Otherwise the caller's subsequent activities (like,
@@ -678,11 +886,14 @@ class MutableFileNode:
 
         # Define IPublishInvoker with a set_downloader_hints method?
         # Then have the publisher call that method when it's done publishing?
+        self._forget_recent_servermap()
         p = Publish(self, self._storage_broker, servermap)
         if self._history:
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._forget_recent_servermap)
+        d.addCallback(self._remember_update_data, p)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -742,6 +953,26 @@ class MutableFileVersion:
         """
         return self._version[0] # verinfo[0] == the sequence number
 
+    def get_root_hash(self):
+        """
+        Get the root hash of the share hash tree of the mutable version
+        that I represent.
+        """
+        return self._version[1] # verinfo[1] == the root hash
+
+    def is_current(self):
+        """
+        I return a Deferred that fires with True if the shares in which
+        my servermap found my version still hold it, or False if the
+        file may have been modified since. This only reads the signed
+        prefix of each of those shares (see ServermapRevalidator).
+        """
+        if self._servermap.best_recoverable_version() != self._version:
+            return defer.succeed(False)
+        r = ServermapRevalidator(self._node, self._storage_broker,
+                                 self._servermap)
+        return r.revalidate()
+
     def get_servermap(self):
         return self._servermap
 
@@ -1003,11 +1234,14 @@ class MutableFileVersion:
 
     def _upload(self, new_contents):
         #assert self._pubkey, "update_servermap must be called before publish"
+        self._node._forget_recent_servermap()
         p = Publish(self._node, self._storage_broker, self._servermap)
         if self._history:
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._node._forget_recent_servermap)
+        d.addCallback(self._node._remember_update_data, p)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -1057,12 +1291,46 @@ class MutableFileVersion:
 
         # Otherwise, we can replace just the parts that are changing.
         log.msg("updating in place")
+        if offset == old_size and self._node._get_update_data(self._version):
+            return self._do_cached_append(data, offset)
+        return self._do_in_place_update(data, offset)
+
+
+    def _do_in_place_update(self, data, offset):
         d = self._do_update_update(data, offset)
         d.addCallback(self._decode_and_decrypt_segments, data, offset)
         d.addCallback(self._build_uploadable_and_finish, data, offset)
         return d
 
 
+    def _do_cached_append(self, data, offset):
+        """
+        I append data to a version that our node published itself. The
+        node kept the block hash trees and the plaintext tail segment of
+        that version, so I can skip the servermap update that fetches
+        them (along with the boundary blocks) from every share, and the
+        decoding of those blocks. If the servermap shows that the grid
+        has moved on since then, I do a regular in-place update instead.
+        """
+        (verinfo, blockhashes, tail) = self._node._get_update_data(self._version)
+        d = self._update_servermap()
+        def _updated(ign):
+            sm = self._servermap
+            if sm.best_recoverable_version() != self._version:
+                log.msg("grid has changed, doing a regular in-place update")
+                return self._do_in_place_update(data, offset)
+            # only update the shares that the servermap found, just like
+            # _decode_and_decrypt_segments does
+            shnums = set([shnum for (shnum, server, timestamp)
+                          in sm.make_versionmap()[self._version]])
+            bht = dict([(shnum, blockhashes[shnum]) for shnum in shnums
+                        if shnum in blockhashes])
+            return self._build_uploadable_and_finish([tail, tail, bht],
+                                                     data, offset)
+        d.addCallback(_updated)
+        return d
+
+
     def _do_modify_update(self, data, offset):
         """
         I perform a file update by modifying the contents of the file
@@ -1171,8 +1439,12 @@ class MutableFileVersion:
                                    self._version[3],
                                    segments_and_bht[0],
                                    segments_and_bht[1])
+        self._node._forget_recent_servermap()
         p = Publish(self._node, self._storage_broker, self._servermap)
-        return p.update(u, offset, segments_and_bht[2], self._version)
+        d = p.update(u, offset, segments_and_bht[2], self._version)
+        d.addBoth(self._node._forget_recent_servermap)
+        d.addCallback(self._node._remember_update_data, p)
+        return d
 
 
     def _update_servermap(self, mode=MODE_WRITE, update_range=None):
@@ -1145,7 +1145,33 @@ class MDMFSlotWriteProxy:
                              self._segment_size,
                              self._data_length)
         self._writevs.append(tuple([encoding_parameters_offset, params]))
-        return self._write(self._writevs)
+        return self._write(self._coalesce_writevs(self._writevs))
+
+
+    def _coalesce_writevs(self, writevs):
+        """
+        I merge each write vector that starts where the one queued before
+        it ends into that one. put_block queues one vector per segment,
+        and the blocks of a share are contiguous, so the server gets the
+        share data as a single vector instead of one per segment. The
+        vectors are not reordered, so the result on the server is the
+        same.
+        """
+        coalesced = []
+        pieces = []
+        start = end = None
+        for (offset, data) in writevs:
+            if pieces and offset == end:
+                pieces.append(data)
+            else:
+                if pieces:
+                    coalesced.append((start, "".join(pieces)))
+                pieces = [data]
+                start = end = offset
+            end += len(data)
+        if pieces:
+            coalesced.append((start, "".join(pieces)))
+        return coalesced
 
 
     def _write(self, datavs, on_failure=None, on_success=None):
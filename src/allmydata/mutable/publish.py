@@ -129,11 +129,29 @@ class Publish:
         self._status.set_active(True)
         self._version = self._node.get_version()
         assert self._version in (SDMF_VERSION, MDMF_VERSION)
+        self._tail_segment = None # plaintext, see get_update_data
 
 
     def get_status(self):
         return self._status
 
+
+    def get_update_data(self):
+        """
+        After a successful MDMF publish, I return (verinfo, blockhashes,
+        tail), where blockhashes maps shnum to the block hash tree that I
+        wrote for that share and tail is the plaintext of the last
+        segment. These are what an in-place append to the new version
+        would otherwise have to fetch from the grid and decode. I return
+        None for SDMF files, and for updates that did not reach the end
+        of the file.
+        """
+        if self._version != MDMF_VERSION or not self.versioninfo:
+            return None
+        if self.num_segments and self._tail_segment is None:
+            return None
+        return (self.versioninfo, self.blockhashes, self._tail_segment or "")
+
     def log(self, *args, **kwargs):
         if 'parent' not in kwargs:
             kwargs['parent'] = self._log_number
@@ -165,8 +183,9 @@ class Publish:
 
         self.data = data
 
-        # XXX: Use the MutableFileVersion instead.
-        self.datalength = self._node.get_size()
+        # Use the size of the version that we are updating: our node may
+        # not have heard about changes that other clients made.
+        self.datalength = version[4] # verinfo[4] == size
         if data.get_size() > self.datalength:
             self.datalength = data.get_size()
 
@@ -708,6 +727,8 @@ class Publish:
         data = "".join(data)
 
         assert len(data) == segsize, len(data)
+        if segnum + 1 == self.num_segments and self._version == MDMF_VERSION:
+            self._tail_segment = data
 
         salt = os.urandom(16)
 
@@ -100,6 +100,13 @@ class Retrieve:
     # will use a single ServerMap instance.
     implements(IPushProducer)
 
+    # While one segment is being validated and decoded, we keep block
+    # requests outstanding for the following segments, so that a
+    # multi-segment MDMF download is not limited to one round trip per
+    # segment. This is the number of segments (including the current one)
+    # that we will have requested at any one time.
+    PIPELINE_DEPTH = 4
+
     def __init__(self, filenode, storage_broker, servermap, verinfo,
                  fetch_privkey=False, verify=False):
         self._node = filenode
@@ -153,6 +160,7 @@ class Retrieve:
         self._status.set_size(datalength)
         self._status.set_encoding(k, N)
         self.readers = {}
+        self._prefetched = {} # (segnum, shnum) -> Deferred, see _request_block
         self._stopped = False
         self._pause_deferred = None
         self._offset = None
@@ -569,10 +577,13 @@ class Retrieve:
         self._status.add_problem(server, f)
         self._last_failure = f
 
-        # Remove the reader from _active_readers
+        # Remove the reader from _active_readers, and forget anything we
+        # asked it for in advance
         self._active_readers.remove(reader)
         for shnum in list(self.remaining_sharemap.keys()):
             self.remaining_sharemap.discard(shnum, reader.server)
+        for key in [key for key in self._prefetched if key[1] == reader.shnum]:
+            del self._prefetched[key]
 
         if f.check(BadShareError):
             self.notify_server_corruption(server, shnum, str(f.value))
@@ -614,16 +625,14 @@ class Retrieve:
         # successful, we will assemble the results into plaintext.
         ds = []
         for reader in self._active_readers:
-            started = time.time()
-            d1 = reader.get_block_and_salt(segnum)
-            d2,d3 = self._get_needed_hashes(reader, segnum)
-            d = deferredutil.gatherResults([d1,d2,d3])
-            d.addCallback(self._validate_block, segnum, reader, reader.server, started)
+            d = self._fetch_block(reader, segnum)
+            d.addCallback(self._validate_block, segnum, reader, reader.server)
             # _handle_bad_share takes care of recoverable errors (by dropping
             # that share and returning None). Any other errors (i.e. code
             # bugs) are passed through and cause the retrieve to fail.
             d.addErrback(self._handle_bad_share, [reader])
             ds.append(d)
+        self._prefetch_segments(segnum)
         dl = deferredutil.gatherResults(ds)
         if self._verify:
             dl.addCallback(lambda ignored: "")
@@ -633,6 +642,59 @@ class Retrieve:
         return dl
 
 
+    def _request_block(self, reader, segnum):
+        """
+        I ask the given reader for the block, salt, and hashes that are
+        needed to validate segnum. I return a Deferred that fires with
+        (True, results) or (False, failure): a prefetched request might
+        never be used, so its failure must not be left unhandled.
+        """
+        started = time.time()
+        d1 = reader.get_block_and_salt(segnum)
+        d2,d3 = self._get_needed_hashes(reader, segnum)
+        d = deferredutil.gatherResults([d1,d2,d3])
+        def _fetched(results):
+            elapsed = time.time() - started
+            self._status.add_fetch_timing(reader.server, elapsed)
+            return results
+        d.addCallback(_fetched)
+        d.addCallbacks(lambda results: (True, results),
+                       lambda f: (False, f))
+        return d
+
+
+    def _fetch_block(self, reader, segnum):
+        """
+        I return a Deferred that fires with the [(block, salt), blockhashes,
+        sharehashes] for segnum from the given reader, using the request
+        that _prefetch_segments made for it if there is one.
+        """
+        d = self._prefetched.pop((segnum, reader.shnum), None)
+        if d is None:
+            d = self._request_block(reader, segnum)
+        # returning the Failure switches to the errback chain
+        d.addCallback(lambda (success, res): res)
+        return d
+
+
+    def _prefetch_segments(self, segnum):
+        """
+        I ask the active readers for the blocks of the segments after
+        segnum, up to PIPELINE_DEPTH segments in all, so that their round
+        trips overlap with the processing of segnum. I do not ask for
+        anything new while our consumer has paused us.
+        """
+        if self._pause_deferred is not None or self._stopped:
+            return
+        last = min(segnum + self.PIPELINE_DEPTH - 1, self._last_segment)
+        for next_segnum in xrange(segnum + 1, last + 1):
+            for reader in self._active_readers:
+                key = (next_segnum, reader.shnum)
+                if key not in self._prefetched:
+                    self._prefetched[key] = self._request_block(reader,
+                                                                next_segnum)
+
+
     def _maybe_decode_and_decrypt_segment(self, results, segnum):
         """
         I take the results of fetching and validating the blocks from
@@ -729,7 +791,7 @@ class Retrieve:
         return None
 
 
-    def _validate_block(self, results, segnum, reader, server, started):
+    def _validate_block(self, results, segnum, reader, server):
         """
         I validate a block from one share on a remote server.
         """
@@ -737,8 +799,6 @@ class Retrieve:
         # validate this block, then generate the block hash root.
         self.log("validating share %d for segment %d" % (reader.shnum,
                                                              segnum))
-        elapsed = time.time() - started
-        self._status.add_fetch_timing(server, elapsed)
         self._set_current_status("validating blocks")
 
         block_and_salt, blockhashes, sharehashes = results
@@ -946,6 +1006,7 @@ class Retrieve:
         Retrieve object through self._done_deferred.
         """
         self._running = False
+        self._prefetched.clear()
         self._status.set_active(False)
         now = time.time()
         self._status.timings['total'] = now - self._started
@@ -996,6 +1057,7 @@ class Retrieve:
     def _error(self, f):
         # all errors, including NotEnoughSharesError, land here
         self._running = False
+        self._prefetched.clear()
         self._status.set_active(False)
         now = time.time()
         self._status.timings['total'] = now - self._started
@@ -13,7 +13,8 @@ from allmydata.interfaces import IServermapUpdaterStatus
 from pycryptopp.publickey import rsa
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
-     MODE_READ, MODE_REPAIR, CorruptShareError
+     MODE_READ, MODE_REPAIR, CorruptShareError, verification_cache, \
+     share_size_hints
 from allmydata.mutable.layout import SIGNED_PREFIX_LENGTH, MDMFSlotReadProxy
 
 class UpdateStatus:
@@ -135,6 +136,8 @@ class ServerMap:
         s._last_update_mode = self._last_update_mode
         s._last_update_time = self._last_update_time
         s.update_data = copy.deepcopy(self.update_data)
+        # the proxies only cache share data, so they can be shared
+        s.proxies = self.proxies.copy()
         return s
 
     def get_reachable_servers(self):
@@ -426,6 +429,12 @@ class ServermapUpdater:
         if mode == MODE_CHECK:
             # we use unpack_prefix_and_signature, so we need 1k
             self._read_size = 1000
+        elif mode == MODE_READ:
+            # If we have seen this file before and its shares were small,
+            # read all of each share now, so that Retrieve can use the data
+            # cached in our proxies instead of making another round trip.
+            self._read_size = share_size_hints.get_read_size(self._storage_index,
+                                                             self._read_size)
         self._need_privkey = False
 
         if mode in (MODE_WRITE, MODE_REPAIR) and not self._node.get_privkey():
@@ -641,6 +650,9 @@ class ServermapUpdater:
         ss = server.get_rref()
         now = time.time()
         elapsed = now - started
+        received = sum([len(data) for datav in datavs.values()
+                        for data in datav])
+        server.get_performance().record_transfer(received, elapsed)
         def _done_processing(ignored=None):
             self._queries_outstanding.discard(server)
             self._servermap.mark_server_reachable(server)
@@ -791,7 +803,9 @@ class ServermapUpdater:
         if fingerprint != self._node.get_fingerprint():
             raise CorruptShareError(server, shnum,
                                     "pubkey doesn't match fingerprint")
-        self._node._populate_pubkey(self._deserialize_pubkey(pubkey_s))
+        self._node._populate_pubkey(
+            verification_cache.get_verifier(fingerprint, pubkey_s,
+                                            self._deserialize_pubkey))
         assert self._node.get_pubkey()
 
 
@@ -832,7 +846,13 @@ class ServermapUpdater:
          offsets_tuple) = verinfo
 
 
-        if verinfo not in self._valid_versions:
+        # Versions checked by an earlier mapupdate (of this or any other
+        # node for the same file) are remembered in verification_cache.
+        fingerprint = self._node.get_fingerprint()
+        if (verinfo not in self._valid_versions and
+            not verification_cache.is_verified(self._storage_index,
+                                               fingerprint, verinfo,
+                                               signature[1])):
             # This is a new version tuple, and we need to validate it
             # against the public key before keeping track of it.
             assert self._node.get_pubkey()
@@ -840,6 +860,9 @@ class ServermapUpdater:
             if not valid:
                 raise CorruptShareError(server, shnum,
                                         "signature is invalid")
+            verification_cache.add_verified(self._storage_index,
+                                            fingerprint, verinfo,
+                                            signature[1])
 
         # ok, it's a valid verinfo. Add it to the list of validated
         # versions.
@@ -849,6 +872,8 @@ class ServermapUpdater:
                     k, n, segsize, datalen),
                     parent=lp)
         self._valid_versions.add(verinfo)
+        share_size_hints.observe(self._storage_index,
+                                 dict(offsets_tuple)["EOF"])
         # We now know that this is a valid candidate verinfo. Whether or
         # not this instance of it is valid is a matter for the next
         # statement; at this point, we just know that if we see this
@@ -1222,3 +1247,85 @@ class ServermapUpdater:
         self._done_deferred.errback(f)
 
 
+
+class ServermapRevalidator:
+    """I check that a previously-updated MODE_READ servermap still
+    describes the grid, by reading just the signed prefix of each known
+    share of its best recoverable version. This costs one small
+    slot_readv per share holder, instead of the share-sized reads and
+    signature checks of a full ServermapUpdater pass.
+
+    My revalidate() method returns a Deferred that fires with True if at
+    least k of those shares still hold the same version (in which case the
+    servermap's last-update time is refreshed), or False if the caller
+    should do a full update instead.
+    """
+
+    def __init__(self, filenode, storage_broker, servermap):
+        self._node = filenode
+        self._storage_broker = storage_broker
+        self._servermap = servermap
+        self._storage_index = filenode.get_storage_index()
+        prefix = si_b2a(self._storage_index)[:5]
+        self._log_number = log.msg(format="ServermapRevalidator(%(si)s): starting",
+                                   si=prefix,
+                                   facility="tahoe.mutable.mapupdate")
+
+    def log(self, *args, **kwargs):
+        if "parent" not in kwargs:
+            kwargs["parent"] = self._log_number
+        if "facility" not in kwargs:
+            kwargs["facility"] = "tahoe.mutable.mapupdate"
+        return log.msg(*args, **kwargs)
+
+    def revalidate(self):
+        started = time.time()
+        verinfo = self._servermap.best_recoverable_version()
+        if verinfo is None:
+            return defer.succeed(False)
+        k = verinfo[5]
+        prefix = verinfo[7]
+
+        shnums_by_server = DictOfSets()
+        for (shnum, server, timestamp) in self._servermap.make_versionmap()[verinfo]:
+            shnums_by_server.add(server, shnum)
+
+        dl = []
+        for (server, shnums) in shnums_by_server.items():
+            d = self._read_prefixes(server, sorted(shnums), len(prefix))
+            dl.append(d)
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _check(results):
+            confirmed = set()
+            for (success, res) in results:
+                if not success:
+                    self.log("prefix read failed", failure=res,
+                             level=log.UNUSUAL)
+                    continue
+                (server, shnums, datavs) = res
+                for shnum in shnums:
+                    if shnum not in datavs:
+                        continue
+                    if datavs[shnum][0] != prefix:
+                        self.log(format="sh%(shnum)d on %(name)s has changed",
+                                 shnum=shnum, name=server.get_name())
+                        return False
+                    confirmed.add(shnum)
+            if len(confirmed) < k:
+                self.log(format="only %(found)d of %(k)d shares confirmed",
+                         found=len(confirmed), k=k)
+                return False
+            self._servermap.set_last_update(MODE_READ, started)
+            self.log("servermap still current")
+            return True
+        d.addCallback(_check)
+        return d
+
+    def _read_prefixes(self, server, shnums, length):
+        rref = server.get_rref()
+        if rref is None:
+            return defer.fail(failure.Failure(DeadReferenceError("not connected")))
+        d = rref.callRemote("slot_readv", self._storage_index, shnums,
+                            [(0, length)])
+        d.addCallback(lambda datavs: (server, shnums, datavs))
+        return d
@@ -263,6 +263,8 @@ class Node(service.MultiService, ConfigMixin):
         if not os.path.exists(tempdir):
             fileutil.make_dirs(tempdir)
         tempfile.tempdir = tempdir
+        fileutil.encrypt_temporary_files = self.get_config("node", "tempdir.encrypt",
+                                                           True, boolean=True)
         # this should cause twisted.web.http (which uses
         # tempfile.TemporaryFile) to put large request bodies in the given
         # directory. Without this, the default temp dir is usually /tmp/,
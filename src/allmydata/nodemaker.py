@@ -1,15 +1,18 @@
 import weakref
 from zope.interface import implements
 from allmydata.util.assertutil import precondition
-from allmydata.interfaces import INodeMaker
+from allmydata.interfaces import INodeMaker, MDMF_VERSION
 from allmydata.immutable.literal import LiteralFileNode
 from allmydata.immutable.filenode import ImmutableFileNode, CiphertextFileNode
 from allmydata.immutable.upload import Data
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.publish import MutableData
-from allmydata.dirnode import DirectoryNode, pack_children
+from allmydata.dirnode import DirectoryNode, ShardedDirectoryNode, \
+     pack_children, normalize, shard_for_name, DEFAULT_DIRECTORY_SHARDS, \
+     MAX_DIRECTORY_SHARDS
 from allmydata.unknown import UnknownNode
 from allmydata.blacklist import ProhibitedNode
+from allmydata.util.deferredutil import gatherResults
 from allmydata import uri
 
 
@@ -19,7 +22,9 @@ class NodeMaker:
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None,
+                 servermap_ttl=0, servermap_revalidate=False,
+                 check_results_cache=None, verify_sample=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -29,24 +34,46 @@ class NodeMaker:
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.servermap_ttl = servermap_ttl
+        self.servermap_revalidate = servermap_revalidate
+        self.check_results_cache = check_results_cache
+        self.verify_sample = verify_sample
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
     def _create_lit(self, cap):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
-        return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+        n = ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
+                              self.terminator, self.history)
+        self._configure_immutable(n)
+        return n
     def _create_immutable_verifier(self, cap):
-        return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+        n = CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
+                               self.terminator, self.history)
+        self._configure_immutable(n)
+        return n
+    def _configure_immutable(self, n):
+        if self.check_results_cache:
+            n.set_check_results_cache(self.check_results_cache)
+        if self.verify_sample:
+            n.set_verify_sample(self.verify_sample)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
                             self.history)
+        self._configure_mutable(n)
         return n.init_from_cap(cap)
+    def _configure_mutable(self, n):
+        if self.servermap_ttl:
+            n.set_servermap_freshness(self.servermap_ttl,
+                                      self.servermap_revalidate)
+        if self.check_results_cache:
+            n.set_check_results_cache(self.check_results_cache)
     def _create_dirnode(self, filenode):
         return DirectoryNode(filenode, self, self.uploader)
+    def _create_sharded_dirnode(self, filenode):
+        return ShardedDirectoryNode(filenode, self, self.uploader)
 
     def create_from_cap(self, writecap, readcap=None, deep_immutable=False, name=u"<unknown name>"):
         # this returns synchronously. It starts with a "cap string".
@@ -112,6 +139,10 @@ class NodeMaker:
                             uri.ReadonlyMDMFDirectoryURI)):
             filenode = self._create_from_single_cap(cap.get_filenode_cap())
             return self._create_dirnode(filenode)
+        if isinstance(cap, (uri.ShardedDirectoryURI,
+                            uri.ReadonlyShardedDirectoryURI)):
+            filenode = self._create_from_single_cap(cap.get_filenode_cap())
+            return self._create_sharded_dirnode(filenode)
         return None
 
     def create_mutable_file(self, contents=None, keysize=None, version=None):
@@ -119,6 +150,7 @@ class NodeMaker:
             version = self.mutable_file_default
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters, self.history)
+        self._configure_mutable(n)
         d = self.key_generator.generate(keysize)
         d.addCallback(n.create_with_keys, contents, version=version)
         d.addCallback(lambda res: n)
@@ -137,6 +169,33 @@ class NodeMaker:
         d.addCallback(self._create_dirnode)
         return d
 
+    def create_new_sharded_directory(self, initial_children={},
+                                     shards=DEFAULT_DIRECTORY_SHARDS,
+                                     version=None):
+        # each shard is an ordinary mutable directory of the given version.
+        # The index that points at them is always MDMF.
+        precondition(0 < shards <= MAX_DIRECTORY_SHARDS, shards)
+        for (name, (node, metadata)) in initial_children.iteritems():
+            precondition(isinstance(metadata, dict),
+                         "create_new_sharded_directory requires metadata to be a dict, not None", metadata)
+            node.raise_error()
+        buckets = [{} for i in range(shards)]
+        for (name, child) in initial_children.iteritems():
+            buckets[shard_for_name(normalize(name), shards)][name] = child
+        d = gatherResults([self.create_new_mutable_directory(children,
+                                                             version=version)
+                           for children in buckets])
+        def _created_shards(shard_nodes):
+            index = dict([(unicode(i), (shard, {}))
+                          for (i, shard) in enumerate(shard_nodes)])
+            return self.create_mutable_file(lambda n:
+                                            MutableData(pack_children(index,
+                                                           n.get_writekey())),
+                                            version=MDMF_VERSION)
+        d.addCallback(_created_shards)
+        d.addCallback(self._create_sharded_dirnode)
+        return d
+
     def create_immutable_directory(self, children, convergence=None):
         if convergence is None:
             convergence = self.secret_holder.get_convergence_secret()
@@ -0,0 +1,115 @@
+
+import time, simplejson
+
+from twisted.application import service
+from twisted.application.internet import TimerService
+
+from allmydata.util import dbutil, log
+
+
+PERFORMANCE_SCHEMA_V1 = """
+CREATE TABLE `version`
+(
+ version INTEGER -- contains one row, set to 1
+);
+
+CREATE TABLE `server_performance`
+(
+ `server_id` VARCHAR PRIMARY KEY, -- IServer.get_longname()
+ `state` VARCHAR not null,        -- JSON, from ServerPerformance.get_state()
+ `last_updated` INTEGER not null  -- seconds since epoch
+);
+"""
+
+
+class PerformanceDB(service.MultiService):
+    """I persist the ServerPerformance statistics of every storage server
+    that a StorageFarmBroker knows about, so that a freshly-started client
+    can prefer fast servers (and notice slow ones) without having to
+    rediscover their speeds one request at a time.
+
+    I write the statistics out every SAVE_INTERVAL seconds and when the
+    node shuts down. History older than MAX_AGE seconds is not restored,
+    since a server's network position may have changed since then.
+    """
+    SAVE_INTERVAL = 5*60
+    MAX_AGE = 7*24*60*60
+
+    def __init__(self, dbfile, storage_broker):
+        service.MultiService.__init__(self)
+        self._dbfile = dbfile
+        self._storage_broker = storage_broker
+        self._db = None
+        self._open_db()
+        t = TimerService(self.SAVE_INTERVAL, self.save)
+        t.setServiceParent(self)
+
+    def _open_db(self):
+        if self._db is None:
+            (self._sqlite,
+             self._db) = dbutil.get_db(self._dbfile,
+                                       create_version=(PERFORMANCE_SCHEMA_V1, 1),
+                                       dbname="performancedb")
+            self._cursor = self._db.cursor()
+
+    def _close_db(self):
+        try:
+            self._cursor.close()
+        finally:
+            self._cursor = None
+        self._db.close()
+        self._db = None
+
+    def startService(self):
+        self._open_db()
+        return service.MultiService.startService(self)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        def _stopped(res):
+            self.save()
+            self._close_db()
+            return res
+        d.addBoth(_stopped)
+        return d
+
+    def restore(self, server_id, performance, now=None):
+        """Load the recorded statistics for 'server_id' into the given
+        ServerPerformance. Returns True if anything was restored."""
+        if self._db is None:
+            return False
+        now = now or time.time()
+        self._cursor.execute("SELECT `state`, `last_updated`"
+                             " FROM `server_performance`"
+                             " WHERE `server_id` = ?",
+                             (server_id,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return False
+        (state_s, last_updated) = row
+        if now - last_updated > self.MAX_AGE:
+            return False
+        try:
+            state = simplejson.loads(state_s)
+        except ValueError:
+            log.msg(format="ignoring unparseable performance history for %(server)s",
+                    server=server_id, level=log.UNUSUAL, umid="Sg5Rrw")
+            return False
+        performance.set_state(state)
+        return True
+
+    def save(self, now=None):
+        """Record the current statistics of every server that has answered
+        at least one request."""
+        if self._db is None:
+            return
+        now = int(now or time.time())
+        for server in self._storage_broker.get_known_servers():
+            state = server.get_performance().get_state()
+            if state["rtt"] is None:
+                continue
+            self._cursor.execute("INSERT OR REPLACE INTO `server_performance`"
+                                 " VALUES (?,?,?)",
+                                 (server.get_longname(),
+                                  simplejson.dumps(state), now))
+        self._db.commit()
@@ -423,6 +423,7 @@ class CheckOptions(FilesystemOptions):
         ("verify", None, "Verify all hashes, instead of merely querying share presence."),
         ("repair", None, "Automatically repair any problems found."),
         ("add-lease", None, "Add/renew lease on all shares."),
+        ("force", None, "Ask the storage servers, even if the node remembers a recent healthy result."),
         ]
     def parseArgs(self, *locations):
         self.locations = map(argv_to_unicode, locations)
@@ -439,6 +440,7 @@ class DeepCheckOptions(FilesystemOptions):
         ("verify", None, "Verify all hashes, instead of merely querying share presence."),
         ("repair", None, "Automatically repair any problems found."),
         ("add-lease", None, "Add/renew lease on all shares."),
+        ("force", None, "Ask the storage servers, even if the node remembers a recent healthy result."),
         ("verbose", "v", "Be noisy about what is happening."),
         ]
     def parseArgs(self, *locations):
@@ -623,6 +623,15 @@ def dump_uri_instance(u, nodeid, out, show_header=True):
             print >>out, "Directory Verifier URI:"
         dump_uri_instance(u._filenode_uri, nodeid, out, False)
 
+    elif isinstance(u, uri.ShardedDirectoryURI): # sharded directory
+        if show_header:
+            print >>out, "Sharded Directory Writeable URI:"
+        dump_uri_instance(u._filenode_uri, nodeid, out, False)
+    elif isinstance(u, uri.ReadonlyShardedDirectoryURI):
+        if show_header:
+            print >>out, "Sharded Directory Read-only URI:"
+        dump_uri_instance(u._filenode_uri, nodeid, out, False)
+
     else:
         print >>out, "unknown cap type"
 
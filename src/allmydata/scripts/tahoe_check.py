@@ -39,6 +39,8 @@ def check_location(options, where):
         url += "&repair=true"
     if options["add-lease"]:
         url += "&add-lease=true"
+    if options["force"]:
+        url += "&force=true"
 
     resp = do_http("POST", url)
     if resp.status != 200:
@@ -303,6 +305,8 @@ class DeepCheckStreamer(LineOnlyReceiver):
             output = DeepCheckOutput(self, options)
         if options["add-lease"]:
             url += "&add-lease=true"
+        if options["force"]:
+            url += "&force=true"
         resp = do_http("POST", url)
         if resp.status not in (200, 302):
             print >>stderr, format_http_error("ERROR", resp)
@@ -73,7 +73,18 @@ class ManifestStreamer(LineOnlyReceiver):
         except Exception, e:
             print >>stderr, "ERROR could not decode/parse %s\nERROR  %r" % (quote_output(line), e)
         else:
-            if d["type"] in ("file", "directory"):
+            if d["type"] == "directory-shard":
+                # a shard has no path, but its shares are part of the tree
+                v = None
+                if self.options["storage-index"]:
+                    v = d.get("storage-index", None)
+                elif self.options["verify-cap"]:
+                    v = d.get("verifycap", None)
+                elif self.options["repair-cap"]:
+                    v = d.get("repaircap", None)
+                if v:
+                    print >>stdout, quote_output(v, quotemarks=False)
+            elif d["type"] in ("file", "directory"):
                 if self.options["storage-index"]:
                     si = d.get("storage-index", None)
                     if si:
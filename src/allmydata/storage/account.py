@@ -112,6 +112,9 @@ class Account(Referenceable):
     def remote_get_buckets(self, storage_index):
         return self.server.client_get_buckets(storage_index, self)
 
+    def remote_get_buckets_bulk(self, storage_indexes):
+        return self.server.client_get_buckets_bulk(storage_indexes, self)
+
     def remote_slot_testv_and_readv_and_writev(self, storage_index, secrets,
                                                test_and_write_vectors, read_vector):
         write_enabler = secrets[0]
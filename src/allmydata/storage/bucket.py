@@ -124,6 +124,12 @@ class BucketReader(Referenceable):
         d.addBoth(self._add_latency, "read", start)
         return d
 
+    def remote_readv(self, read_vector):
+        start = time.time()
+        d = self._share.readv(read_vector)
+        d.addBoth(self._add_latency, "read", start)
+        return d
+
     def remote_advise_corrupt_share(self, reason):
         return self._account.remote_advise_corrupt_share("immutable",
                                                          self.storage_index,
@@ -57,6 +57,7 @@ class StorageServer(service.MultiService):
                           "close": [],
                           "read": [],
                           "get": [],
+                          "get_bulk": [],
                           "writev": [], # mutable
                           "readv": [],
                           "add-lease": [], # both
@@ -201,6 +202,7 @@ class StorageServer(service.MultiService):
                       "prevents-read-past-end-of-share-data": True,
                       "ignores-lease-renewal-and-cancel-secrets": True,
                       "has-immutable-readv": True,
+                      "has-bulk-get-buckets": True,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -281,6 +283,29 @@ class StorageServer(service.MultiService):
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
+        d = self._get_bucket_readers(storage_index, account)
+        d.addBoth(self._add_latency, "get", start)
+        return d
+
+    def client_get_buckets_bulk(self, storage_indexes, account):
+        start = self.clock.seconds()
+        self.count("get_bulk")
+        log.msg("storage: get_buckets_bulk [%d SIs]" % len(storage_indexes))
+        results = {} # k: storage_index, v: {sharenum: BucketReader}
+
+        d = defer.succeed(None)
+        for storage_index in set(storage_indexes):
+            d.addCallback(lambda ign, storage_index=storage_index:
+                          self._get_bucket_readers(storage_index, account))
+            def _got_readers(bucketreaders, storage_index=storage_index):
+                if bucketreaders:
+                    results[storage_index] = bucketreaders
+            d.addCallback(_got_readers)
+        d.addCallback(lambda ign: results)
+        d.addBoth(self._add_latency, "get_bulk", start)
+        return d
+
+    def _get_bucket_readers(self, storage_index, account):
         bucketreaders = {} # k: sharenum, v: BucketReader
 
         shareset = self.backend.get_shareset(storage_index)
@@ -292,7 +317,6 @@ class StorageServer(service.MultiService):
                 bucketreaders[share.get_shnum()] = shareset.make_bucket_reader(account, share)
             return bucketreaders
         d.addCallback(_make_readers)
-        d.addBoth(self._add_latency, "get", start)
         return d
 
     def client_slot_testv_and_readv_and_writev(self, storage_index,
@@ -31,8 +31,10 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 
 import re, time
 from zope.interface import implements
-from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
+from twisted.internet import defer
+from foolscap.api import eventually, DeadReferenceError
+from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer, \
+     MAX_BULK_STORAGE_INDEXES
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
@@ -62,17 +64,20 @@ class StorageFarmBroker:
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
     """
-    def __init__(self, tub, permute_peers, preferred_peers=()):
+    def __init__(self, tub, permute_peers, preferred_peers=(),
+                 demote_slow_servers=False):
         self.tub = tub
         assert permute_peers # False not implemented yet
         self.permute_peers = permute_peers
         self.preferred_peers = preferred_peers
+        self.demote_slow_servers = demote_slow_servers
         # self.servers maps serverid -> IServer, and keeps track of all the
         # storage servers that we've heard about. Each descriptor manages its
         # own Reconnector, and will give us a RemoteReference when we ask
         # them for it.
         self.servers = {}
         self.introducer_client = None
+        self.performance_db = None
 
     # these two are used in unit tests
     def test_add_rref(self, serverid, rref, ann):
@@ -84,6 +89,11 @@ class StorageFarmBroker:
     def test_add_server(self, serverid, s):
         self.servers[serverid] = s
 
+    def use_performance_db(self, performance_db):
+        """Remember server response times in the given PerformanceDB, and
+        start each newly-announced server off with its recorded history."""
+        self.performance_db = performance_db
+
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
         ic.subscribe_to("storage", self._got_announcement)
@@ -102,7 +112,11 @@ class StorageFarmBroker:
             # replacement
             del self.servers[serverid]
             old.stop_connecting()
-            # now we forget about them and start using the new one
+            # now we forget about them and start using the new one, but
+            # what we learned about their speed still applies
+            s.performance = old.performance
+        elif self.performance_db:
+            self.performance_db.restore(s.get_longname(), s.performance)
         self.servers[serverid] = s
         s.start_connecting(self.tub, self._trigger_connections)
         # the descriptor will manage their own Reconnector, and each time we
@@ -124,12 +138,40 @@ class StorageFarmBroker:
         assert self.permute_peers == True
         connected_servers = self.get_connected_servers()
         preferred_servers = frozenset(s for s in connected_servers if s.get_longname() in self.preferred_peers)
+        slow_servers = frozenset()
+        if self.demote_slow_servers:
+            slow_servers = self._find_slow_servers(connected_servers)
         def _permuted(server):
             seed = server.get_permutation_seed()
             is_unpreferred = server not in preferred_servers
-            return (is_unpreferred, sha1(peer_selection_index + seed).digest())
+            is_slow = server in slow_servers
+            return (is_unpreferred, is_slow,
+                    sha1(peer_selection_index + seed).digest())
         return sorted(connected_servers, key=_permuted)
 
+    # If demote_slow_servers is set, a server whose median response time is
+    # this many times the grid-wide median, and at least
+    # SLOW_SERVER_MIN_LATENCY seconds, is moved to the end of the permuted
+    # list (but stays ahead of unpreferred servers if it is preferred).
+    # Everybody else keeps their usual permuted position, so placement only
+    # changes for servers that are clearly struggling.
+    SLOW_SERVER_FACTOR = 4
+    SLOW_SERVER_MIN_LATENCY = 0.5
+    SLOW_SERVER_MIN_KNOWN = 3
+
+    def _find_slow_servers(self, servers):
+        medians = {}
+        for s in servers:
+            m = s.get_performance().get_latency_percentile(0.5)
+            if m is not None:
+                medians[s] = m
+        if len(medians) < self.SLOW_SERVER_MIN_KNOWN:
+            return frozenset()
+        typical = sorted(medians.values())[len(medians)//2]
+        threshold = max(typical * self.SLOW_SERVER_FACTOR,
+                        self.SLOW_SERVER_MIN_LATENCY)
+        return frozenset(s for (s, m) in medians.items() if m > threshold)
+
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
 
@@ -162,6 +204,172 @@ class StubServer:
     def get_nickname(self):
         return "?"
 
+class ServerPerformance:
+    """I remember how quickly a single storage server has answered our
+    requests, so that downloaders can prefer fast servers and notice when a
+    request is taking unusually long.
+
+    I keep an exponentially-weighted moving average of the round-trip time
+    and of the throughput, plus a window of recent response times from which
+    percentiles are computed. All times are in seconds, throughput is in
+    bytes per second.
+    """
+    ALPHA = 0.25 # weight of each new sample in the moving averages
+    MAX_SAMPLES = 100 # response times retained for get_latency_percentile
+    MIN_SAMPLES = 20 # fewer than this and percentiles are not meaningful
+    # responses smaller than this are dominated by latency rather than
+    # bandwidth, so they only update the RTT estimate
+    MIN_TRANSFER_SIZE = 10*1000
+
+    def __init__(self):
+        self.rtt = None
+        self.throughput = None
+        self._samples = []
+        self._sorted_samples = None # cache for get_latency_percentile
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return (1-self.ALPHA)*old + self.ALPHA*new
+
+    def _add_sample(self, elapsed):
+        self._samples.append(elapsed)
+        if len(self._samples) > self.MAX_SAMPLES:
+            self._samples = self._samples[-self.MAX_SAMPLES:]
+        self._sorted_samples = None
+
+    def record_rtt(self, rtt):
+        """Record the time taken by a request that moved very little data."""
+        self.rtt = self._average(self.rtt, rtt)
+        self._add_sample(rtt)
+
+    def record_transfer(self, received, elapsed):
+        """Record that a request which returned 'received' bytes took
+        'elapsed' seconds from start to finish."""
+        if received < self.MIN_TRANSFER_SIZE or self.rtt is None:
+            self.record_rtt(elapsed)
+            return
+        self._add_sample(elapsed)
+        transfer_time = elapsed - self.rtt
+        if transfer_time > 0:
+            self.throughput = self._average(self.throughput,
+                                            received / transfer_time)
+
+    def estimate_time(self, size):
+        """Return the expected number of seconds needed to fetch 'size'
+        bytes, or None if I have not seen any responses yet."""
+        if self.rtt is None:
+            return None
+        if self.throughput is None:
+            return self.rtt
+        return self.rtt + size / self.throughput
+
+    def get_latency_percentile(self, percentile):
+        """Return the given percentile (0.0-1.0) of the recent response
+        times, or None if there are too few samples to say."""
+        count = len(self._samples)
+        if count < self.MIN_SAMPLES:
+            return None
+        if self._sorted_samples is None:
+            self._sorted_samples = sorted(self._samples)
+        return self._sorted_samples[min(int(percentile*count), count-1)]
+
+    def get_state(self):
+        """Return a dict describing everything I have learned, suitable for
+        JSON serialization and for passing to set_state() later."""
+        return {"rtt": self.rtt,
+                "throughput": self.throughput,
+                "samples": list(self._samples)}
+
+    def set_state(self, state):
+        """Replace my statistics with those from a previous get_state()."""
+        self.rtt = state.get("rtt")
+        self.throughput = state.get("throughput")
+        self._samples = list(state.get("samples", []))[-self.MAX_SAMPLES:]
+        self._sorted_samples = None
+
+
+class BucketLocator:
+    """I answer get_buckets() questions on behalf of a single server. A
+    question asked while no other is outstanding is sent straight away. If
+    the server supports get_buckets_bulk(), questions asked while a previous
+    request is still in flight are held until it returns, and then sent
+    together in a single round trip, so operations that look up many files
+    at once (deep-check, or a backup looking for files it has already
+    uploaded) do not pay one round trip per file. Older servers are asked one
+    storage index at a time, as before.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._pending = {} # storage_index -> list of Deferreds
+        self._in_flight = 0
+
+    def _supports_bulk(self):
+        version = self._server.get_version()
+        if version is None:
+            return False
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+        return v1.get("has-bulk-get-buckets", False)
+
+    def get_buckets(self, storage_index):
+        rref = self._server.get_rref()
+        if not self._supports_bulk():
+            d = rref.callRemote("get_buckets", storage_index)
+            d.addCallback(self._record_rtt, time.time())
+            return d
+        d = defer.Deferred()
+        self._pending.setdefault(storage_index, []).append(d)
+        if not self._in_flight or len(self._pending) >= MAX_BULK_STORAGE_INDEXES:
+            self._flush()
+        return d
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self._in_flight += 1
+        def _ask():
+            rref = self._server.get_rref()
+            if rref is None:
+                # the server went away while we were waiting
+                raise DeadReferenceError("server is not connected")
+            # the round trip is timed from here, rather than from when the
+            # questions were asked, since they may have been waiting for a
+            # previous request to return
+            started = time.time()
+            if len(pending) == 1:
+                [storage_index] = pending.keys()
+                d = rref.callRemote("get_buckets", storage_index)
+                d.addCallback(lambda buckets: {storage_index: buckets})
+            else:
+                d = rref.callRemote("get_buckets_bulk", pending.keys())
+            d.addCallback(self._record_rtt, started)
+            return d
+        d = defer.maybeDeferred(_ask)
+        def _distribute(results):
+            for storage_index, waiters in pending.items():
+                buckets = results.get(storage_index, {})
+                for waiter in waiters:
+                    waiter.callback(dict(buckets))
+        def _failed(f):
+            for waiters in pending.values():
+                for waiter in waiters:
+                    waiter.errback(f)
+        d.addCallbacks(_distribute, _failed)
+        d.addErrback(log.err, format="error in BucketLocator._flush",
+                     level=log.WEIRD, umid="oq3GmA")
+        def _retired(ign):
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._flush()
+        d.addBoth(_retired)
+
+    def _record_rtt(self, res, started):
+        self._server.get_performance().record_rtt(time.time() - started)
+        return res
+
+
 class NativeStorageServer:
     """I hold information about a storage server that we want to connect to.
     If we are connected, I hold the RemoteReference, their host address, and
@@ -176,6 +384,9 @@ class NativeStorageServer:
 
     @ivar rref: the RemoteReference, if connected, otherwise None
     @ivar remote_host: the IAddress, if connected, otherwise None
+
+    @ivar performance: a ServerPerformance, which accumulates the response
+                       times we observe across all uploads and downloads
     """
     implements(IServer)
 
@@ -185,6 +396,8 @@ class NativeStorageServer:
           "maximum-mutable-share-size": 2*1000*1000*1000, # maximum prior to v1.9.2
           "tolerates-immutable-read-overrun": False,
           "delete-mutable-shares-with-zero-length-writev": False,
+          "has-immutable-readv": False,
+          "has-bulk-get-buckets": False,
           "available-space": None,
           },
         "application-version": "unknown: no get_version()",
@@ -222,6 +435,8 @@ class NativeStorageServer:
         self._is_connected = False
         self._reconnector = None
         self._trigger_cb = None
+        self.performance = ServerPerformance()
+        self._bucket_locator = BucketLocator(self)
 
     # Special methods used by copy.copy() and copy.deepcopy(). When those are
     # used in allmydata.immutable.filenode to copy CheckResults during
@@ -265,6 +480,10 @@ class NativeStorageServer:
         return self.last_connect_time
     def get_last_loss_time(self):
         return self.last_loss_time
+    def get_performance(self):
+        return self.performance
+    def get_buckets(self, storage_index):
+        return self._bucket_locator.get_buckets(storage_index)
     def get_last_received_data_time(self):
         if self.rref is None:
             return None
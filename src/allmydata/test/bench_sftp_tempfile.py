@@ -0,0 +1,75 @@
+"""
+Measure the throughput of the temporary files used by the SFTP frontend, by
+driving an OverwriteableFileConsumer the way that GeneralSFTPFile does:
+
+ upload:   the client writes the file in 32 KiB writeChunk requests, then
+           the file is read back in 128 KiB pieces to be uploaded
+ download: the file is downloaded in 128 KiB segments, then the client
+           reads it in 32 KiB readChunk requests
+
+Run it with:
+
+python bench_sftp_tempfile.py [size in MiB]
+"""
+
+import sys, time
+
+from allmydata.frontends.sftpd import OverwriteableFileConsumer
+from allmydata.util import fileutil
+
+CHUNK_SIZE = 32*1024
+SEGMENT_SIZE = 128*1024
+
+class B(object):
+    def __init__(self, size):
+        self.size = size
+        self.data = "".join(["%015d\n" % i for i in xrange(size // 16)])
+
+    def upload(self):
+        consumer = OverwriteableFileConsumer(0, fileutil.EncryptedTemporaryFile)
+        consumer.download_done("download not needed")
+        for offset in xrange(0, self.size, CHUNK_SIZE):
+            consumer.overwrite(offset, self.data[offset:offset+CHUNK_SIZE])
+        f = consumer.get_file()
+        f.seek(0)
+        pieces = []
+        while True:
+            data = f.read(SEGMENT_SIZE)
+            if not data:
+                break
+            pieces.append(data)
+        consumer.close()
+        assert "".join(pieces) == self.data
+
+    def download(self):
+        consumer = OverwriteableFileConsumer(self.size, fileutil.EncryptedTemporaryFile)
+        for offset in xrange(0, self.size, SEGMENT_SIZE):
+            consumer.write(self.data[offset:offset+SEGMENT_SIZE])
+        pieces = []
+        for offset in xrange(0, self.size, CHUNK_SIZE):
+            # the download is complete, so these fire immediately
+            consumer.read(offset, CHUNK_SIZE).addCallback(pieces.append)
+        consumer.close()
+        assert "".join(pieces) == self.data
+
+    def run_benchmarks(self, reps=5):
+        for encrypt in (True, False):
+            fileutil.encrypt_temporary_files = encrypt
+            for func in (self.upload, self.download):
+                best = None
+                for i in xrange(reps):
+                    start = time.time()
+                    func()
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                print "%-8s %-12s %7.1f MiB/s" % (func.__name__,
+                                                  encrypt and "encrypted" or "unencrypted",
+                                                  self.size / best / (1024*1024))
+
+if __name__ == "__main__":
+    size_mib = 64
+    if len(sys.argv) > 1:
+        size_mib = int(sys.argv[1])
+    b = B(size_mib*1024*1024)
+    b.run_benchmarks()
@@ -299,6 +299,14 @@ class FakeMutableFileNode:
         assert self.storage_index in self.file_types
         return self.file_types[self.storage_index]
 
+    # we do not keep track of versions, so pretend that there has only ever
+    # been one, whose root hash depends upon the current contents
+    def get_sequence_number(self):
+        return 1
+    def get_root_hash(self):
+        return hashutil.tagged_hash("fake-root-hash",
+                                    self.all_contents[self.storage_index])
+
     def check(self, monitor, verify=False, add_lease=False):
         s = StubServer("\x00"*20)
         r = CheckResults(self.my_uri, self.storage_index,
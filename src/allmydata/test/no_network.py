@@ -26,6 +26,8 @@ from allmydata import uri as tahoe_uri
 from allmydata.client import Client
 from allmydata.storage.server import StorageServer
 from allmydata.storage.backends.disk.disk_backend import DiskBackend
+from allmydata.storage_client import ServerPerformance, BucketLocator, \
+     StubServer
 from allmydata.util import fileutil, idlib, hashutil, log
 from allmydata.util.hashutil import sha1
 from allmydata.test.common_web import HTTPClientGETFactory
@@ -121,6 +123,11 @@ class LocalWrapper:
                 for shnum in res:
                     assert not isinstance(res[shnum], defer.Deferred), (methname, res)
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_buckets_bulk":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        assert not isinstance(buckets[shnum], defer.Deferred), (methname, res)
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -148,6 +155,8 @@ class NoNetworkServer:
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        self.performance = ServerPerformance()
+        self._bucket_locator = BucketLocator(self)
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     # Special method used by copy.copy() and copy.deepcopy(). When those are
@@ -176,6 +185,10 @@ class NoNetworkServer:
         return self.rref
     def get_version(self):
         return self.rref.version
+    def get_performance(self):
+        return self.performance
+    def get_buckets(self, storage_index):
+        return self._bucket_locator.get_buckets(storage_index)
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
@@ -197,6 +210,12 @@ class NoNetworkStorageBroker:
     def get_all_serverids(self):
         return self.client.get_all_serverids()
 
+    def get_stub_server(self, serverid):
+        for s in self.get_connected_servers():
+            if s.get_serverid() == serverid:
+                return s
+        return StubServer(serverid)
+
 
 class NoNetworkClient(Client):
     def create_tub(self):
@@ -440,8 +440,9 @@ class CounterHolder(object):
     def __init__(self):
         self._num_active_block_fetches = 0
         self._max_active_block_fetches = 0
+        self._blocks_fetched = {} # sharenum -> set(blocknum)
 
-from allmydata.immutable.checker import ValidatedReadBucketProxy
+from allmydata.immutable.checker import ValidatedReadBucketProxy, Checker
 class MockVRBP(ValidatedReadBucketProxy):
     def __init__(self, sharenum, bucket, share_hash_tree, num_blocks, block_size, share_size, counterholder):
         ValidatedReadBucketProxy.__init__(self, sharenum, bucket,
@@ -450,6 +451,7 @@ class MockVRBP(ValidatedReadBucketProxy):
         self.counterholder = counterholder
 
     def get_block(self, blocknum):
+        self.counterholder._blocks_fetched.setdefault(self.sharenum, set()).add(blocknum)
         self.counterholder._num_active_block_fetches += 1
         if self.counterholder._num_active_block_fetches > self.counterholder._max_active_block_fetches:
             self.counterholder._max_active_block_fetches = self.counterholder._num_active_block_fetches
@@ -466,11 +468,40 @@ class TooParallel(GridTestMixin, unittest.TestCase):
     # crashing with MemoryErrors on >1GB files.
 
     def test_immutable(self):
+        self.basedir = "checker/TooParallel/immutable"
+        d = self._verify()
+        def _check((cr, counterholder)):
+            # the verifier works on all 4 shares in parallel, but only
+            # keeps a few block fetches outstanding for each share
+            per_share = Checker.MAX_BLOCK_FETCHES_PER_SHARE
+            self.failUnlessEqual(counterholder._max_active_block_fetches,
+                                 4 * per_share)
+            for shnum in range(4):
+                self.failUnlessEqual(counterholder._blocks_fetched[shnum],
+                                     set(range(80)))
+            self.failUnlessEqual(cr.get_report(), [])
+        d.addCallback(_check)
+        return d
+
+    test_immutable.timeout = 80
+
+    def test_sample(self):
+        self.basedir = "checker/TooParallel/sample"
+        d = self._verify(sample=0.1)
+        def _check((cr, counterholder)):
+            self.failUnless(cr.is_healthy())
+            for shnum in range(4):
+                self.failUnlessEqual(len(counterholder._blocks_fetched[shnum]),
+                                     8)
+            self.failUnlessEqual(cr.get_report(),
+                                 ["verified a random 10% of the blocks of each share"])
+        d.addCallback(_check)
+        return d
+
+    def _verify(self, sample=None):
         import allmydata.immutable.checker
         origVRBP = allmydata.immutable.checker.ValidatedReadBucketProxy
 
-        self.basedir = "checker/TooParallel/immutable"
-
         # If any code asks to instantiate a ValidatedReadBucketProxy,
         # we give them a MockVRBP which is configured to use our
         # CounterHolder.
@@ -494,18 +525,148 @@ class TooParallel(GridTestMixin, unittest.TestCase):
         d.addCallback(_start)
         def _do_check(ur):
             n = self.c0.create_node_from_uri(ur.get_uri())
+            if sample:
+                n.set_verify_sample(sample)
             return n.check(Monitor(), verify=True)
         d.addCallback(_do_check)
-        def _check(cr):
-            # the verifier works on all 4 shares in parallel, but only
-            # fetches one block from each share at a time, so we expect to
-            # see 4 parallel fetches
-            self.failUnlessEqual(counterholder._max_active_block_fetches, 4)
-        d.addCallback(_check)
+        d.addCallback(lambda cr: (cr, counterholder))
         def _clean_up(res):
             allmydata.immutable.checker.ValidatedReadBucketProxy = origVRBP
             return res
         d.addBoth(_clean_up)
         return d
 
-    test_immutable.timeout = 80
+class FakeResults:
+    def __init__(self, storage_index, healthy=True):
+        self._storage_index = storage_index
+        self._healthy = healthy
+    def get_storage_index(self):
+        return self._storage_index
+    def is_healthy(self):
+        return self._healthy
+
+class ResultsCache(unittest.TestCase):
+    def test_cache(self):
+        c = check_results.CheckResultsCache(60)
+        good = FakeResults("si1")
+        self.failUnlessIdentical(c.add(good, False, now=1000), good)
+        self.failUnlessIdentical(c.get("si1", False, now=1059), good)
+        # an unverified result does not stand in for a verifying check
+        self.failUnlessEqual(c.get("si1", True, now=1001), None)
+        self.failUnlessEqual(c.get("si1", False, now=1060), None)
+
+        # unhealthy results are not remembered
+        bad = FakeResults("si2", healthy=False)
+        self.failUnlessIdentical(c.add(bad, True, now=1000), bad)
+        self.failUnlessEqual(c.get("si2", False, now=1000), None)
+
+        verified = FakeResults("si3")
+        c.add(verified, True, now=1000)
+        self.failUnlessIdentical(c.get("si3", False, now=1000), verified)
+        crr = c.get_check_and_repair("si3", True, now=1000)
+        self.failIf(crr.get_repair_attempted())
+        self.failUnlessIdentical(crr.get_pre_repair_results(), verified)
+        self.failUnlessIdentical(crr.get_post_repair_results(), verified)
+        c.discard("si3")
+        self.failUnlessEqual(c.get("si3", False, now=1000), None)
+        self.failUnlessEqual(c.get_check_and_repair("si3", False, now=1000),
+                             None)
+
+    def test_limit(self):
+        self.patch(check_results.CheckResultsCache, "MAX_ENTRIES", 2)
+        c = check_results.CheckResultsCache(60)
+        c.add(FakeResults("si1"), False, now=1000)
+        c.add(FakeResults("si2"), False, now=1001)
+        c.add(FakeResults("si1"), False, now=1002)
+        c.add(FakeResults("si3"), False, now=1003)
+        self.failUnlessEqual(c.get("si2", False, now=1004), None)
+        self.failUnless(c.get("si1", False, now=1004))
+        self.failUnless(c.get("si3", False, now=1004))
+        # expired entries are dropped as new ones arrive
+        c.add(FakeResults("si4"), False, now=1062)
+        self.failUnlessEqual(sorted(c._results.keys()), ["si3", "si4"])
+
+class CachedChecks(GridTestMixin, unittest.TestCase):
+    def test_nodes(self):
+        self.basedir = "checker/CachedChecks/nodes"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        c0.nodemaker.check_results_cache = check_results.CheckResultsCache(600)
+        self.results = []
+        def _remember(res):
+            self.results.append(res)
+            return res
+        d = c0.upload(Data("data" * 100, convergence=""))
+        def _uploaded(ur):
+            self.imm = c0.create_node_from_uri(ur.get_uri())
+            return c0.create_mutable_file(MutableData("contents"))
+        d.addCallback(_uploaded)
+        def _created(node):
+            self.mut = node
+        d.addCallback(_created)
+
+        def _check(ign, node, **kwargs):
+            d = node.check(Monitor(), **kwargs)
+            d.addCallback(_remember)
+            return d
+        def _same(ign, a, b):
+            self.failUnlessIdentical(self.results[a], self.results[b])
+        def _different(ign, a, b):
+            self.failIfIdentical(self.results[a], self.results[b])
+
+        d.addCallback(lambda ign: _check(ign, self.imm))           # 0
+        d.addCallback(lambda ign: _check(ign, self.imm))           # 1
+        d.addCallback(_same, 0, 1)
+        d.addCallback(lambda ign: _check(ign, self.imm, verify=True)) # 2
+        d.addCallback(_different, 1, 2)
+        d.addCallback(lambda ign: _check(ign, self.imm))           # 3
+        d.addCallback(_same, 2, 3)
+        d.addCallback(lambda ign: _check(ign, self.imm, add_lease=True)) # 4
+        d.addCallback(_different, 3, 4)
+        def _check_and_repair(ign):
+            d = self.imm.check_and_repair(Monitor())
+            def _checked(crr):
+                self.failIf(crr.get_repair_attempted())
+                self.failUnlessIdentical(crr.get_pre_repair_results(),
+                                         self.results[4])
+            d.addCallback(_checked)
+            return d
+        d.addCallback(_check_and_repair)
+
+        d.addCallback(lambda ign: _check(ign, self.mut))           # 5
+        d.addCallback(lambda ign: _check(ign, self.mut))           # 6
+        d.addCallback(_same, 5, 6)
+        # publishing forgets the old results
+        d.addCallback(lambda ign: self.mut.overwrite(MutableData("new contents")))
+        d.addCallback(lambda ign: _check(ign, self.mut))           # 7
+        d.addCallback(_different, 6, 7)
+        return d
+
+    def test_deep_check_force(self):
+        self.basedir = "checker/CachedChecks/deep_check_force"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        c0.nodemaker.check_results_cache = check_results.CheckResultsCache(600)
+        d = c0.create_dirnode()
+        def _created(root):
+            self.root = root
+            return root.add_file(u"file", Data("data" * 100, convergence=""))
+        d.addCallback(_created)
+        self.results = []
+        def _deep_check(ign, **kwargs):
+            d = self.root.start_deep_check(**kwargs).when_done()
+            def _done(res):
+                self.results.append(res.get_all_results())
+            d.addCallback(_done)
+            return d
+        d.addCallback(_deep_check)
+        d.addCallback(_deep_check)
+        d.addCallback(_deep_check, force=True)
+        def _check(ign):
+            (first, second, forced) = self.results
+            self.failUnlessEqual(sorted(first.keys()), [(), (u"file",)])
+            for path in first:
+                self.failUnlessIdentical(first[path], second[path])
+                self.failIfIdentical(second[path], forced[path])
+        d.addCallback(_check)
+        return d
@@ -2,6 +2,7 @@ import os, sys
 
 import twisted
 from twisted.trial import unittest
+from twisted.internet import reactor, task
 from twisted.application import service
 
 import allmydata
@@ -15,11 +16,12 @@ from allmydata import client
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.backends.disk.disk_backend import DiskBackend
 from allmydata.storage.backends.cloud.cloud_backend import CloudBackend
-from allmydata.util import base32, fileutil
+from allmydata.util import base32, fileutil, pollmixin
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, IDirectoryNode
 from foolscap.api import flushEventualQueue
 import allmydata.test.common_util as testutil
+from allmydata.test.common import TEST_RSA_KEY_SIZE
 
 import mock
 
@@ -541,6 +543,26 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         expected = fileutil.abspath_expanduser_unicode(u"relative", abs_basedir)
         self.failUnlessReallyEqual(w.staticdir, expected)
 
+    def test_web_directory_cache(self):
+        basedir = u"client.Basic.test_web_directory_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "[node]\n" +
+                       "web.port = tcp:0:interface=127.0.0.1\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.get_directory_cache(), None)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "[node]\n" +
+                       "web.port = tcp:0:interface=127.0.0.1\n" +
+                       "web.directory_cache_size = 2MB\n")
+        c = client.Client(basedir)
+        cache = c.get_directory_cache()
+        self.failUnless(cache)
+        self.failUnlessReallyEqual(cache._max_size, 2*1000*1000)
+
     # TODO: also test config options for SFTP.
 
     def test_ftp_auth_keyfile(self):
@@ -606,6 +628,149 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         sb.servers.clear()
         self.failUnlessReallyEqual(self._permute(sb, "one"), [])
 
+    def test_permute_demotes_slow_servers(self):
+        sb = StorageFarmBroker(None, True, ['1'], demote_slow_servers=True)
+        for k in ["%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+        def _record(serverid, latency):
+            p = sb.servers[serverid].get_performance()
+            for i in range(p.MAX_SAMPLES):
+                p.record_rtt(latency)
+        # with too little history, nobody is moved
+        _record("3", 5.0)
+        _record("1", 5.0)
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['1','3','0','4','2'])
+        # slow servers go to the back of their group
+        _record("0", 0.1)
+        _record("2", 0.1)
+        _record("4", 0.1)
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['1','0','4','2','3'])
+        # but small differences in fast servers are not worth acting upon
+        _record("3", 0.3)
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['1','3','0','4','2'])
+
+    def test_permute_keeps_slow_servers_by_default(self):
+        sb = StorageFarmBroker(None, True)
+        for k in ["%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+            p = sb.servers[k].get_performance()
+            for i in range(p.MAX_SAMPLES):
+                p.record_rtt(k == "3" and 5.0 or 0.1)
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
+
+    def test_demote_slow_config(self):
+        basedir = "test_client.Basic.test_demote_slow_config"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failIf(c.get_storage_broker().demote_slow_servers)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG + "peers.demote_slow = true\n")
+        c = client.Client(basedir)
+        self.failUnless(c.get_storage_broker().demote_slow_servers)
+
+    def test_performance_db(self):
+        basedir = "test_client.Basic.test_performance_db"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnless(c.get_storage_broker().performance_db)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "server_performance.sqlite")))
+
+        basedir = "test_client.Basic.test_performance_db_disabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "peers.remember_performance = false\n")
+        c = client.Client(basedir)
+        self.failIf(c.get_storage_broker().performance_db)
+
+    def test_check_results_cache(self):
+        basedir = "test_client.Basic.test_check_results_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.get_check_results_cache(), None)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG + "check.cache_ttl = 600\n")
+        c = client.Client(basedir)
+        cache = c.get_check_results_cache()
+        self.failUnless(cache)
+        n = c.create_node_from_uri("URI:CHK:n7r3m6wmomelk4sep3kw5cvduq:os7ijw5c3maek7pg65e5254k2fzjflavtpejjyhshpsxuqzhcwwq:3:20:14861")
+        self.failUnlessIdentical(n._cnode._check_results_cache, cache)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG + "check.cache_ttl = -1\n")
+        self.failUnlessRaises(InvalidValueError, client.Client, basedir)
+
+    def test_verify_sample(self):
+        basedir = "test_client.Basic.test_verify_sample"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.verify_sample, None)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG + "check.verify_sample = 0.05\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.verify_sample, 0.05)
+        n = c.create_node_from_uri("URI:CHK:n7r3m6wmomelk4sep3kw5cvduq:os7ijw5c3maek7pg65e5254k2fzjflavtpejjyhshpsxuqzhcwwq:3:20:14861")
+        self.failUnlessEqual(n._cnode._verify_sample, 0.05)
+
+        for bad in ["0", "1.5"]:
+            fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                           BASECONFIG + "check.verify_sample = %s\n" % bad)
+            self.failUnlessRaises(InvalidValueError, client.Client, basedir)
+
+    def test_deep_check_journal(self):
+        basedir = "test_client.Basic.test_deep_check_journal"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnless(c.get_deep_check_journal())
+        self.failUnlessEqual(c.deep_check_skip_healthy_within, None)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "deepcheck.sqlite")))
+
+        basedir = "test_client.Basic.test_deep_check_journal_disabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "deep-check.journal = false\n" +
+                       "deep-check.skip_healthy_within = 7 days\n")
+        c = client.Client(basedir)
+        self.failIf(c.get_deep_check_journal())
+        self.failUnlessEqual(c.deep_check_skip_healthy_within, 7*24*60*60)
+
+    def test_servermap_freshness(self):
+        basedir = "test_client.Basic.test_servermap_freshness"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.servermap_ttl, 0)
+        self.failIf(c.nodemaker.servermap_revalidate)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.servermap_ttl = 2.5\n" +
+                       "mutable.servermap_revalidate = true\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.servermap_ttl, 2.5)
+        self.failUnless(c.nodemaker.servermap_revalidate)
+        n = c.create_node_from_uri("URI:SSK-RO:e3mdrzfwhoq42hy5ubcz6rp3o4:ybyibhnp3vvwuq2vaw2ckjmesgkklfs6ghxleztqidihjyofgw7q")
+        self.failUnlessEqual(n._servermap_ttl, 2.5)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.servermap_ttl = -1\n")
+        self.failUnlessRaises(InvalidValueError, client.Client, basedir)
+
     def test_versions(self):
         basedir = "test_client.Basic.test_versions"
         os.mkdir(basedir)
@@ -726,6 +891,93 @@ def flush_but_dont_ignore(res):
     d.addCallback(_done)
     return d
 
+class KeyPool(unittest.TestCase, pollmixin.PollMixin):
+    def _make_generator(self, poolfile, low_water, high_water):
+        kg = client.KeyGenerator(poolfile, low_water, high_water)
+        kg.set_default_keysize(TEST_RSA_KEY_SIZE)
+        kg.pool_refresh_delay = 0
+        return kg
+
+    def test_pool(self):
+        basedir = "test_client.KeyPool.test_pool"
+        os.mkdir(basedir)
+        poolfile = os.path.join(basedir, "rsa_keypool")
+        kg = self._make_generator(poolfile, 1, 3)
+        kg.startService()
+        d = self.poll(lambda: len(kg.keypool) == 3)
+        def _full(ign):
+            self.failUnlessEqual(kg.timer, None)
+            first = kg.keypool[0]
+            d2 = kg.generate()
+            d2.addCallback(lambda keypair: self.failUnlessIdentical(keypair, first))
+            # other sizes are never taken from the pool
+            d2.addCallback(lambda ign: kg.generate(TEST_RSA_KEY_SIZE+8))
+            d2.addCallback(lambda ign: self.failUnlessEqual(len(kg.keypool), 2))
+            return d2
+        d.addCallback(_full)
+        def _stop(ign):
+            # still above the low water mark, so no refill was started
+            self.failUnlessEqual(len(kg.keypool), 2)
+            self.saved = [signer.serialize() for (verifier, signer) in kg.keypool]
+            kg.stopService()
+            self.failUnless(os.path.exists(poolfile))
+        d.addCallback(_stop)
+        def _restart(ign):
+            kg2 = self._make_generator(poolfile, 0, 0)
+            kg2.startService()
+            # loading the pool consumes the file
+            self.failIf(os.path.exists(poolfile))
+            self.failUnlessEqual(len(kg2.keypool), 2)
+            d2 = kg2.generate()
+            def _check((verifier, signer)):
+                self.failUnlessEqual(signer.serialize(), self.saved[0])
+                self.failUnlessEqual(verifier.serialize(),
+                                     signer.get_verifying_key().serialize())
+            d2.addCallback(_check)
+            d2.addCallback(lambda ign: kg2.stopService())
+            return d2
+        d.addCallback(_restart)
+        return d
+
+    def test_config(self):
+        basedir = "test_client.KeyPool.test_config"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "keypool.low_water = 2\n" +
+                       "keypool.high_water = 5\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c._key_generator.low_water, 2)
+        self.failUnlessEqual(c._key_generator.high_water, 5)
+
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "keypool.low_water = 5\n" +
+                       "keypool.high_water = 2\n")
+        self.failUnlessRaises(InvalidValueError, client.Client, basedir)
+
+        # a remote key generator makes the pool pointless
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "key_generator.furl = pb://ab@nowhere/xyz\n" +
+                       "keypool.low_water = 2\n" +
+                       "keypool.high_water = 5\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c._key_generator.high_water, 0)
+
+    def test_no_refill_with_remote(self):
+        kg = self._make_generator(None, 1, 3)
+        kg.set_remote_generator(object())
+        kg.startService()
+        d = task.deferLater(reactor, 0.1, lambda: None)
+        def _check(ign):
+            self.failUnlessEqual(kg.keypool, [])
+            self.failUnlessEqual(kg.timer, None)
+            kg.stopService()
+        d.addCallback(_check)
+        return d
+
+
 class Run(unittest.TestCase, testutil.StallMixin):
 
     def setUp(self):
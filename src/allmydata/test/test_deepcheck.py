@@ -7,7 +7,7 @@ from twisted.internet import threads # CLI tests use deferToThread
 from allmydata.immutable import upload
 from allmydata.mutable.common import UnrecoverableFileError
 from allmydata.mutable.publish import MutableData
-from allmydata.util import idlib
+from allmydata.util import idlib, fileutil
 from allmydata.util import base32
 from allmydata.scripts import runner
 from allmydata.interfaces import ICheckResults, ICheckAndRepairResults, \
@@ -21,6 +21,8 @@ from allmydata.test.common import ErrorMixin, _corrupt_mutable_share_data, \
 from allmydata.test.common_util import StallMixin
 from allmydata.test.no_network import GridTestMixin
 from allmydata.scripts import debug
+from allmydata.deepcheckjournal import DeepCheckJournal
+from allmydata.dirnode import DeepChecker
 
 
 timeout = 2400 # One of these took 1046.091s on Zandr's ARM box.
@@ -575,6 +577,7 @@ class DeepCheckWebGood(DeepCheckBase, unittest.TestCase):
     def json_full_deepcheck_is_healthy(self, data, n, where):
         self.failUnlessEqual(data["root-storage-index"],
                              base32.b2a(n.get_storage_index()), where)
+        self.failUnlessEqual(data["resumed"], False, where)
         self.failUnlessEqual(data["count-objects-checked"], 3, where)
         self.failUnlessEqual(data["count-objects-healthy"], 3, where)
         self.failUnlessEqual(data["count-objects-unhealthy"], 0, where)
@@ -586,6 +589,7 @@ class DeepCheckWebGood(DeepCheckBase, unittest.TestCase):
     def json_full_deepcheck_and_repair_is_healthy(self, data, n, where):
         self.failUnlessEqual(data["root-storage-index"],
                              base32.b2a(n.get_storage_index()), where)
+        self.failUnlessEqual(data["resumed"], False, where)
         self.failUnlessEqual(data["count-objects-checked"], 3, where)
 
         self.failUnlessEqual(data["count-objects-healthy-pre-repair"], 3, where)
@@ -1248,3 +1252,260 @@ class Large(DeepCheckBase, unittest.TestCase):
         d.addCallback(_check)
 
         return d
+
+
+class Sharded(DeepCheckBase, unittest.TestCase):
+    def test_stream_manifest(self):
+        self.basedir = "deepcheck/Sharded/stream_manifest"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode(shards=3)
+        def _created(n):
+            self.root = n
+            return n.add_file(u"large",
+                              upload.Data("large enough for CHK" * 100, None))
+        d.addCallback(_created)
+        d.addCallback(lambda ign: self.web(self.root, method="POST",
+                                           t="stream-manifest"))
+        def _check_stream( (output, url) ):
+            units = list(self.parse_streamed_json(output))
+            shards = self.root.get_known_shards()
+            shard_units = [u for u in units if u["type"] == "directory-shard"]
+            self.failUnlessEqual(len(shard_units), 3)
+            self.failUnlessEqual(sorted([u["shard"] for u in shard_units]),
+                                 [0, 1, 2])
+            for u in shard_units:
+                shard = shards[u["shard"]]
+                self.failUnlessEqual(u["directory"], self.root.get_uri())
+                self.failUnlessEqual(u["cap"], shard.get_uri())
+                self.failUnlessEqual(u["storage-index"],
+                                     base32.b2a(shard.get_storage_index()))
+                self.failUnlessEqual(u["verifycap"],
+                                     shard.get_verify_cap().to_string())
+            self.failUnlessEqual(units[-1]["type"], "stats")
+            self.failUnlessEqual(len(units), 2+3+1)
+
+            stdout, stderr = StringIO(), StringIO()
+            argv = ["--node-directory", self.get_clientdir(0),
+                    "manifest", "--storage-index", self.root.get_uri()]
+            d = threads.deferToThread(runner.runner, argv, run_by_human=False,
+                                      stdin=StringIO(""),
+                                      stdout=stdout, stderr=stderr)
+            d.addCallback(lambda ign: (stdout.getvalue(), stderr.getvalue()))
+            return d
+        d.addCallback(_check_stream)
+        def _check_cli( (out, err) ):
+            self.failUnlessEqual(err, "")
+            lines = [l for l in out.split("\n") if l]
+            expected = [self.root] + self.root.get_known_shards()
+            self.failUnlessEqual(len(lines), len(expected)+1)
+            for n in expected:
+                self.failUnlessIn(base32.b2a(n.get_storage_index()), lines)
+        d.addCallback(_check_cli)
+        return d
+
+
+class Journal(DeepCheckBase, unittest.TestCase):
+    def set_up_tree(self):
+        # root/
+        #  good (CHK)
+        #  subdir/
+        #   also-good (CHK)
+        fileutil.make_dirs(self.basedir)
+        self.journal = DeepCheckJournal(os.path.join(self.basedir,
+                                                     "deepcheck.sqlite"))
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            up = upload.Data("large enough for CHK" * 100, "")
+            return n.add_file(u"good", up)
+        d.addCallback(_created_root)
+        def _added_good(n):
+            self.good = n
+            return self.root.create_subdirectory(u"subdir")
+        d.addCallback(_added_good)
+        def _created_subdir(n):
+            self.subdir = n
+            up = upload.Data("also large enough for CHK" * 100, "")
+            return n.add_file(u"also-good", up)
+        d.addCallback(_created_subdir)
+        return d
+
+    def deep_check(self, ophandle, add_lease=False, skip_healthy_within=None):
+        op = self.journal.start_operation(ophandle, self.root, False, False,
+                                          add_lease)
+        d = self.root.start_deep_check(add_lease=add_lease, journal=op,
+                                       skip_healthy_within=skip_healthy_within
+                                       ).when_done()
+        def _done(res):
+            return (res.is_resumed(), res.get_counters()["count-objects-checked"],
+                    res.get_stats()["count-files"])
+        d.addCallback(_done)
+        return d
+
+    def test_resume(self):
+        self.basedir = "deepcheck/Journal/resume"
+        self.set_up_grid()
+        d = self.set_up_tree()
+        def _interrupt(ign):
+            # pretend that a walk was interrupted after the root and 'good'
+            # had been checked, with 'subdir' still to be read
+            op = self.journal.start_operation("handle", self.root,
+                                              False, False, False)
+            self.failIf(op.resumed)
+            op.directory_found(self.subdir.get_verify_cap().to_string(),
+                               self.subdir.get_write_uri(),
+                               self.subdir.get_readonly_uri(), [u"subdir"])
+            op.node_checked(self.root.get_verify_cap().to_string(), True, False)
+            op.node_checked(self.good.get_verify_cap().to_string(), True, False)
+        d.addCallback(_interrupt)
+        d.addCallback(lambda ign: self.deep_check("handle"))
+        # only subdir and also-good are left to check
+        d.addCallback(self.failUnlessEqual, (True, 2, 1))
+        # once finished, the same ophandle starts a new walk
+        d.addCallback(lambda ign: self.deep_check("handle"))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        # as does a different set of options
+        def _interrupt_again(ign):
+            op = self.journal.start_operation("handle", self.root,
+                                              True, False, False)
+            self.failIf(op.resumed)
+        d.addCallback(_interrupt_again)
+        d.addCallback(lambda ign: self.deep_check("handle"))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        return d
+
+    def _interrupt_after_root(self, ophandle, repair=False):
+        # pretend that a walk was interrupted after the root had been
+        # checked, with 'subdir' still to be read
+        op = self.journal.start_operation(ophandle, self.root,
+                                          False, repair, False)
+        self.failIf(op.resumed)
+        op.directory_found(self.subdir.get_verify_cap().to_string(),
+                           self.subdir.get_write_uri(),
+                           self.subdir.get_readonly_uri(), [u"subdir"])
+        op.node_checked(self.root.get_verify_cap().to_string(), True, False)
+        return op
+
+    def test_resume_ignores_other_operations(self):
+        # objects checked by another deep-check since this one started must
+        # still be checked (and reported on) when this one is resumed
+        self.basedir = "deepcheck/Journal/resume_ignores_other_operations"
+        self.set_up_grid()
+        d = self.set_up_tree()
+        d.addCallback(lambda ign: self._interrupt_after_root("handle"))
+        d.addCallback(lambda ign: self.deep_check("other"))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        # subdir and also-good were checked by 'other', but this walk has
+        # not seen them yet
+        d.addCallback(lambda ign: self.deep_check("handle"))
+        d.addCallback(self.failUnlessEqual, (True, 2, 1))
+        return d
+
+    def _resume_with_problem(self, repair):
+        # 'good' loses some shares, and is found to be unhealthy before the
+        # walk is interrupted. The resumed operation must still report it.
+        self.set_up_grid()
+        d = self.set_up_tree()
+        def _interrupt(ign):
+            self.delete_shares_numbered(self.good.get_uri(), [0, 1, 2])
+            op = self._interrupt_after_root("handle", repair)
+            checker = DeepChecker(self.root, False, repair, False, journal=op)
+            checker.set_monitor(Monitor())
+            return checker.add_node(self.good, [u"good"])
+        d.addCallback(_interrupt)
+        def _resume(ign):
+            op = self.journal.start_operation("handle", self.root,
+                                              False, repair, False)
+            self.failUnless(op.resumed)
+            if repair:
+                return self.root.start_deep_check_and_repair(journal=op).when_done()
+            return self.root.start_deep_check(journal=op).when_done()
+        d.addCallback(_resume)
+        return d
+
+    def test_resume_keeps_problems(self):
+        self.basedir = "deepcheck/Journal/resume_keeps_problems"
+        d = self._resume_with_problem(repair=False)
+        def _check(res):
+            self.failUnless(res.is_resumed())
+            c = res.get_counters()
+            # 'good' from before the restart, then subdir and also-good
+            self.failUnlessEqual(c["count-objects-checked"], 3)
+            self.failUnlessEqual(c["count-objects-unhealthy"], 1)
+            r = res.get_all_results()[(u"good",)]
+            self.failIf(r.is_healthy())
+            self.failUnlessEqual(r.get_storage_index(),
+                                 self.good.get_storage_index())
+            self.failUnlessEqual(r.get_share_counter_good(), 7)
+            self.failUnlessEqual(len(r.get_sharemap()), 7)
+            self.failUnlessEqual(r.get_uri().to_string(),
+                                 self.good.get_verify_cap().to_string())
+        d.addCallback(_check)
+        return d
+
+    def test_resume_keeps_repairs(self):
+        self.basedir = "deepcheck/Journal/resume_keeps_repairs"
+        d = self._resume_with_problem(repair=True)
+        def _check(res):
+            c = res.get_counters()
+            self.failUnlessEqual(c["count-objects-checked"], 3)
+            self.failUnlessEqual(c["count-objects-unhealthy-pre-repair"], 1)
+            self.failUnlessEqual(c["count-repairs-attempted"], 1)
+            self.failUnlessEqual(c["count-repairs-successful"], 1)
+            r = res.get_all_results()[(u"good",)]
+            self.failUnless(r.get_repair_attempted())
+            self.failUnless(r.get_post_repair_results().is_healthy())
+        d.addCallback(_check)
+        return d
+
+    def test_resume_web(self):
+        self.basedir = "deepcheck/Journal/resume_web"
+        self.set_up_grid()
+        d = self.set_up_tree()
+        def _interrupt(ign):
+            journal = self.g.clients[0].get_deep_check_journal()
+            op = journal.start_operation("resumeme", self.root,
+                                         False, False, False)
+            op.directory_found(self.subdir.get_verify_cap().to_string(),
+                               self.subdir.get_write_uri(),
+                               self.subdir.get_readonly_uri(), [u"subdir"])
+            op.node_checked(self.root.get_verify_cap().to_string(), True, False)
+            op.node_checked(self.good.get_verify_cap().to_string(), True, False)
+            return self.web(self.root, "POST", t="start-deep-check",
+                            ophandle="resumeme")
+        d.addCallback(_interrupt)
+        d.addCallback(self.wait_for_operation, "resumeme")
+        d.addCallback(self.get_operation_results, "resumeme", output="json")
+        def _check_json(data):
+            self.failUnlessEqual(data["resumed"], True)
+            self.failUnlessEqual(data["count-objects-checked"], 2)
+            return self.get_operation_results(None, "resumeme")
+        d.addCallback(_check_json)
+        def _check_html(res):
+            self.failUnlessIn("This operation was resumed", res)
+        d.addCallback(_check_html)
+        return d
+
+    def test_skip_healthy(self):
+        self.basedir = "deepcheck/Journal/skip_healthy"
+        self.set_up_grid()
+        d = self.set_up_tree()
+        d.addCallback(lambda ign: self.deep_check("one", skip_healthy_within=3600))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        # the files were healthy, so only the directories are checked, but
+        # the files are still counted
+        d.addCallback(lambda ign: self.deep_check("two", skip_healthy_within=3600))
+        d.addCallback(self.failUnlessEqual, (False, 2, 2))
+        # no lease was added last time, so add-lease checks everything
+        d.addCallback(lambda ign: self.deep_check("three", add_lease=True,
+                                                  skip_healthy_within=3600))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        d.addCallback(lambda ign: self.deep_check("four", add_lease=True,
+                                                  skip_healthy_within=3600))
+        d.addCallback(self.failUnlessEqual, (False, 2, 2))
+        # and without skip_healthy_within, nothing is skipped
+        d.addCallback(lambda ign: self.deep_check("five"))
+        d.addCallback(self.failUnlessEqual, (False, 4, 2))
+        return d
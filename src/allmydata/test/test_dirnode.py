@@ -14,14 +14,16 @@ from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
      MDMF_VERSION, SDMF_VERSION
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.common import UncoordinatedWriteError
+from allmydata.mutable.publish import Publish
 from allmydata.util import hashutil, base32
 from allmydata.util.netstring import split_netstring
-from allmydata.monitor import Monitor
+from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata.test.common import make_chk_file_uri, make_mutable_file_uri, \
      ErrorMixin
 from allmydata.test.no_network import GridTestMixin
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.nodemaker import NodeMaker
+from foolscap.api import fireEventually
 from base64 import b32decode
 import allmydata.test.common_util as testutil
 
@@ -1404,6 +1406,97 @@ class Packing(testutil.ReallyEqualMixin, unittest.TestCase):
         children = node._unpack_contents(packed_children)
         self._check_children(children)
 
+    def test_lazy_unpacking(self):
+        # children should only be created when they are looked at, and
+        # repacking should reuse the entries of untouched children
+        known_tree = b32decode(self.known_tree)
+        nodemaker = NodeMaker(None, None, None,
+                              None, None,
+                              {"k": 3, "n": 10}, None, None)
+        write_uri = "URI:SSK-RO:e3mdrzfwhoq42hy5ubcz6rp3o4:ybyibhnp3vvwuq2vaw2ckjmesgkklfs6ghxleztqidihjyofgw7q"
+        filenode = nodemaker.create_from_cap(write_uri)
+        node = dirnode.DirectoryNode(filenode, nodemaker, None)
+        created = []
+        original = nodemaker.create_from_cap
+        def create_from_cap(writecap, readcap=None, **kwargs):
+            created.append(readcap)
+            return original(writecap, readcap, **kwargs)
+        self.patch(nodemaker, "create_from_cap", create_from_cap)
+
+        children = node._unpack_contents(known_tree)
+        self.failUnlessEqual(created, [])
+        self.failUnless(children.has_key(u"file2"))
+        self.failIf(children.has_key(u"file4"))
+        self.failUnless(children.get(u"file2"))
+        self.failUnlessEqual(len(created), 1)
+        # repacking copies the packed entries, without creating the
+        # children that were never looked at
+        self.failUnlessReallyEqual(node._pack_contents(children), known_tree)
+        self.failUnlessEqual(len(created), 1)
+
+        del created[:]
+        children = node._unpack_contents(known_tree)
+        del children[u"file1"]
+        child, metadata = children[u"file3"]
+        children[u"file3"] = (child, {"new": "metadata"})
+        self.failUnlessEqual(len(created), 2)
+        packed = node._pack_contents(children)
+        self.failUnlessEqual(len(created), 2)
+
+        # the result should be the same as if everything had been unpacked
+        del created[:]
+        children = node._unpack_contents(known_tree).materialize_all()
+        self.failUnlessEqual(len(created), 3)
+        del children[u"file1"]
+        children[u"file3"] = (children[u"file3"][0], {"new": "metadata"})
+        self.failUnlessReallyEqual(node._pack_contents(children), packed)
+        self._check_children(node._unpack_contents(known_tree))
+
+    def test_lazy_children_dict_api(self):
+        # every way of getting at the values creates the children, and
+        # unusable entries never show up
+        made = []
+        def unpack_entry(name, entry):
+            made.append(name)
+            if entry == "bad":
+                return None
+            return (entry, {})
+        def make():
+            children = dirnode.LazyChildren(unpack_entry)
+            for name in (u"a", u"b", u"bad"):
+                children.set_packed(name, name == u"bad" and "bad" or "node-"+name)
+            return children
+        expected = {u"a": ("node-a", {}), u"b": ("node-b", {})}
+
+        children = make()
+        self.failUnlessEqual(children[u"a"], ("node-a", {}))
+        self.failUnlessEqual(made, [u"a"])
+        self.failIf(u"bad" in children)
+        self.failUnlessEqual(children.get(u"bad", "missing"), "missing")
+        self.failUnlessRaises(KeyError, lambda: children[u"bad"])
+
+        for view in (lambda c: dict(c), lambda c: c.copy(),
+                     lambda c: dict(c.items()), lambda c: dict(c.iteritems())):
+            self.failUnlessEqual(view(make()), expected)
+        self.failUnlessEqual(sorted(make().keys()), [u"a", u"b"])
+        self.failUnlessEqual(sorted(make()), [u"a", u"b"])
+        self.failUnlessEqual(len(make()), 2)
+        self.failUnlessEqual(sorted(make().values()), sorted(expected.values()))
+        self.failUnlessEqual(make(), expected)
+
+        d = {}
+        d.update(make())
+        self.failUnlessEqual(d, expected)
+        children = make()
+        self.failUnlessEqual(children.pop(u"b"), ("node-b", {}))
+        self.failUnlessEqual(children.setdefault(u"a", None), ("node-a", {}))
+        self.failUnlessEqual(children.popitem(), (u"a", ("node-a", {})))
+        self.failUnlessEqual(len(children), 0)
+
+        # a copy keeps the packed entries, for repacking
+        children = make()
+        self.failUnlessEqual(children.copy().get_aux(u"a"), "node-a")
+
     def _check_children(self, children):
         # Are all the expected child nodes there?
         self.failUnless(children.has_key(u'file1'))
@@ -1793,6 +1886,107 @@ class DeepStats(testutil.ReallyEqualMixin, unittest.TestCase):
                                      (3162277660169L, 10000000000000L, 1),
                                      ])
 
+class SpillingStack(unittest.TestCase):
+    def test_spill(self):
+        s = dirnode._SpillingStack(4)
+        for i in range(10):
+            s.push(["URI:CHK:%d" % i, None, [u"dir%d" % i]])
+        self.failUnlessEqual(len(s), 10)
+        self.failUnless(s._spilled)
+        self.failUnless(len(s._items) <= 4)
+        popped = [s.pop() for i in range(3)]
+        for i in range(10, 20):
+            s.push(["URI:CHK:%d" % i, None, [u"dir%d" % i]])
+        while len(s):
+            popped.append(s.pop())
+        s.close()
+        expected = range(9, 6, -1) + range(19, 9, -1) + range(6, -1, -1)
+        self.failUnlessEqual([p[0] for p in popped],
+                             ["URI:CHK:%d" % i for i in expected])
+        self.failUnlessEqual(popped[-1], [u"URI:CHK:0", None, [u"dir0"]])
+
+class Traversal(GridTestMixin, testutil.ShouldFailMixin, unittest.TestCase):
+    timeout = 240
+
+    def test_bounded(self):
+        self.basedir = "dirnode/Traversal/test_bounded"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        nm = c.nodemaker
+        self.patch(dirnode.DeepTraversal, "MAX_DIRECTORY_READS", 2)
+        self.patch(dirnode.DeepTraversal, "MAX_NODE_OPERATIONS", 3)
+        self.patch(dirnode.DeepTraversal, "MAX_QUEUED_DIRECTORIES", 2)
+        self.expected = set([()])
+        def _populate(dn, path, depth):
+            kids = {}
+            for i in range(4):
+                name = u"file%d" % i
+                kids[name] = (nm.create_from_cap(make_chk_file_uri(1000+len(self.expected))), {})
+                self.expected.add(path + (name,))
+            d = dn.set_nodes(kids)
+            if depth:
+                for i in range(3):
+                    name = u"dir%d" % i
+                    self.expected.add(path + (name,))
+                    d.addCallback(lambda ign, name=name: dn.create_subdirectory(name))
+                    d.addCallback(_populate, path + (name,), depth-1)
+            return d
+        d = c.create_dirnode()
+        def _created(root):
+            self.root = root
+            return _populate(root, (), 2)
+        d.addCallback(_created)
+        def _walk(ign):
+            # a walker whose operations take a few turns, so that they overlap
+            walker = dirnode.ManifestWalker(self.root)
+            self.outstanding = 0
+            self.max_outstanding = 0
+            original_add_node = walker.add_node
+            def add_node(node, path):
+                self.outstanding += 1
+                self.max_outstanding = max(self.max_outstanding, self.outstanding)
+                d = fireEventually()
+                d.addCallback(fireEventually)
+                def _done(ign):
+                    self.outstanding -= 1
+                    return original_add_node(node, path)
+                d.addCallback(_done)
+                return d
+            walker.add_node = add_node
+            return self.root.deep_traverse(walker).when_done()
+        d.addCallback(_walk)
+        def _check(res):
+            paths = set([tuple(path) for (path, cap) in res["manifest"]])
+            self.failUnlessEqual(paths, self.expected)
+            self.failUnlessEqual(len(res["manifest"]), len(self.expected))
+            self.failUnless(1 < self.max_outstanding <= 3, self.max_outstanding)
+            self.failUnlessEqual(res["stats"]["count-directories"], 13)
+        d.addCallback(_check)
+        return d
+
+    def test_cancel(self):
+        self.basedir = "dirnode/Traversal/test_cancel"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        nm = c.nodemaker
+        kids = dict([(u"file%d" % i,
+                      (nm.create_from_cap(make_chk_file_uri(1000+i)), {}))
+                     for i in range(20)])
+        d = c.create_dirnode(kids)
+        def _created(root):
+            walker = dirnode.ManifestWalker(root)
+            original_add_node = walker.add_node
+            def add_node(node, path):
+                if len(path) == 1 and path[0] == u"file5":
+                    self.monitor.cancel()
+                return original_add_node(node, path)
+            walker.add_node = add_node
+            self.monitor = root.deep_traverse(walker)
+            return self.shouldFail(OperationCancelledError, "cancel", None,
+                                   self.monitor.when_done)
+        d.addCallback(_created)
+        return d
+
 class UCWEingMutableFileNode(MutableFileNode):
     please_ucwe_after_next_upload = False
 
@@ -1855,6 +2049,40 @@ class Deleter(GridTestMixin, testutil.ReallyEqualMixin, unittest.TestCase):
 
 class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
+    def test_burst(self):
+        # changes that are requested together should be published together
+        self.basedir = "dirnode/Adder/test_burst"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        filenodes = [c.nodemaker.create_from_cap(make_chk_file_uri(1000+i))
+                     for i in range(10)]
+        d = c.create_dirnode()
+        def _created(dn):
+            self.dn = dn
+            self.publishes = []
+            original = Publish.publish
+            def publish(p, newdata):
+                self.publishes.append(newdata)
+                return original(p, newdata)
+            self.patch(Publish, "publish", publish)
+            ds = [dn.set_node(u"file%d" % i, filenodes[i]) for i in range(10)]
+            ds.append(self.shouldFail(NoSuchChildError, "delete", "missing",
+                                      dn.delete, u"missing"))
+            ds.append(dn.delete(u"file3"))
+            return defer.gatherResults(ds)
+        d.addCallback(_created)
+        def _check(res):
+            self.failUnlessEqual(res[:10], filenodes)
+            self.failUnlessEqual(res[11].get_uri(), filenodes[3].get_uri())
+            self.failUnlessEqual(len(self.publishes), 1)
+            return self.dn.list()
+        d.addCallback(_check)
+        d.addCallback(lambda children:
+                      self.failUnlessEqual(sorted(children.keys()),
+                                           [u"file%d" % i for i in range(10)
+                                            if i != 3]))
+        return d
+
     def test_overwrite(self):
         # note: This functionality could be tested without actually creating
         # several RSA keys. It would be faster without the GridTestMixin: use
@@ -1917,3 +2145,180 @@ class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
         d.addCallback(_test_adder)
         return d
+
+class Sharded(GridTestMixin, testutil.ShouldFailMixin, unittest.TestCase):
+    timeout = 240
+
+    def _shard_of(self, name):
+        return self.shards[dirnode.shard_for_name(name, len(self.shards))]
+
+    def test_basic(self):
+        self.basedir = "dirnode/Sharded/test_basic"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        nm = c.nodemaker
+        filenodes = [nm.create_from_cap(make_chk_file_uri(1000+i))
+                     for i in range(10)]
+        kids = {u"initial": (filenodes[0], {})}
+        d = c.create_dirnode(kids, shards=3)
+        def _created(dn):
+            self.dn = dn
+            self.failUnlessIsInstance(dn, dirnode.ShardedDirectoryNode)
+            self.failUnless(dn.get_uri().startswith("URI:DIR2-SHARDED:"))
+            self.failUnless(dn.get_readonly_uri().startswith("URI:DIR2-SHARDED-RO:"))
+            self.failUnless(dn.is_mutable())
+            self.failIf(dn.is_readonly())
+            return dn._get_shards()
+        d.addCallback(_created)
+        def _got_shards(shards):
+            self.shards = shards
+            self.failUnlessEqual(len(shards), 3)
+            for shard in shards:
+                self.failUnless(shard.is_mutable())
+                self.failIf(shard.is_readonly())
+            return self._shard_of(u"initial").list()
+        d.addCallback(_got_shards)
+        d.addCallback(lambda children:
+                      self.failUnlessEqual(children.keys(), [u"initial"]))
+        def _add_children(ign):
+            self.published = []
+            original = Publish.publish
+            def publish(p, newdata):
+                self.published.append(p._storage_index)
+                return original(p, newdata)
+            self.patch(Publish, "publish", publish)
+            d = defer.succeed(None)
+            for i in range(1, 10):
+                d.addCallback(lambda ign, i=i:
+                              self.dn.set_node(u"file%d" % i, filenodes[i]))
+            return d
+        d.addCallback(_add_children)
+        def _check_published(ign):
+            # each change rewrote only the shard that holds the child
+            self.failUnlessEqual(self.published,
+                                 [self._shard_of(u"file%d" % i).get_storage_index()
+                                  for i in range(1, 10)])
+            return self.dn.list()
+        d.addCallback(_check_published)
+        def _check_list(children):
+            self.failUnlessEqual(sorted(children.keys()),
+                                 [u"file%d" % i for i in range(1, 10)] + [u"initial"])
+            self.failUnlessEqual(children[u"file4"][0].get_uri(),
+                                 filenodes[4].get_uri())
+        d.addCallback(_check_list)
+        d.addCallback(lambda ign: self.dn.get(u"file5"))
+        d.addCallback(lambda child:
+                      self.failUnlessEqual(child.get_uri(), filenodes[5].get_uri()))
+        d.addCallback(lambda ign: self.dn.has_child(u"file6"))
+        d.addCallback(self.failUnless)
+        d.addCallback(lambda ign: self.dn.has_child(u"missing"))
+        d.addCallback(self.failIf)
+        d.addCallback(lambda ign:
+                      self.shouldFail(NoSuchChildError, "get missing", "missing",
+                                      self.dn.get, u"missing"))
+        d.addCallback(lambda ign:
+                      self.shouldFail(ExistingChildError, "set_node", "file1",
+                                      self.dn.set_node, u"file1", filenodes[0],
+                                      overwrite=False))
+        d.addCallback(lambda ign: self.dn.delete(u"file1"))
+        d.addCallback(lambda old_child:
+                      self.failUnlessEqual(old_child.get_uri(), filenodes[1].get_uri()))
+        d.addCallback(lambda ign: self.dn.set_metadata_for(u"file2", {"key": "value"}))
+        d.addCallback(lambda ign: self.dn.get_metadata_for(u"file2"))
+        d.addCallback(lambda md: self.failUnlessEqual(md["key"], "value"))
+        d.addCallback(lambda ign: self.dn.move_child_to(u"file2", self.dn, u"moved"))
+        d.addCallback(lambda ign: self.dn.create_subdirectory(u"subdir"))
+        d.addCallback(lambda ign:
+                      self.dn.set_children({u"a": (filenodes[0].get_uri(), None),
+                                            u"b": (filenodes[1].get_uri(), None),
+                                            u"c": (filenodes[2].get_uri(), None)}))
+        d.addCallback(lambda ign: self.dn.list())
+        d.addCallback(lambda children:
+                      self.failUnlessEqual(sorted(children.keys()),
+                                           [u"a", u"b", u"c"] +
+                                           [u"file%d" % i for i in range(3, 10)] +
+                                           [u"initial", u"moved", u"subdir"]))
+
+        def _readonly(ign):
+            ro = nm.create_from_cap(self.dn.get_readonly_uri())
+            self.failUnlessIsInstance(ro, dirnode.ShardedDirectoryNode)
+            self.failUnless(ro.is_readonly())
+            d = ro.list()
+            def _check_ro(children):
+                self.failUnlessEqual(len(children), 13)
+                self.failUnless(children[u"subdir"][0].is_readonly())
+                return self.shouldFail(dirnode.NotWriteableError, "set_node ro", None,
+                                       ro.set_node, u"new", filenodes[0])
+            d.addCallback(_check_ro)
+            d.addCallback(lambda ign:
+                          self.shouldFail(dirnode.NotWriteableError, "delete ro", None,
+                                          ro.delete, u"a"))
+            return d
+        d.addCallback(_readonly)
+        return d
+
+    def test_deep_check(self):
+        self.basedir = "dirnode/Sharded/test_deep_check"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        d = c.create_dirnode(shards=2)
+        def _created(dn):
+            self.dn = dn
+            return dn.create_subdirectory(u"subdir")
+        d.addCallback(_created)
+        d.addCallback(lambda ign: self.dn.start_deep_check().when_done())
+        def _check(res):
+            c = res.get_counters()
+            self.failUnlessEqual(c["count-objects-checked"], 2)
+            self.failUnlessEqual(c["count-objects-healthy"], 2)
+        d.addCallback(_check)
+        d.addCallback(lambda ign: self.dn.build_manifest().when_done())
+        def _check_manifest(res):
+            shards = self.dn.get_known_shards()
+            self.failUnlessEqual(len(shards), 2)
+            self.failUnlessEqual(len(res["manifest"]), 2)
+            sis = [self.dn.get_storage_index()] + \
+                  [s.get_storage_index() for s in shards]
+            for si in sis:
+                self.failUnlessIn(base32.b2a(si), res["storage-index"])
+            for shard in shards:
+                self.failUnlessIn(shard.get_verify_cap().to_string(),
+                                  res["verifycaps"])
+            # the root's size includes its shards
+            self.failUnlessEqual(res["stats"]["largest-directory"],
+                                 self.dn.get_size() +
+                                 sum([s.get_size() for s in shards]))
+        d.addCallback(_check_manifest)
+        def _damage_shard(ign):
+            shards = self.dn.get_known_shards()
+            d = self.delete_shares_numbered(shards[1].get_uri(), range(5, 10))
+            d.addCallback(lambda ign: self.dn.check(Monitor()))
+            return d
+        d.addCallback(_damage_shard)
+        def _check_damaged(cr):
+            self.failIf(cr.is_healthy())
+            self.failUnless(cr.is_recoverable())
+            # the results are for the directory, and say which shard failed
+            self.failUnlessEqual(cr.get_storage_index(),
+                                 self.dn.get_storage_index())
+            self.failUnlessEqual(cr.get_uri(), self.dn._uri)
+            shard_si = base32.b2a(self.dn.get_known_shards()[1].get_storage_index())
+            self.failUnless(cr.get_summary().startswith("shard 1: "),
+                            cr.get_summary())
+            self.failUnlessIn("shard 1 (SI %s): " % shard_si,
+                              "\n".join(cr.get_report()))
+            self.failUnlessEqual(cr.get_share_counter_good(), 5)
+            return self.dn.check_and_repair(Monitor())
+        d.addCallback(_check_damaged)
+        def _check_repaired(crr):
+            self.failUnlessEqual(crr.get_storage_index(),
+                                 self.dn.get_storage_index())
+            pre = crr.get_pre_repair_results()
+            self.failUnlessEqual(pre.get_storage_index(),
+                                 self.dn.get_storage_index())
+            self.failIf(pre.is_healthy())
+            self.failUnless(crr.get_repair_attempted())
+            self.failUnless(crr.get_repair_successful())
+            self.failUnless(crr.get_post_repair_results().is_healthy())
+        d.addCallback(_check_repaired)
+        return d
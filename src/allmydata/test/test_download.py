@@ -7,6 +7,7 @@ import os
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 from allmydata.util.deferredutil import async_iterate
 
@@ -15,6 +16,7 @@ from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
 from allmydata.test.no_network import GridTestMixin, NoNetworkServer
+from allmydata.storage_client import ServerPerformance
 from allmydata.test.common import ShouldFailMixin
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
      DownloadStopped
@@ -22,6 +24,7 @@ from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.share import Share
 from allmydata.codec import CRSDecoder
 
 
@@ -597,6 +600,85 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def _count_share_requests(self):
+        calls = {"read": 0, "readv": 0}
+        def _counting(methname, orig):
+            def _send(share, *args):
+                calls[methname] += 1
+                return orig(share, *args)
+            return _send
+        self.patch(Share, "_send_request",
+                   _counting("read", Share._send_request.im_func))
+        self.patch(Share, "_send_readv",
+                   _counting("readv", Share._send_readv.im_func))
+        return calls
+
+    def _download_multiple_segments(self, calls):
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            n._cnode._maybe_create_download_node()
+            n._cnode._node._build_guessed_tables(u.max_segment_size)
+            calls["read"] = calls["readv"] = 0
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+        d.addCallback(_got_data)
+        return d
+
+    def test_download_coalesced(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        calls = self._count_share_requests()
+
+        # the block, block hashes, and ciphertext hashes for each segment
+        # are close together in such a small share, so each segment should
+        # cost at most a single read() per share: 5 segments * 3 shares
+        d = self._download_multiple_segments(calls)
+        def _check(ign):
+            self.failUnlessEqual(calls["readv"], 0, calls)
+            self.failUnless(0 < calls["read"] <= 15, calls)
+        d.addCallback(_check)
+        return d
+
+    def test_download_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.patch(Share, "READ_COALESCE_GAP", 0)
+        calls = self._count_share_requests()
+
+        # without coalescing, the spans for each segment are separate, and
+        # should be fetched together with readv()
+        d = self._download_multiple_segments(calls)
+        d.addCallback(lambda ign: self.failUnless(calls["readv"] > 0, calls))
+        return d
+
+    def test_download_no_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.patch(Share, "READ_COALESCE_GAP", 0)
+        calls = self._count_share_requests()
+
+        # pretend the servers are too old to offer RIBucketReader.readv, so
+        # we fall back to one read() per span
+        for s in self.c0.storage_broker.get_connected_servers():
+            rref = s.get_rref()
+            v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["has-immutable-readv"] = False
+
+        d = self._download_multiple_segments(calls)
+        def _check(ign):
+            self.failUnlessEqual(calls["readv"], 0)
+            self.failUnless(calls["read"] > 15, calls)
+        d.addCallback(_check)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -1304,6 +1386,7 @@ class FakeNode:
         self.failed = None
         self.processed = None
         self._si_prefix = "si_prefix"
+        self.block_size = None
     def want_more_shares(self):
         self.want_more += 1
     def fetch_failed(self, fetcher, f):
@@ -1619,3 +1702,64 @@ class Selection(unittest.TestCase):
                                                       2: "block-2"}) )
         d.addCallback(_check4)
         return d
+
+    def test_prefer_fast_servers(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None)
+        servers = make_servers(["peer-A", "peer-B", "peer-C", "peer-D"])
+        # peer-A answered DYHB first, but has been slow to deliver blocks
+        servers["peer-A"].get_performance().record_rtt(5.0)
+        servers["peer-B"].get_performance().record_rtt(0.1)
+        servers["peer-C"].get_performance().record_rtt(0.2)
+        shares = [MyShare(0, servers["peer-A"], 0.0),
+                  MyShare(1, servers["peer-B"], 1.0),
+                  MyShare(2, servers["peer-C"], 2.0),
+                  MyShare(3, servers["peer-D"], 3.0), # no history
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[2], shares[3]])
+            for sh in sf._test_start_shares:
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(node.processed, (0, {1: "block-1",
+                                                      2: "block-2",
+                                                      3: "block-3"}) )
+        d.addCallback(_check2)
+        return d
+
+    def test_hedge_late_request(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None)
+        self.patch(sf, "MIN_HEDGE_DELAY", 0.0)
+        servers = make_servers(["peer-%d" % i for i in range(4)])
+        # peer-0 usually answers within 10ms
+        for i in range(ServerPerformance.MIN_SAMPLES):
+            servers["peer-0"].get_performance().record_rtt(0.01)
+        shares = [MyShare(i, servers["peer-%d" % i], i) for i in range(4)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares[:3])
+            sf._block_request_activity(shares[1], 1, COMPLETE, "block-1")
+            sf._block_request_activity(shares[2], 2, COMPLETE, "block-2")
+            # sh0 never answers, so it should be hedged with sh3
+            return deferLater(reactor, 0.1, flushEventualQueue)
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares)
+            self.failUnlessEqual(sf._hedge_timers, {})
+            sf._block_request_activity(shares[3], 3, COMPLETE, "block-3")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(node.processed, (0, {1: "block-1",
+                                                      2: "block-2",
+                                                      3: "block-3"}) )
+        d.addCallback(_check3)
+        return d
@@ -15,6 +15,7 @@ from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable.upload import Data
 from allmydata.immutable.downloader import finder
+from allmydata.storage_client import ServerPerformance
 
 
 class MockShareHashTree(object):
@@ -118,6 +119,10 @@ class TestShareFinder(unittest.TestCase):
                 return "name-%s" % self.serverid
             def get_version(self):
                 return self.rref.version
+            def get_performance(self):
+                return ServerPerformance()
+            def get_buckets(self, storage_index):
+                return self.rref.callRemote("get_buckets", storage_index)
 
         class MockStorageBroker(object):
             def __init__(self, servers):
@@ -26,11 +26,12 @@ from allmydata.mutable.filenode import MutableFileNode, BackoffAgent
 from allmydata.mutable.common import \
      MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ, \
      NeedMoreDataError, UnrecoverableFileError, UncoordinatedWriteError, \
-     NotEnoughServersError, CorruptShareError
+     NotEnoughServersError, CorruptShareError, VerificationCache, ShareSizeHints
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.publish import Publish, MutableFileHandle, \
                                       MutableData, \
                                       DEFAULT_MAX_SEGMENT_SIZE
+from allmydata.mutable import servermap
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
 from allmydata.mutable.layout import unpack_header, MDMFSlotReadProxy
 from allmydata.mutable.repairer import MustForceRepairError
@@ -524,6 +525,38 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin, WaitForDelayedCallsM
         d.addCallback(self._test_retrieve_producer, "MDMF", data)
         return d
 
+    def test_retrieve_pipelined_mdmf(self):
+        # Retrieve should have blocks of several segments in flight at once,
+        # and still deliver them in order, including when it is paused
+        data = "contents1" * 100000 # 7 segments
+        outstanding = set()
+        segments_in_flight = []
+        original = MDMFSlotReadProxy.get_block_and_salt
+        def get_block_and_salt(reader, segnum):
+            outstanding.add((reader.shnum, segnum))
+            segments_in_flight.append(len(set([s for (sh, s) in outstanding])))
+            d = original(reader, segnum)
+            def _fetched(res):
+                outstanding.discard((reader.shnum, segnum))
+                return res
+            d.addBoth(_fetched)
+            return d
+        self.patch(MDMFSlotReadProxy, "get_block_and_salt", get_block_and_salt)
+        d = self.nodemaker.create_mutable_file(MutableData(data),
+                                               version=MDMF_VERSION)
+        d.addCallback(lambda node: node.get_best_mutable_version())
+        def _read(version):
+            c = PausingConsumer()
+            d2 = version.read(c)
+            d2.addCallback(lambda ign:
+                           self.failUnlessEqual("".join(c.chunks), data))
+            return d2
+        d.addCallback(_read)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(max(segments_in_flight),
+                                           Retrieve.PIPELINE_DEPTH))
+        return d
+
     # note: SDMF has only one big segment, so we can't use the usual
     # after-the-first-write() trick to pause or stop the download.
     # Disabled until we find a better approach.
@@ -847,6 +880,61 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin, WaitForDelayedCallsM
         d.addBoth(self.wait_for_delayed_calls)
         return d
 
+    def test_modify_coalesced(self):
+        # modifiers that are queued together should be applied by a single
+        # publish, and each should get its own result
+        publishes = []
+        original = Publish.publish
+        def publish(p, newdata):
+            publishes.append(newdata.get_size())
+            return original(p, newdata)
+        self.patch(Publish, "publish", publish)
+        def _appender(s):
+            def _modifier(old_contents, servermap, first_time):
+                return old_contents + s
+            return _modifier
+        def _error_modifier(old_contents, servermap, first_time):
+            raise ValueError("oops")
+
+        d = self.nodemaker.create_mutable_file(MutableData("line1"))
+        def _created(n):
+            del publishes[:]
+            ds = [n.modify(_appender("a")),
+                  n.modify(_error_modifier),
+                  n.modify(_appender("b")),
+                  n.modify(_appender("c"))]
+            ds[1] = self.shouldFail(ValueError, "error_modifier", "oops",
+                                    lambda: ds[1])
+            d = defer.gatherResults(ds)
+            d.addCallback(lambda res: self.failUnlessEqual(publishes, [8]))
+            d.addCallback(lambda res: n.download_best_version())
+            d.addCallback(lambda res: self.failUnlessEqual(res, "line1abc"))
+            d.addCallback(lambda res: self.failUnlessCurrentSeqnumIs(n, 2, "m"))
+            return d
+        d.addCallback(_created)
+        return d
+
+    def test_modify_coalesced_keeps_order(self):
+        # a modify() queued after an overwrite() must not join the batch
+        # that was queued before it, or the overwrite would clobber it
+        def _appender(s):
+            def _modifier(old_contents, servermap, first_time):
+                return old_contents + s
+            return _modifier
+
+        d = self.nodemaker.create_mutable_file(MutableData("line1"))
+        def _created(n):
+            ds = [n.modify(_appender("a")),
+                  n.overwrite(MutableData("line2")),
+                  n.modify(_appender("b"))]
+            d = defer.gatherResults(ds)
+            d.addCallback(lambda res: n.download_best_version())
+            d.addCallback(lambda res: self.failUnlessEqual(res, "line2b"))
+            d.addCallback(lambda res: self.failUnlessCurrentSeqnumIs(n, 4, "m"))
+            return d
+        d.addCallback(_created)
+        return d
+
     def test_upload_and_download_full_size_keys(self):
         self.nodemaker.key_generator = client.KeyGenerator()
         d = self.nodemaker.create_mutable_file()
@@ -1053,6 +1141,11 @@ class Servermap(unittest.TestCase, PublishMixin):
 
         d.addCallback(lambda res: ms(mode=MODE_CHECK))
         d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 10))
+        def _check_performance(ign):
+            # every server was queried, and its response time recorded
+            for server in self._storage_broker.get_connected_servers():
+                self.failIfEqual(server.get_performance().rtt, None)
+        d.addCallback(_check_performance)
         d.addCallback(lambda res: ms(mode=MODE_WRITE))
         d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 10))
         d.addCallback(lambda res: ms(mode=MODE_READ))
@@ -1098,6 +1191,61 @@ class Servermap(unittest.TestCase, PublishMixin):
         return d
 
 
+    def test_verification_cache(self):
+        # a second mapupdate of an unchanged file, even through a fresh
+        # filenode, should not need any public-key operations
+        self.patch(servermap, "verification_cache", VerificationCache())
+        calls = {"deserialize": 0, "verify": 0}
+        class CountingVerifier:
+            def __init__(self, verifier):
+                self._verifier = verifier
+            def verify(self, msg, signature):
+                calls["verify"] += 1
+                return self._verifier.verify(msg, signature)
+        original = ServermapUpdater._deserialize_pubkey
+        def _deserialize_pubkey(updater, pubkey_s):
+            calls["deserialize"] += 1
+            return CountingVerifier(original(updater, pubkey_s))
+        self.patch(ServermapUpdater, "_deserialize_pubkey", _deserialize_pubkey)
+
+        def _fresh_node():
+            return self._nodemaker.create_from_cap(self._fn.get_uri())
+        d = self.make_servermap(MODE_READ, _fresh_node())
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 6))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(calls, {"deserialize": 1,
+                                                   "verify": 1}))
+        d.addCallback(lambda ign: self.make_servermap(MODE_CHECK,
+                                                      _fresh_node()))
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 10))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(calls, {"deserialize": 1,
+                                                   "verify": 1}))
+        return d
+
+    def test_verification_cache_bounded(self):
+        c = VerificationCache(max_entries=2)
+        for i in range(3):
+            c.add_verified("si", "fp", ("verinfo", i), "sig")
+        self.failIf(c.is_verified("si", "fp", ("verinfo", 0), "sig"))
+        self.failIf(c.is_verified("si", "fp", ("verinfo", 2), "other sig"))
+        self.failUnless(c.is_verified("si", "fp", ("verinfo", 2), "sig"))
+        self.failUnless(c.is_verified("si", "fp", ("verinfo", 1), "sig"))
+        # lookups refresh an entry, so ("verinfo", 1) survives this one
+        c.add_verified("si", "fp", ("verinfo", 3), "sig")
+        self.failUnless(c.is_verified("si", "fp", ("verinfo", 1), "sig"))
+        self.failIf(c.is_verified("si", "fp", ("verinfo", 2), "sig"))
+
+        parsed = []
+        def _deserialize(pubkey_s):
+            parsed.append(pubkey_s)
+            return "verifier-" + pubkey_s
+        self.failUnlessEqual(c.get_verifier("fp", "key", _deserialize),
+                             "verifier-key")
+        self.failUnlessEqual(c.get_verifier("fp", "key", _deserialize),
+                             "verifier-key")
+        self.failUnlessEqual(parsed, ["key"])
+
     def test_mark_bad(self):
         d = defer.succeed(None)
         ms = self.make_servermap
@@ -1239,6 +1387,71 @@ class Servermap(unittest.TestCase, PublishMixin):
         return d
 
 
+class ServermapFreshness(unittest.TestCase, PublishMixin):
+    def setUp(self):
+        d = self.publish_one()
+        def _count_updates(ign):
+            self.updates = 0
+            original = ServermapUpdater.update
+            def update(updater):
+                self.updates += 1
+                return original(updater)
+            self.patch(ServermapUpdater, "update", update)
+        d.addCallback(_count_updates)
+        return d
+
+    def _download(self, n, expected):
+        d = n.download_best_version()
+        d.addCallback(lambda data: self.failUnlessEqual(data, expected))
+        return d
+
+    def _expire(self, n):
+        n._recent_servermap.set_last_update(MODE_READ, 0)
+
+    def test_disabled(self):
+        n = self._fn2
+        d = self._download(n, self.CONTENTS)
+        d.addCallback(lambda ign: self._download(n, self.CONTENTS))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.updates, 2))
+        return d
+
+    def test_reuse(self):
+        n = self._fn2
+        n.set_servermap_freshness(60)
+        d = self._download(n, self.CONTENTS)
+        d.addCallback(lambda ign: self._download(n, self.CONTENTS))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.updates, 1))
+        # writes through this node must be seen right away
+        d.addCallback(lambda ign: n.overwrite(MutableData("new contents")))
+        d.addCallback(lambda ign: self._download(n, "new contents"))
+        def _check(ign):
+            self.failUnlessEqual(self.updates, 3) # overwrite did MODE_WRITE
+            self._expire(n)
+        d.addCallback(_check)
+        # without revalidation, an expired servermap is simply replaced
+        d.addCallback(lambda ign: self._download(n, "new contents"))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.updates, 4))
+        return d
+
+    def test_revalidate(self):
+        n = self._fn2
+        n.set_servermap_freshness(60, revalidate=True)
+        d = self._download(n, self.CONTENTS)
+        d.addCallback(lambda ign: self._expire(n))
+        d.addCallback(lambda ign: self._download(n, self.CONTENTS))
+        def _revalidated(ign):
+            # no full update was needed, and the servermap is fresh again
+            self.failUnlessEqual(self.updates, 1)
+            self.failUnless(n._recent_servermap.get_last_update()[1] > 0)
+            self._expire(n)
+        d.addCallback(_revalidated)
+        # another node changes the file: revalidation must notice
+        d.addCallback(lambda ign: self._fn.overwrite(MutableData("changed")))
+        d.addCallback(lambda ign: self._download(n, "changed"))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.updates, 3))
+        return d
+
+
 class Roundtrip(unittest.TestCase, testutil.ShouldFailMixin, PublishMixin):
     def setUp(self):
         return self.publish_one()
@@ -1284,6 +1497,48 @@ class Roundtrip(unittest.TestCase, testutil.ShouldFailMixin, PublishMixin):
         return d
 
 
+    def test_speculative_read(self):
+        # once we know how big this file's shares are, a MODE_READ mapupdate
+        # reads them whole, and Retrieve needs no further queries
+        self.patch(servermap, "share_size_hints", ShareSizeHints())
+        share_reads = []
+        original = FakeStorageServer.slot_readv
+        def slot_readv(ss, storage_index, shnums, readv):
+            if shnums: # the mapupdate asks for all shares
+                share_reads.append(shnums)
+            return original(ss, storage_index, shnums, readv)
+        self.patch(FakeStorageServer, "slot_readv", slot_readv)
+        def _download(ign):
+            del share_reads[:]
+            d = self.make_servermap()
+            d.addCallback(self.do_download)
+            d.addCallback(lambda data:
+                          self.failUnlessEqual(data, self.CONTENTS))
+            return d
+        d = _download(None)
+        d.addCallback(lambda ign: self.failUnless(share_reads))
+        d.addCallback(_download)
+        d.addCallback(lambda ign: self.failUnlessEqual(share_reads, []))
+        return d
+
+    def test_share_size_hints(self):
+        h = ShareSizeHints(max_entries=2, max_read_size=20000)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 4000)
+        h.observe("si1", 2000)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 4000)
+        h.observe("si1", 10000)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 11000)
+        h.observe("si1", 19900)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 20000)
+        # shares that are too big to read speculatively are forgotten
+        h.observe("si1", 50000)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 4000)
+        h.observe("si1", 10000)
+        h.observe("si2", 10000)
+        h.observe("si3", 10000)
+        self.failUnlessEqual(h.get_read_size("si1", 4000), 4000)
+        self.failUnlessEqual(h.get_read_size("si3", 4000), 11000)
+
     def test_basic(self):
         d = self.make_servermap()
         def _do_retrieve(servermap):
@@ -3584,6 +3839,72 @@ class Update(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
         # what we expect.
         return self._test_replace(len(self.data), "appended")
 
+    def _count_update_fetches(self):
+        # count the block hash trees that updates fetch from the grid
+        fetches = []
+        original = MDMFSlotReadProxy.get_blockhashes
+        def get_blockhashes(reader, *args, **kwargs):
+            fetches.append(reader.shnum)
+            return original(reader, *args, **kwargs)
+        self.patch(MDMFSlotReadProxy, "get_blockhashes", get_blockhashes)
+        return fetches
+
+    def test_append_uses_update_data(self):
+        # appending to a version that this node published should not need
+        # to fetch its block hash trees or boundary segments again
+        fetches = self._count_update_fetches()
+        expected = self.data
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            d = defer.succeed(None)
+            for new_data in ("appended", "A" * 1000, "B" * 200000):
+                d.addCallback(lambda ign: self.mdmf_node.get_best_mutable_version())
+                d.addCallback(lambda mv, new_data=new_data:
+                              mv.update(MutableData(new_data), mv.get_size()))
+            return d
+        d0.addCallback(_run)
+        d0.addCallback(lambda ign: self.failUnlessEqual(fetches, []))
+        d0.addCallback(lambda ign: self.mdmf_node.download_best_version())
+        expected += "appended" + "A" * 1000 + "B" * 200000
+        d0.addCallback(self._check_differences, expected)
+        return d0
+
+    def test_append_without_update_data(self):
+        # a node that did not publish the version it appends to has to
+        # fetch what it needs from the grid
+        fetches = self._count_update_fetches()
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            self.mdmf_node._update_data = None
+            return self.mdmf_node.get_best_mutable_version()
+        d0.addCallback(_run)
+        d0.addCallback(lambda mv:
+                       mv.update(MutableData("appended"), len(self.data)))
+        d0.addCallback(lambda ign: self.failIfEqual(fetches, []))
+        d0.addCallback(lambda ign: self.mdmf_node.download_best_version())
+        d0.addCallback(self._check_differences, self.data + "appended")
+        return d0
+
+    def test_append_after_other_writer(self):
+        # if someone else has modified the file since we published it, the
+        # data we kept is stale, and the append must not use it
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            # a separate node for the same file, as another client would
+            # have. do_upload_mdmf left 255 shares as the default.
+            self.nm.default_encoding_parameters['n'] = 10
+            self.nm.default_encoding_parameters['k'] = 3
+            other = self.nm._create_mutable(self.mdmf_node.get_cap())
+            return other.overwrite(MutableData("other " * 50000))
+        d0.addCallback(_run)
+        d0.addCallback(lambda ign: self.mdmf_node.get_best_mutable_version())
+        d0.addCallback(lambda mv:
+                       mv.update(MutableData("appended"), mv.get_size()))
+        d0.addCallback(lambda ign: self.mdmf_node.download_best_version())
+        d0.addCallback(self._check_differences,
+                       "other " * 50000 + "appended")
+        return d0
+
     def test_replace_middle(self):
         # We should be able to replace data in the middle of a mutable
         # file and get what we expect back.
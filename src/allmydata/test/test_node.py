@@ -112,6 +112,23 @@ class TestCase(testutil.SignalMixin, unittest.TestCase):
         n = TestNode(basedir)
         self.failUnless(n.nickname == nickname)
 
+    def test_tempdir_encrypt(self):
+        basedir = "test_node/test_tempdir_encrypt"
+        fileutil.make_dirs(basedir)
+        self.patch(fileutil, "encrypt_temporary_files", True)
+
+        TestNode(basedir)
+        self.failUnless(fileutil.encrypt_temporary_files)
+        self.failUnless(fileutil.EncryptedTemporaryFile().key)
+
+        f = open(os.path.join(basedir, 'tahoe.cfg'), 'wt')
+        f.write("[node]\n")
+        f.write("tempdir.encrypt = false\n")
+        f.close()
+        TestNode(basedir)
+        self.failIf(fileutil.encrypt_temporary_files)
+        self.failUnlessEqual(fileutil.EncryptedTemporaryFile().key, None)
+
     def test_private_config(self):
         basedir = "test_node/test_private_config"
         privdir = os.path.join(basedir, "private")
@@ -1,5 +1,5 @@
 
-import random
+import random, struct
 
 from twisted.internet import defer
 from twisted.trial import unittest
@@ -9,7 +9,7 @@ from allmydata.monitor import Monitor
 from allmydata import check_results
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.check_results import CheckAndRepairResults
-from allmydata.immutable import upload
+from allmydata.immutable import repairer, upload
 from allmydata.util import fileutil
 from allmydata.util.consumer import download_to_data
 from allmydata.test.no_network import GridTestMixin
@@ -512,6 +512,84 @@ class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
                       self.failUnlessEqual(newdata, common.TEST_DATA))
         return d
 
+    def _get_share_data(self, shares):
+        # the share data, without the container header and leases
+        data = {}
+        for (shnum, serverid, sharefile) in shares:
+            f = fileutil.read(sharefile)
+            (version, length, num_leases) = struct.unpack(">LLL", f[:12])
+            data[shnum] = f[12:12+length]
+        return data
+
+    def test_regenerate_missing_shares(self):
+        """ Repair encodes and pushes only the missing shares, and they come
+        out identical to the ones that were lost. """
+        self.basedir = "repairer/Repairer/regenerate_missing_shares"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ign: self.find_uri_shares(self.uri))
+        def _stash_shares(shares):
+            self.original_data = self._get_share_data(shares)
+        d.addCallback(_stash_shares)
+        d.addCallback(lambda ign: self.delete_shares_numbered(self.uri, [2, 7]))
+        def _repair(ign):
+            cnode = self.c0_filenode._cnode
+            r = repairer.Repairer(cnode, cnode._storage_broker,
+                                  cnode._secret_holder, Monitor())
+            def _reencode():
+                self.fail("should not have re-encoded the whole file")
+            r._reencode = _reencode
+            return r.start()
+        d.addCallback(_repair)
+        def _check_results(ur):
+            self.failUnlessEqual(ur.get_pushed_shares(), 2)
+            self.failUnlessEqual(ur.get_preexisting_shares(), 8)
+            # the whole file was downloaded to regenerate them
+            self.failUnlessEqual(ur.get_ciphertext_fetched(),
+                                 self.c0_filenode.get_size())
+            self.failUnlessEqual(sorted(ur.get_sharemap().keys()), [2, 7])
+            self.failUnlessEqual(ur.get_verifycapstr(),
+                                 self.c0_filenode.get_verify_cap().to_string())
+        d.addCallback(_check_results)
+        d.addCallback(lambda ign: self.find_uri_shares(self.uri))
+        def _check_shares(shares):
+            self.failUnlessEqual(self._get_share_data(shares),
+                                 self.original_data)
+        d.addCallback(_check_shares)
+        return d
+
+    def test_regenerate_fallback(self):
+        """ If the surviving share hash chains can't be used, repair falls
+        back to re-encoding the whole file. """
+        self.basedir = "repairer/Repairer/regenerate_fallback"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ign: self.delete_shares_numbered(self.uri, [2]))
+        # sh3 is the nearest neighbour of sh2 in the share hash tree, so its
+        # chain is the one the repairer reads
+        d.addCallback(lambda ign:
+                      self.corrupt_shares_numbered(self.uri, [3],
+                                                   common._corrupt_share_hashes))
+        def _repair(ign):
+            cnode = self.c0_filenode._cnode
+            r = repairer.Repairer(cnode, cnode._storage_broker,
+                                  cnode._secret_holder, Monitor())
+            self.reencoded = False
+            original_reencode = r._reencode
+            def _reencode():
+                self.reencoded = True
+                return original_reencode()
+            r._reencode = _reencode
+            return r.start()
+        d.addCallback(_repair)
+        d.addCallback(lambda ign: self.failUnless(self.reencoded))
+        d.addCallback(lambda ign: self.delete_shares_numbered(self.uri,
+                                                              range(3, 10)))
+        d.addCallback(lambda ign: download_to_data(self.c1_filenode))
+        d.addCallback(lambda newdata:
+                      self.failUnlessEqual(newdata, common.TEST_DATA))
+        return d
+
     def test_repairer_servers_of_happiness(self):
         # The repairer is supposed to generate and place as many of the
         # missing shares as possible without caring about how they are
@@ -24,7 +24,8 @@ if have_pycrypto:
     from twisted.conch.ssh import filetransfer as sftp
     from allmydata.frontends import sftpd
 
-from allmydata.interfaces import IDirectoryNode, ExistingChildError, NoSuchChildError
+from allmydata.interfaces import IDirectoryNode, ExistingChildError, NoSuchChildError, \
+     MDMF_VERSION
 from allmydata.mutable.common import NotWriteableError
 
 from allmydata.util.consumer import download_to_data
@@ -539,6 +540,87 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_read_random_access(self):
+        d = self._set_up("openFile_read_random_access")
+        d.addCallback(lambda ign: self._set_up_tree())
+        self.patch(sftpd, "READ_BLOCK_SIZE", 100)
+
+        contents = "".join(["%04d," % i for i in range(1000)])
+        d.addCallback(lambda ign: self.root.add_file(u"large", upload.Data(contents, None)))
+        d.addCallback(lambda ign: self.client.create_mutable_file(publish.MutableData(contents),
+                                                                  version=MDMF_VERSION))
+        d.addCallback(lambda node: self.root.set_node(u"mdmf", node))
+
+        def _check_random_access(rf):
+            self.failUnless(isinstance(rf, sftpd.RandomAccessReadOnlySFTPFile), rf)
+
+            d2 = rf.readChunk(0, 10)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[:10]))
+            # only the blocks that were needed (and the one after, since the
+            # first read counts as sequential) should have been fetched
+            d2.addCallback(lambda ign: self.failIf(set(rf._blocks) - set([0, 1]), rf._blocks.keys()))
+
+            d2.addCallback(lambda ign: rf.readChunk(2345, 300))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[2345:2645]))
+
+            d2.addCallback(lambda ign: rf.readChunk(4990, 100))  # read that starts before EOF is OK
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[4990:]))
+            d2.addCallback(lambda ign: rf.readChunk(100, 0))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, ""))
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_EOF, "readChunk starting at EOF",
+                                             rf.readChunk, 5000, 1))
+
+            # read the whole file sequentially, in chunks that do not line up
+            # with the blocks
+            chunks = []
+            def _read_sequentially(offset):
+                if offset >= len(contents):
+                    return
+                d3 = rf.readChunk(offset, 37)
+                d3.addCallback(chunks.append)
+                d3.addCallback(lambda ign: _read_sequentially(offset + 37))
+                return d3
+            d2.addCallback(lambda ign: _read_sequentially(0))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual("".join(chunks), contents))
+            d2.addCallback(lambda ign: self.failUnless(len(rf._blocks) <= sftpd.READ_CACHE_BLOCKS, rf._blocks.keys()))
+
+            d2.addCallback(lambda ign: rf.getAttrs())
+            d2.addCallback(lambda attrs: self._compareAttributes(attrs, {'permissions': S_IFREG | 0666, 'size': 5000}))
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_PERMISSION_DENIED, "writeChunk on read-only handle denied",
+                                             rf.writeChunk, 0, "a"))
+
+            d2.addCallback(lambda ign: rf.close())
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_BAD_MESSAGE, "readChunk on closed file",
+                                             rf.readChunk, 0, 1))
+            return d2
+
+        d.addCallback(lambda ign: self.handler.openFile("large", sftp.FXF_READ, {}))
+        d.addCallback(_check_random_access)
+        d.addCallback(lambda ign: self.handler.openFile("mdmf", sftp.FXF_READ, {}))
+        d.addCallback(_check_random_access)
+
+        # SDMF files and files opened for writing still use a GeneralSFTPFile
+        d.addCallback(lambda ign: self.handler.openFile("mutable", sftp.FXF_READ, {}))
+        def _check_sdmf(rf):
+            self.failUnless(isinstance(rf, sftpd.GeneralSFTPFile), rf)
+            return rf.close()
+        d.addCallback(_check_sdmf)
+        d.addCallback(lambda ign: self.handler.openFile("large", sftp.FXF_READ | sftp.FXF_WRITE, {}))
+        def _check_write(wf):
+            self.failUnless(isinstance(wf, sftpd.GeneralSFTPFile), wf)
+            d2 = wf.readChunk(2345, 10)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, contents[2345:2355]))
+            d2.addCallback(lambda ign: wf.close())
+            return d2
+        d.addCallback(_check_write)
+
+        d.addCallback(lambda ign: self.failUnlessEqual(sftpd.all_heisenfiles, {}))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
+        return d
+
     def test_openFile_read_error(self):
         # The check at the end of openFile_read tested this for large files,
         # but it trashed the grid in the process, so this needs to be a
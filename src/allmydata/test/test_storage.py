@@ -1739,7 +1739,45 @@ class ServerTest(ServerMixin, ShouldFailMixin):
         sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
         self.failUnless(sv1.get('has-immutable-readv'), sv1)
 
-        # TODO: test that we actually support it
+        d = self.allocate(aa, "si1", [0], 25)
+        d.addCallback(lambda (already, writers):
+                      for_items(self._write_and_close, writers))
+        d.addCallback(lambda ign: aa.remote_get_buckets("si1"))
+        def _got_buckets(bs):
+            self.failUnlessEqual(set(bs.keys()), set([0]))
+            return bs[0].remote_readv([(0, 5), (20, 5), (10, 3), (24, 10), (30, 1)])
+        d.addCallback(_got_buckets)
+        d.addCallback(lambda res: self.failUnlessEqual(res, ["     ", "    0",
+                                                             "   ", "0", ""]))
+        return d
+
+    def test_get_buckets_bulk(self):
+        server = self.create("test_get_buckets_bulk")
+        aa = server.get_accountant().get_anonymous_account()
+
+        ver = aa.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('has-bulk-get-buckets'), sv1)
+
+        d = self.allocate(aa, "si1", [0, 2], 25)
+        d.addCallback(lambda (already, writers):
+                      for_items(self._write_and_close, writers))
+        d.addCallback(lambda ign: self.allocate(aa, "si2", [1], 25))
+        d.addCallback(lambda (already, writers):
+                      for_items(self._write_and_close, writers))
+        d.addCallback(lambda ign: aa.remote_get_buckets_bulk(["si1", "si2", "si3"]))
+        def _got_buckets(res):
+            self.failUnlessEqual(set(res.keys()), set(["si1", "si2"]))
+            self.failUnlessEqual(set(res["si1"].keys()), set([0, 2]))
+            self.failUnlessEqual(set(res["si2"].keys()), set([1]))
+            return res["si2"][1].remote_read(0, 5)
+        d.addCallback(_got_buckets)
+        d.addCallback(lambda res: self.failUnlessEqual(res, "     "))
+        d.addCallback(lambda ign: aa.remote_get_buckets_bulk([]))
+        d.addCallback(lambda res: self.failUnlessEqual(res, {}))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(len(server.latencies["get_bulk"]), 2))
+        return d
 
     def test_declares_maximum_share_sizes(self):
         server = self.create("test_declares_maximum_share_sizes")
@@ -3990,6 +4028,41 @@ class MDMFProxies(WithDiskBackend, ShouldFailMixin, unittest.TestCase):
         return d
 
 
+    def test_write_coalesces_blocks(self):
+        self.init("test_write_coalesces_blocks")
+        mw = self._make_new_mw("si1", 0)
+        for i in xrange(6):
+            mw.put_block(self.block, i, self.salt)
+        mw.put_encprivkey(self.encprivkey)
+        mw.put_blockhashes(self.block_hash_tree)
+        mw.put_sharehashes(self.share_hash_chain)
+        mw.put_root_hash(self.root_hash)
+        mw.put_signature(self.signature)
+        mw.put_verification_key(self.verification_key)
+        writes = []
+        callRemote = self.rref.callRemote
+        def _record(methname, *args, **kwargs):
+            writes.append(args[2])
+            return callRemote(methname, *args, **kwargs)
+        self.rref.callRemote = _record
+        d = mw.finish_publishing()
+        def _check((result, ign)):
+            self.failUnless(result, "publish failed")
+            self.failUnlessEqual(len(writes), 1)
+            (testvs, datavs, new_length) = writes[0][0]
+            sharedata_offset = mw._offsets['share_data']
+            blocks = [data for (offset, data) in datavs
+                      if offset == sharedata_offset]
+            self.failUnlessEqual(blocks, [(self.salt + self.block) * 6])
+            return self.aa.remote_slot_readv("si1", [0],
+                                             [(sharedata_offset,
+                                               6 * len(self.salt + self.block))])
+        d.addCallback(_check)
+        d.addCallback(lambda res:
+            self.failUnlessEqual(res, {0: [(self.salt + self.block) * 6]}))
+        return d
+
+
     def _make_new_mw(self, si, share, datalength=36):
         # This is a file of size 36 bytes. Since it has a segment
         # size of 6, we know that it has 6 byte segments, which will
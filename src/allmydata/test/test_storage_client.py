@@ -1,6 +1,13 @@
 
+import os, time, mock
 from twisted.trial import unittest
-from allmydata.storage_client import NativeStorageServer
+from twisted.internet import defer
+from allmydata.storage_client import NativeStorageServer, ServerPerformance, \
+     StorageFarmBroker, BucketLocator
+from allmydata.perfdb import PerformanceDB
+from allmydata.util import base32, fileutil
+from allmydata.test.common import ShouldFailMixin
+from foolscap.api import DeadReferenceError
 
 
 class NativeStorageServerWithVersion(NativeStorageServer):
@@ -28,3 +35,233 @@ class TestNativeStorageServer(unittest.TestCase):
             })
         self.failUnlessEqual(nss.get_available_space(), 111)
 
+
+class FakeBucketServer:
+    def __init__(self, bulk, shares):
+        self.version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                        {"has-bulk-get-buckets": bulk}}
+        self.shares = shares # storage_index -> {shnum: bucket}
+        self.calls = []
+        self.answer = None # or a Deferred to hold the next response
+        self.connected = True
+        self.performance = ServerPerformance()
+    def get_version(self):
+        return self.version
+    def get_performance(self):
+        return self.performance
+    def get_rref(self):
+        if self.connected:
+            return self
+        return None
+    def callRemote(self, methname, *args):
+        self.calls.append((methname,) + args)
+        if self.answer:
+            d, self.answer = self.answer, None
+            return d
+        if methname == "get_buckets":
+            return defer.succeed(self.shares.get(args[0], {}))
+        assert methname == "get_buckets_bulk"
+        return defer.succeed(dict([(si, self.shares[si]) for si in args[0]
+                                   if si in self.shares]))
+
+
+class TestBucketLocator(ShouldFailMixin, unittest.TestCase):
+    def _locate(self, server, storage_indexes):
+        locator = BucketLocator(server)
+        return defer.gatherResults([locator.get_buckets(si)
+                                    for si in storage_indexes])
+
+    def test_coalesce(self):
+        server = FakeBucketServer(True, {"si1": {0: "b0", 1: "b1"},
+                                         "si2": {3: "b3"}})
+        server.answer = answer = defer.Deferred()
+        d = self._locate(server, ["si0", "si1", "si2", "si3", "si1"])
+        # the first lookup is sent immediately, and the rest wait for it
+        self.failUnlessEqual(server.calls, [("get_buckets", "si0")])
+        answer.callback({})
+        def _check(res):
+            self.failUnlessEqual(res, [{}, {0: "b0", 1: "b1"}, {3: "b3"}, {},
+                                       {0: "b0", 1: "b1"}])
+            self.failUnlessEqual(len(server.calls), 2)
+            (methname, sis) = server.calls[1]
+            self.failUnlessEqual(methname, "get_buckets_bulk")
+            self.failUnlessEqual(sorted(sis), ["si1", "si2", "si3"])
+        d.addCallback(_check)
+        return d
+
+    def test_rtt(self):
+        server = FakeBucketServer(True, {})
+        server.answer = answer = defer.Deferred()
+        now = [100.0]
+        self.patch(time, "time", lambda: now[0])
+        locator = BucketLocator(server)
+        d0 = locator.get_buckets("si0")
+        now[0] = 101.0
+        d1 = locator.get_buckets("si1")
+        d2 = locator.get_buckets("si2")
+        # the queued lookups are sent when the first one returns, and their
+        # round trip is timed from then, not from when they were asked
+        now[0] = 103.0
+        server.answer = answer2 = defer.Deferred()
+        answer.callback({})
+        self.failUnlessEqual(server.performance._samples, [3.0])
+        now[0] = 103.5
+        answer2.callback({})
+        self.failUnlessEqual(server.performance._samples, [3.0, 0.5])
+        return defer.gatherResults([d0, d1, d2])
+
+    def test_single(self):
+        server = FakeBucketServer(True, {"si1": {0: "b0"}})
+        d = self._locate(server, ["si1"])
+        def _check(res):
+            self.failUnlessEqual(res, [{0: "b0"}])
+            self.failUnlessEqual(server.calls, [("get_buckets", "si1")])
+        d.addCallback(_check)
+        return d
+
+    def test_disconnected(self):
+        server = FakeBucketServer(True, {"si1": {0: "b0"}})
+        server.answer = answer = defer.Deferred()
+        locator = BucketLocator(server)
+        d0 = locator.get_buckets("si0")
+        d1 = locator.get_buckets("si1")
+        # the server goes away while the first lookup is outstanding, so the
+        # queued one fails rather than waiting forever
+        server.connected = False
+        answer.callback({})
+        d = self.shouldFail(DeadReferenceError, "disconnected", None,
+                            lambda: d1)
+        d.addCallback(lambda ign: d0)
+        d.addCallback(lambda res: self.failUnlessEqual(res, {}))
+        # and once it comes back, lookups are sent straight away again
+        def _reconnect(ign):
+            server.connected = True
+            return locator.get_buckets("si1")
+        d.addCallback(_reconnect)
+        d.addCallback(lambda res: self.failUnlessEqual(res, {0: "b0"}))
+        return d
+
+    def test_old_server(self):
+        server = FakeBucketServer(False, {"si1": {0: "b0"}})
+        d = self._locate(server, ["si1", "si2"])
+        def _check(res):
+            self.failUnlessEqual(res, [{0: "b0"}, {}])
+            self.failUnlessEqual(server.calls, [("get_buckets", "si1"),
+                                                ("get_buckets", "si2")])
+        d.addCallback(_check)
+        return d
+
+
+class TestServerPerformance(unittest.TestCase):
+    def test_no_history(self):
+        p = ServerPerformance()
+        self.failUnlessEqual(p.estimate_time(1000), None)
+        self.failUnlessEqual(p.get_latency_percentile(0.95), None)
+
+    def test_rtt(self):
+        p = ServerPerformance()
+        p.record_rtt(1.0)
+        self.failUnlessEqual(p.rtt, 1.0)
+        p.record_rtt(2.0)
+        self.failUnlessEqual(p.rtt, 1.25)
+        # small responses only tell us about latency
+        p.record_transfer(100, 2.0)
+        self.failUnlessEqual(p.rtt, 1.4375)
+        self.failUnlessEqual(p.throughput, None)
+        self.failUnlessEqual(p.estimate_time(10**6), 1.4375)
+
+    def test_throughput(self):
+        p = ServerPerformance()
+        p.record_rtt(0.5)
+        p.record_transfer(100000, 1.5)
+        self.failUnlessEqual(p.rtt, 0.5)
+        self.failUnlessEqual(p.throughput, 100000.0)
+        self.failUnlessEqual(p.estimate_time(200000), 2.5)
+
+    def test_percentile(self):
+        p = ServerPerformance()
+        for i in range(p.MIN_SAMPLES-1):
+            p.record_rtt(0.01)
+        self.failUnlessEqual(p.get_latency_percentile(0.95), None)
+        p.record_rtt(1.0)
+        self.failUnlessEqual(p.get_latency_percentile(0.5), 0.01)
+        self.failUnlessEqual(p.get_latency_percentile(0.95), 1.0)
+        for i in range(p.MAX_SAMPLES):
+            p.record_rtt(0.02)
+        self.failUnlessEqual(p.get_latency_percentile(0.95), 0.02)
+
+    def test_state(self):
+        p = ServerPerformance()
+        p.record_rtt(0.5)
+        p.record_transfer(100000, 1.5)
+        p2 = ServerPerformance()
+        p2.set_state(p.get_state())
+        self.failUnlessEqual(p2.rtt, 0.5)
+        self.failUnlessEqual(p2.throughput, 100000.0)
+        self.failUnlessEqual(p2.get_state(), p.get_state())
+
+
+class TestPerformanceDB(unittest.TestCase):
+    def _make_broker(self, count):
+        sb = StorageFarmBroker(None, True)
+        for k in ["%d" % i for i in range(count)]:
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+        return sb
+
+    def _make_db(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        return os.path.join(basedir, "server_performance.sqlite")
+
+    def test_save_and_restore(self):
+        sb = self._make_broker(2)
+        dbfile = self._make_db()
+        sb.servers["0"].get_performance().record_rtt(0.25)
+        db = PerformanceDB(dbfile, sb)
+        db.save(now=1000)
+
+        db = PerformanceDB(dbfile, sb)
+        p = ServerPerformance()
+        self.failUnless(db.restore("0", p, now=2000))
+        self.failUnlessEqual(p.rtt, 0.25)
+        # servers that never answered are not recorded
+        self.failIf(db.restore("1", ServerPerformance(), now=2000))
+        # and old history is ignored
+        p = ServerPerformance()
+        self.failIf(db.restore("0", p, now=1000+db.MAX_AGE+1))
+        self.failUnlessEqual(p.rtt, None)
+
+    def test_broker_restores_new_servers(self):
+        sb = self._make_broker(0)
+        dbfile = self._make_db()
+        db = PerformanceDB(dbfile, sb)
+        sb.use_performance_db(db)
+        tub = mock.Mock()
+        key_s = "v0-" + "a"*52
+        ann = {"service-name": "storage",
+               "anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+               "permutation-seed-base32": base32.b2a("seed") }
+        sb.tub = tub
+        sb._got_announcement(key_s, ann)
+        (server,) = sb.get_known_servers()
+        self.failUnlessEqual(server.get_performance().rtt, None)
+        server.get_performance().record_rtt(0.75)
+        db.save()
+
+        # a replacement announcement keeps what we already know
+        ann2 = ann.copy()
+        ann2["nickname"] = u"renamed"
+        sb._got_announcement(key_s, ann2)
+        (server2,) = sb.get_known_servers()
+        self.failIfIdentical(server2, server)
+        self.failUnlessEqual(server2.get_performance().rtt, 0.75)
+
+        # and a new broker (e.g. after a restart) starts off with it
+        sb2 = self._make_broker(0)
+        sb2.tub = tub
+        sb2.use_performance_db(db)
+        sb2._got_announcement(key_s, ann)
+        (server3,) = sb2.get_known_servers()
+        self.failUnlessEqual(server3.get_performance().rtt, 0.75)
@@ -515,9 +515,41 @@ class ServerSelection(unittest.TestCase):
                 allocated = s.allocated
                 self.failUnlessEqual(len(allocated), 1)
                 self.failUnlessEqual(s.queries, 1)
+            # each query's round trip was recorded
+            for server in self.node.storage_broker.get_connected_servers():
+                self.failIfEqual(server.get_performance().rtt, None)
         d.addCallback(_check)
         return d
 
+    def test_first_pass_in_parallel(self):
+        # the first query to each server is sent before any of them are
+        # answered, so placement takes one round trip rather than fifty
+        self.make_client()
+        in_flight = [0]
+        peak = [0]
+        def _count_allocations(server):
+            def _callRemote(methname, *args, **kwargs):
+                d = FakeStorageServer.callRemote(server, methname,
+                                                 *args, **kwargs)
+                if methname == "allocate_buckets":
+                    in_flight[0] += 1
+                    peak[0] = max(peak[0], in_flight[0])
+                    def _done(res):
+                        in_flight[0] -= 1
+                        return res
+                    d.addBoth(_done)
+                return d
+            server.callRemote = _callRemote
+        for s in self.node.last_servers:
+            _count_allocations(s)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 30, 50)
+        d = upload_data(self.u, data)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        d.addCallback(lambda ign: self.failUnlessEqual(peak[0], 50))
+        return d
+
     def test_two_each(self):
         # if we have 100 shares, and there are 50 servers, and they all
         # accept all shares, we should get exactly two shares per server
@@ -745,6 +777,8 @@ class FakeServerTracker:
         self.buckets = buckets
     def get_serverid(self):
         return self._serverid
+    def get_name(self):
+        return self._serverid
 
 class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
     ShouldFailMixin):
@@ -1175,7 +1209,6 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(lambda ign:
             self.failUnless(self._has_happy_share_distribution()))
         return d
-    test_problem_layout_ticket_1124.todo = "Fix this after 1.7.1 release."
 
     def test_happiness_with_some_readonly_servers(self):
         # Try the following layout
@@ -1376,6 +1409,30 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         self.failUnlessEqual(expected, merge_servers(shares3, set(trackers)))
 
 
+    def test_abort_superfluous_buckets(self):
+        # A bucket allocated for a share that another server already holds
+        # is aborted, unless it is needed for happiness.
+        class FakeBucket:
+            aborted = False
+            def abort(self):
+                self.aborted = True
+        selector = upload.Tahoe2ServerSelector("dglev", "test",
+                                               upload.UploadStatus())
+        selector.preexisting_shares = {0: set(["server0"]),
+                                       1: set(["server0"])}
+        b0, b1, b2 = FakeBucket(), FakeBucket(), FakeBucket()
+        t1 = FakeServerTracker("server1", {1: b1})
+        t2 = FakeServerTracker("server2", {0: b0, 2: b2})
+        selector.use_trackers = set([t1, t2])
+        selector._abort_superfluous_buckets()
+        self.failUnless(b0.aborted)
+        self.failIf(b1.aborted)
+        self.failIf(b2.aborted)
+        self.failUnlessEqual(t1.buckets, {1: b1})
+        self.failUnlessEqual(t2.buckets, {2: b2})
+        self.failUnlessEqual(selector.use_trackers, set([t1, t2]))
+
+
     def test_servers_of_happiness_utility_function(self):
         # These tests are concerned with the servers_of_happiness()
         # utility function, and its underlying matching algorithm. Other
@@ -1596,7 +1653,9 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         # the one that it wanted to allocate there. Though no shares will
         # be allocated in this request, it should still be called
         # productive, since it caused some homeless shares to be
-        # removed.
+        # removed. The other nine servers were asked for one share each
+        # at the same time, and those allocations are kept because they
+        # improve happiness.
         d.addCallback(_reset)
         d.addCallback(lambda ign:
             self._setup_and_upload())
@@ -1616,7 +1675,7 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(_next)
         d.addCallback(lambda c:
             self.shouldFail(UploadUnhappinessError, "test_query_counting",
-                            "1 queries placed some shares",
+                            "10 queries placed some shares",
                             c.upload, upload.Data("data" * 10000,
                                                   convergence="")))
         return d
@@ -1856,17 +1915,12 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
             return client
 
         d.addCallback(_setup)
-        # Note: actually it should succeed! See
-        # test_problem_layout_ticket_1128. But ticket 1118 is just to
-        # make it realize that it has failed, so if it raises
-        # UploadUnhappinessError then we'll give it the green light
-        # for now.
-        d.addCallback(lambda ignored:
-            self.shouldFail(UploadUnhappinessError,
-                            "test_problem_layout_ticket_1118",
-                            "",
-                            self.g.clients[0].upload, upload.Data("data" * 10000,
-                                                       convergence="")))
+        # the uploader used to either hit the assertion or give up with
+        # UploadUnhappinessError here; it now places the shares happily
+        d.addCallback(lambda client:
+            client.upload(upload.Data("data" * 10000, convergence="")))
+        d.addCallback(lambda ign:
+            self.failUnless(self._has_happy_share_distribution()))
         return d
 
     def test_problem_layout_ticket_1128(self):
@@ -1898,7 +1952,6 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(lambda ign:
             self.failUnless(self._has_happy_share_distribution()))
         return d
-    test_problem_layout_ticket_1128.todo = "Invent a smarter uploader that uploads successfully in this case."
 
     def test_upload_succeeds_with_some_homeless_shares(self):
         # If the upload is forced to stop trying to place shares before
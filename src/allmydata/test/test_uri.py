@@ -701,3 +701,47 @@ class Dirnode(testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessIsInstance(v4, uri.MDMFDirectoryURIVerifier)
         self.failIf(v4.is_mutable())
         self.failUnlessEqual(v4.to_string(), v3.to_string())
+
+    def test_sharded(self):
+        writekey = "\x01" * 16
+        fingerprint = "\x02" * 32
+        uri1 = uri.WriteableMDMFFileURI(writekey, fingerprint)
+        d1 = uri.ShardedDirectoryURI(uri1)
+        self.failIf(d1.is_readonly())
+        self.failUnless(d1.is_mutable())
+        self.failUnless(IURI.providedBy(d1))
+        self.failUnless(IDirnodeURI.providedBy(d1))
+        d1_uri = d1.to_string()
+        self.failUnless(d1_uri.startswith("URI:DIR2-SHARDED:"), d1_uri)
+        self.failUnlessReallyEqual(uri.wrap_sharded_dirnode_cap(uri1).to_string(),
+                                   d1_uri)
+
+        d2 = uri.from_string(d1_uri)
+        self.failUnlessIsInstance(d2, uri.ShardedDirectoryURI)
+        self.failUnlessReallyEqual(d2.to_string(), d1_uri)
+        self.failUnlessReallyEqual(d2.get_storage_index(), uri1.get_storage_index())
+        d3 = uri.from_string(d1_uri, deep_immutable=True)
+        self.failUnlessIsInstance(d3, uri.UnknownURI)
+
+        ro = d2.get_readonly()
+        self.failUnlessIsInstance(ro, uri.ReadonlyShardedDirectoryURI)
+        self.failUnless(ro.is_readonly())
+        self.failUnless(ro.is_mutable())
+        ro_uri = ro.to_string()
+        self.failUnless(ro_uri.startswith("URI:DIR2-SHARDED-RO:"), ro_uri)
+        ro2 = uri.from_string(ro_uri)
+        self.failUnlessIsInstance(ro2, uri.ReadonlyShardedDirectoryURI)
+        self.failUnlessReallyEqual(ro2.to_string(), ro_uri)
+        self.failUnlessIsInstance(uri.from_string(ro_uri, deep_immutable=True),
+                                  uri.UnknownURI)
+        self.failUnlessIsInstance(uri.from_string("ro." + d1_uri),
+                                  uri.UnknownURI)
+
+        v1 = d1.get_verify_cap()
+        self.failUnlessIsInstance(v1, uri.ShardedDirectoryURIVerifier)
+        self.failIf(v1.is_mutable())
+        self.failUnless(v1.to_string().startswith("URI:DIR2-SHARDED-Verifier:"))
+        self.failUnlessEqual(ro.get_verify_cap().to_string(), v1.to_string())
+        v2 = uri.from_string(v1.to_string())
+        self.failUnlessIsInstance(v2, uri.ShardedDirectoryURIVerifier)
+        self.failUnlessEqual(v2.to_string(), v1.to_string())
@@ -494,6 +494,49 @@ class FileUtil(ReallyEqualMixin, unittest.TestCase):
         used = fileutil.du(basedir)
         self.failUnlessEqual(10+11+12+13, used)
 
+    def _check_tempfile(self, f):
+        data = "".join(["%05d," % i for i in range(20000)])
+        # sequential writes in small chunks, as from SFTP writeChunk
+        for pos in range(0, len(data), 1000):
+            f.seek(pos)
+            f.write(data[pos:pos+1000])
+        self.failUnlessReallyEqual(f.tell(), len(data))
+        f.seek(0)
+        self.failUnlessReallyEqual(f.read(), data)
+
+        f.seek(12345)
+        f.write("hello")
+        data = data[:12345] + "hello" + data[12350:]
+        self.failUnlessReallyEqual(f.read(10), data[12350:12360])
+        f.seek(12340)
+        self.failUnlessReallyEqual(f.read(20), data[12340:12360])
+        f.seek(7)
+        self.failUnlessReallyEqual(f.read(100000), data[7:100007])
+
+        f.truncate(50000)
+        f.seek(0)
+        self.failUnlessReallyEqual(f.read(), data[:50000])
+        f.seek(60000)
+        f.write("x")
+        f.seek(60000)
+        self.failUnlessReallyEqual(f.read(), "x")
+
+        f.flush()
+        f.file.seek(0)
+        ondisk = f.file.read(50000)
+        f.close()
+        return (data[:50000], ondisk)
+
+    def test_encrypted_tempfile(self):
+        self.patch(fileutil.EncryptedTemporaryFile, "WRITE_BUFFER_SIZE", 4096)
+        (data, ondisk) = self._check_tempfile(fileutil.EncryptedTemporaryFile())
+        self.failIfEqual(ondisk, data)
+
+    def test_encrypted_tempfile_disabled(self):
+        self.patch(fileutil, "encrypt_temporary_files", False)
+        (data, ondisk) = self._check_tempfile(fileutil.EncryptedTemporaryFile())
+        self.failUnlessReallyEqual(ondisk, data)
+
     def test_abspath_expanduser_unicode(self):
         self.failUnlessRaises(AssertionError, fileutil.abspath_expanduser_unicode, "bytestring")
 
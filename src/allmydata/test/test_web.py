@@ -18,13 +18,15 @@ from nevow import rend
 from nevow.inevow import IRequest
 
 from allmydata import interfaces, uri, webish, dirnode
-from allmydata.storage_client import StorageFarmBroker, StubServer
+from allmydata.storage_client import StorageFarmBroker, StubServer, \
+     ServerPerformance
 from allmydata.immutable import upload
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.unknown import UnknownNode
-from allmydata.web import status, common
+from allmydata.web import status, common, filenode as web_filenode
+from allmydata.web.dircache import DirectoryCache
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.util import fileutil, base32, hashutil
 from allmydata.util.consumer import download_to_data
@@ -155,6 +157,22 @@ def build_one_ds():
 
     return ds
 
+def parse_byteranges(body, content_type):
+    """Split a multipart/byteranges response body into a list of
+    (content-range, data) tuples."""
+    prefix = "multipart/byteranges; boundary="
+    assert content_type.startswith(prefix), content_type
+    boundary = content_type[len(prefix):]
+    assert body.endswith("\r\n--%s--\r\n" % boundary), body
+    parts = []
+    for chunk in body.split("--%s" % boundary)[1:-1]:
+        assert chunk.startswith("\r\n"), chunk
+        assert chunk.endswith("\r\n"), chunk
+        headers, data = chunk[2:-2].split("\r\n\r\n", 1)
+        headers = dict([h.split(": ", 1) for h in headers.split("\r\n")])
+        parts.append((headers["Content-Range"], data))
+    return parts
+
 class FakeHistory:
     _all_upload_status = [upload.UploadStatus()]
     _all_download_status = [build_one_ds()]
@@ -186,6 +204,9 @@ class FakeDisplayableServer(StubServer):
         self.last_loss_time = last_loss_time
         self.last_rx_time = last_rx_time
         self.last_connect_time = last_connect_time
+        self.performance = ServerPerformance()
+    def get_performance(self):
+        return self.performance
     def is_connected(self):
         return self.connected
     def get_permutation_seed(self):
@@ -981,6 +1002,134 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                              headers=headers)
         return d
 
+    def test_GET_FILEURL_multiple_ranges(self):
+        # the parts are sent in ascending order
+        headers = {"range": "bytes=-5, 1-5, 7-9"}
+        length  = len(self.BAR_CONTENTS)
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.has_key("content-range"))
+            self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                       len(res))
+            parts = parse_byteranges(res, headers["content-type"][0])
+            self.failUnlessReallyEqual(parts, [
+                ("bytes 1-5/%d" % length, self.BAR_CONTENTS[1:6]),
+                ("bytes 7-9/%d" % length, self.BAR_CONTENTS[7:10]),
+                ("bytes %d-%d/%d" % (length-5, length-1, length),
+                 self.BAR_CONTENTS[-5:]),
+                ])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_overlapping_ranges(self):
+        # overlapping and adjacent ranges are merged, so that asking for the
+        # same bytes again and again does not get them sent again and again
+        d = self.GET(self.public_url + "/foo/bar.txt",
+                     headers={"range": "bytes=0-,0-,0-,0-"},
+                     return_response=True)
+        def _got_one((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers["content-range"][0],
+                                       "bytes 0-%d/%d"
+                                       % (len(self.BAR_CONTENTS)-1,
+                                          len(self.BAR_CONTENTS)))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS)
+        d.addCallback(_got_one)
+        d.addCallback(lambda ign:
+                      self.GET(self.public_url + "/foo/bar.txt",
+                               headers={"range": "bytes=5-9,0-4,12-14,3-6,13-"},
+                               return_response=True))
+        def _got_two((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            parts = parse_byteranges(res, headers["content-type"][0])
+            length = len(self.BAR_CONTENTS)
+            self.failUnlessReallyEqual(parts, [
+                ("bytes 0-9/%d" % length, self.BAR_CONTENTS[0:10]),
+                ("bytes 12-%d/%d" % (length-1, length),
+                 self.BAR_CONTENTS[12:]),
+                ])
+        d.addCallback(_got_two)
+        return d
+
+    def test_GET_FILEURL_too_many_ranges(self):
+        # a header that asks for too many separate parts is ignored
+        self.patch(web_filenode, "MAX_RANGES", 2)
+        d = self.GET(self.public_url + "/foo/bar.txt",
+                     headers={"range": "bytes=0-1,3-4,6-7"},
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 200)
+            self.failIf(headers.has_key("content-range"))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS)
+        d.addCallback(_got)
+        # but one that merges down to few enough is honoured
+        d.addCallback(lambda ign:
+                      self.GET(self.public_url + "/foo/bar.txt",
+                               headers={"range": "bytes=0-1,3-4,2-2"},
+                               return_response=True))
+        def _got_merged((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[0:5])
+        d.addCallback(_got_merged)
+        return d
+
+    def test_GET_FILEURL_multiple_ranges_overrun(self):
+        # ranges that start beyond the end of the file are ignored
+        headers = {"range": "bytes=100-200,0-1,3-4"}
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            parts = parse_byteranges(res, headers["content-type"][0])
+            length = len(self.BAR_CONTENTS)
+            self.failUnlessReallyEqual(parts, [
+                ("bytes 0-1/%d" % length, self.BAR_CONTENTS[0:2]),
+                ("bytes 3-4/%d" % length, self.BAR_CONTENTS[3:5]),
+                ])
+        d.addCallback(_got)
+        # but if that leaves just one, it is sent on its own
+        d.addCallback(lambda ign:
+                      self.GET(self.public_url + "/foo/bar.txt",
+                               headers={"range": "bytes=100-200,0-1"},
+                               return_response=True))
+        def _got_one((res, status, headers)):
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers["content-range"][0],
+                                       "bytes 0-1/%d" % len(self.BAR_CONTENTS))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[0:2])
+        d.addCallback(_got_one)
+        d.addCallback(lambda ign:
+                      self.shouldFail2(error.Error, "multiple_ranges_overrun",
+                                       "416 Requested Range not satisfiable",
+                                       "First beyond end of file",
+                                       self.GET,
+                                       self.public_url + "/foo/bar.txt",
+                                       headers={"range": "bytes=100-200,300-400"}))
+        return d
+
+    def test_HEAD_FILEURL_multiple_ranges(self):
+        headers = {"range": "bytes=1-4,6-9"}
+        d = self.HEAD(self.public_url + "/foo/bar.txt", headers=headers,
+                      return_response=True)
+        def _got((res, status, headers)):
+            self.failUnlessReallyEqual(res, "")
+            self.failUnlessReallyEqual(int(status), 206)
+            ctype = headers["content-type"][0]
+            self.failUnless(ctype.startswith("multipart/byteranges; boundary="),
+                            ctype)
+            boundary = ctype.split("=", 1)[1]
+            part = ("--%s\r\nContent-Type: text/plain\r\n"
+                    "Content-Range: bytes 1-4/%d\r\n\r\n"
+                    % (boundary, len(self.BAR_CONTENTS)))
+            expected = (len(part) + 4) + (2 + len(part) + 4) + \
+                       len("\r\n--%s--\r\n" % boundary)
+            self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                       expected)
+        d.addCallback(_got)
+        return d
+
     def test_GET_FILEURL_range_bad(self):
         headers = {"range": "BOGUS=fizbop-quarnak"}
         d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
@@ -1242,6 +1391,115 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
 
         return d
 
+    def test_GET_etags_LIT(self):
+        lit_uri = "URI:LIT:n5xgk"
+        d = self.GET("/uri/%s" % lit_uri, return_response=True)
+        def _got((data, code, headers)):
+            self.failUnlessReallyEqual(data, "one")
+            etag = headers['etag'][0]
+            self.failUnless(etag.startswith("LIT:"), etag)
+            return self.GET("/uri/%s" % lit_uri, return_response=True,
+                            headers={"If-None-Match": etag})
+        d.addCallback(_got)
+        d.addCallback(lambda (data, code, headers):
+                      self.failUnlessReallyEqual(int(code), http.NOT_MODIFIED))
+        return d
+
+    def test_GET_immutable_cache_control(self):
+        # content named by its cap can be cached forever, but content named
+        # by a path through a mutable directory might change
+        d = self.GET("/uri/%s" % self._bar_txt_uri, return_response=True)
+        def _by_cap((data, code, headers)):
+            self.failUnlessIsBarDotTxt(data)
+            cc = headers['cache-control'][0]
+            self.failUnlessIn("max-age=31536000", cc)
+            self.failUnlessIn("immutable", cc)
+        d.addCallback(_by_cap)
+        d.addCallback(lambda ign: self.GET(self.public_url + "/foo/bar.txt",
+                                           return_response=True))
+        def _by_path((data, code, headers)):
+            self.failUnlessIsBarDotTxt(data)
+            self.failUnless("etag" in headers)
+            self.failIf("cache-control" in headers)
+        d.addCallback(_by_path)
+        d.addCallback(lambda ign: self.GET("/uri/%s" % self._baz_txt_uri,
+                                           return_response=True))
+        d.addCallback(lambda (data, code, headers):
+                      self.failIf("cache-control" in headers))
+        return d
+
+    def test_GET_immutable_if_modified_since(self):
+        uri = "/uri/%s" % self._bar_txt_uri
+        d = self.GET(uri, return_response=True,
+                     headers={"If-Modified-Since":
+                              "Sat, 29 Oct 1994 19:43:31 GMT"})
+        def _not_modified((data, code, headers)):
+            self.failUnlessReallyEqual(int(code), http.NOT_MODIFIED)
+            self.failUnlessReallyEqual(data, "")
+        d.addCallback(_not_modified)
+        # a malformed date is ignored
+        d.addCallback(lambda ign:
+                      self.GET(uri, return_response=True,
+                               headers={"If-Modified-Since": "yesterday"}))
+        d.addCallback(lambda (data, code, headers):
+                      self.failUnlessIsBarDotTxt(data))
+        # and If-None-Match takes precedence
+        d.addCallback(lambda ign:
+                      self.GET(uri, return_response=True,
+                               headers={"If-None-Match": '"nope"',
+                                        "If-Modified-Since":
+                                        "Sat, 29 Oct 1994 19:43:31 GMT"}))
+        d.addCallback(lambda (data, code, headers):
+                      self.failUnlessIsBarDotTxt(data))
+        return d
+
+    def test_GET_immutable_path_if_modified_since(self):
+        # a name in a directory can be bound to a different file at any time,
+        # so If-Modified-Since cannot tell us that the client is up to date
+        d = self.GET(self.public_url + "/foo/bar.txt", return_response=True,
+                     headers={"If-Modified-Since":
+                              "Sat, 29 Oct 1994 19:43:31 GMT"})
+        def _got((data, code, headers)):
+            self.failUnlessReallyEqual(int(code), http.OK)
+            self.failUnlessIsBarDotTxt(data)
+            self.failIfIn("cache-control", headers)
+        d.addCallback(_got)
+        return d
+
+    def test_HEAD_etags(self):
+        url = "/uri/%s" % self._bar_txt_uri
+        d = self.HEAD(url, return_response=True)
+        def _got((data, code, headers)):
+            etag = headers['etag'][0]
+            return self.HEAD(url, return_response=True,
+                             headers={"If-None-Match": etag})
+        d.addCallback(_got)
+        d.addCallback(lambda (data, code, headers):
+                      self.failUnlessReallyEqual(int(code), http.NOT_MODIFIED))
+        return d
+
+    def test_GET_mutable_etags(self):
+        url = "/uri/%s" % self._baz_txt_uri
+        d = self.GET(url, return_response=True)
+        def _got((data, code, headers)):
+            self.failUnlessReallyEqual(data, self.BAZ_CONTENTS)
+            self._etag = headers['etag'][0]
+            return self.GET(url, return_response=True,
+                            headers={"If-None-Match": self._etag})
+        d.addCallback(_got)
+        d.addCallback(lambda (data, code, headers):
+                      self.failUnlessReallyEqual(int(code), http.NOT_MODIFIED))
+        d.addCallback(lambda ign: self.PUT(url, "new contents"))
+        d.addCallback(lambda ign:
+                      self.GET(url, return_response=True,
+                               headers={"If-None-Match": self._etag}))
+        def _changed((data, code, headers)):
+            self.failUnlessReallyEqual(int(code), http.OK)
+            self.failUnlessReallyEqual(data, "new contents")
+            self.failIfEqual(headers['etag'][0], self._etag)
+        d.addCallback(_changed)
+        return d
+
     # TODO: version of this with a Unicode filename
     def test_GET_FILEURL_save(self):
         d = self.GET(self.public_url + "/foo/bar.txt?filename=bar.txt&save=true",
@@ -3116,6 +3374,35 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_after_mkdir)
         return d
 
+    def test_POST_mkdir_no_parentdir_noredirect_sharded(self):
+        d = self.POST("/uri?t=mkdir&shards=4")
+        def _after_mkdir(res):
+            u = uri.from_string(res)
+            self.failUnlessIsInstance(u, uri.ShardedDirectoryURI)
+            self.sharded_url = "/uri/" + urllib.quote(res)
+            return self.PUT(self.sharded_url + "/new.txt", self.NEWFILE_CONTENTS)
+        d.addCallback(_after_mkdir)
+        d.addCallback(lambda ign: self.GET(self.sharded_url + "/new.txt"))
+        d.addCallback(self.failUnlessReallyEqual, self.NEWFILE_CONTENTS)
+        d.addCallback(lambda ign: self.GET(self.sharded_url + "?t=json"))
+        def _check_json(res):
+            data = simplejson.loads(res)
+            self.failUnlessEqual(data[0], "dirnode")
+            self.failUnlessEqual(data[1]["children"].keys(), [u"new.txt"])
+        d.addCallback(_check_json)
+        return d
+
+    def test_POST_mkdir_no_parentdir_noredirect_bad_shards(self):
+        return self.shouldHTTPError("POST_mkdir_no_parentdir_noredirect_bad_shards",
+                                    400, "Bad Request", "invalid shards= argument",
+                                    self.POST, "/uri?t=mkdir&shards=0")
+
+    def test_POST_mkdir_no_parentdir_noredirect_too_many_shards(self):
+        # each shard needs a mutable file (and an RSA key) of its own
+        return self.shouldHTTPError("POST_mkdir_no_parentdir_noredirect_too_many_shards",
+                                    400, "Bad Request", "must be between 1 and 256",
+                                    self.POST, "/uri?t=mkdir&shards=1000000")
+
     def test_POST_mkdir_no_parentdir_noredirect_bad_format(self):
         return self.shouldHTTPError("POST_mkdir_no_parentdir_noredirect_bad_format",
                                     400, "Bad Request", "Unknown format: foo",
@@ -4373,6 +4660,11 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
             # ophandle to test the uncollected timeout anymore. So,
             # instead, catch the 302 here and don't follow it.
             d.addBoth(self.should302, "uncollected_ophandle_creation")
+            # the expiration timer is only started once the operation is
+            # complete, which can take a few turns.
+            d.addCallback(lambda ign:
+                self.ws.root.child_operations.handles[str(ophandle)][0].when_done())
+            d.addCallback(lambda ign: flushEventualQueue())
             return d
         # Create an ophandle, don't collect it, then advance the clock by
         # 4 days - 1 second and make sure that the ophandle is still there.
@@ -4576,6 +4868,127 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
         url = fileurl + "?" + args
         return self.GET(url, method="POST", clientnum=clientnum)
 
+    def test_directory_cache(self):
+        self.basedir = "web/Grid/directory_cache"
+        self.set_up_grid(num_clients=2)
+        c0 = self.g.clients[0]
+        cache = c0.directory_cache = DirectoryCache(1000*1000)
+        DATA = "data" * 100
+        d = c0.create_dirnode()
+        def _created(dirnode):
+            self.rootnode = dirnode
+            self.rooturl = "uri/" + urllib.quote(dirnode.get_uri())
+            return dirnode.add_file(u"one", upload.Data(DATA, convergence=""))
+        d.addCallback(_created)
+        def _check_json(ign, names, hits, misses, url=None):
+            d2 = self.GET((url or self.rooturl) + "?t=json")
+            def _got(res):
+                data = simplejson.loads(res)
+                self.failUnlessEqual(data[0], "dirnode")
+                self.failUnlessEqual(sorted(data[1]["children"].keys()),
+                                     names)
+                self.failUnlessEqual((cache.hits, cache.misses),
+                                     (hits, misses))
+            d2.addCallback(_got)
+            return d2
+        d.addCallback(_check_json, [u"one"], 0, 1)
+        # the second time, the listing is revalidated and then reused
+        d.addCallback(_check_json, [u"one"], 1, 1)
+        # the HTML page uses the same listing
+        d.addCallback(lambda ign: self.GET(self.rooturl + "/"))
+        def _check_html(res):
+            self.failUnlessIn(">one</a>", res)
+            self.failUnlessEqual((cache.hits, cache.misses), (2, 1))
+        d.addCallback(_check_html)
+        # a change made by another client is noticed
+        def _modify(ign):
+            n = self.g.clients[1].create_node_from_uri(self.rootnode.get_uri())
+            return n.add_file(u"two", upload.Data(DATA+"2", convergence=""))
+        d.addCallback(_modify)
+        d.addCallback(_check_json, [u"one", u"two"], 2, 2)
+        d.addCallback(_check_json, [u"one", u"two"], 3, 2)
+        # the read-only view is kept separately
+        d.addCallback(lambda ign: self.GET("uri/%s?t=json" %
+                                           urllib.quote(self.rootnode.get_readonly_uri())))
+        d.addCallback(lambda res:
+                      self.failIfIn("rw_uri",
+                                    simplejson.loads(res)[1]["children"][u"one"][1]))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual((cache.hits, cache.misses), (3, 3)))
+
+        # immutable directories are reused without asking the servers, so
+        # the listing survives the loss of all their shares
+        d.addCallback(lambda ign: self.rootnode.get(u"one"))
+        d.addCallback(lambda one:
+                      c0.create_immutable_dirnode({u"three": (one, {})}))
+        def _check_immutable(immdir):
+            url = "uri/" + urllib.quote(immdir.get_uri())
+            d2 = _check_json(None, [u"three"], 3, 4, url)
+            d2.addCallback(lambda ign: self.find_uri_shares(immdir.get_uri()))
+            def _remove_shares(shares):
+                for (shnum, serverid, sharefile) in shares:
+                    fileutil.remove(sharefile)
+            d2.addCallback(_remove_shares)
+            d2.addCallback(_check_json, [u"three"], 4, 4, url)
+            return d2
+        d.addCallback(_check_immutable)
+
+        # the size of a mutable child can change without the directory
+        # changing, so the JSON for a directory that has one is not kept
+        d.addCallback(lambda ign: c0.create_mutable_file(publish.MutableData("small")))
+        d.addCallback(lambda n: self.rootnode.set_node(u"mut", n))
+        def _get_mutable_size(ign):
+            d2 = self.GET(self.rooturl + "?t=json")
+            d2.addCallback(lambda res:
+                           simplejson.loads(res)[1]["children"][u"mut"][1].get("size"))
+            return d2
+        # (the child node was made from its cap, so its size is not known yet)
+        d.addCallback(_get_mutable_size)
+        d.addCallback(lambda size: self.failUnlessEqual(size, None))
+        d.addCallback(lambda ign: self.rootnode.get(u"mut"))
+        d.addCallback(lambda n: n.overwrite(publish.MutableData("much larger contents")))
+        d.addCallback(_get_mutable_size)
+        d.addCallback(lambda size:
+                      self.failUnlessEqual(size, len("much larger contents")))
+        return d
+
+    def test_GET_multiple_ranges(self):
+        self.basedir = "web/Grid/GET_multiple_ranges"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        # small segments, and a small buffer for each part, so that the
+        # ranges span several segments, and the downloads of the parts that
+        # are waiting for their turn get paused
+        self.patch(web_filenode, "RANGE_BUFFER_SIZE", 500)
+        DATA = "".join(["%05d" % i for i in range(2000)])
+        u = upload.Data(DATA, None)
+        u.max_segment_size = 1000
+        ranges = [(7500, 8900), (10, 20), (1200, 3500), (9000, 9999), (0, 0)]
+        def _get_ranges(n):
+            fileurl = "uri/" + urllib.quote(n.get_uri())
+            rangeheader = ",".join(["%d-%d" % r for r in ranges])
+            d2 = self.GET(fileurl, headers={"range": "bytes=" + rangeheader},
+                          return_response=True)
+            def _got((res, status, headers)):
+                self.failUnlessReallyEqual(int(status), 206)
+                self.failUnlessReallyEqual(int(headers["content-length"][0]),
+                                           len(res))
+                parts = parse_byteranges(res, headers["content-type"][0])
+                self.failUnlessReallyEqual(parts,
+                    [("bytes %d-%d/%d" % (first, last, len(DATA)),
+                      DATA[first:last+1])
+                     for (first, last) in sorted(ranges)])
+            d2.addCallback(_got)
+            return d2
+        d = c0.upload(u)
+        d.addCallback(lambda ur: c0.create_node_from_uri(ur.get_uri()))
+        d.addCallback(_get_ranges)
+        d.addCallback(lambda ign:
+                      c0.create_mutable_file(publish.MutableData(DATA),
+                                             version=MDMF_VERSION))
+        d.addCallback(_get_ranges)
+        return d
+
     def test_filecheck(self):
         self.basedir = "web/Grid/filecheck"
         self.set_up_grid()
@@ -5746,6 +6159,31 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
 
         return d
 
+    def test_unrecoverable_not_cached(self):
+        # a file whose shares cannot be found is a 410, but the shares might
+        # come back (when their servers reconnect), so caches must not be
+        # told to keep the error response
+        self.basedir = "web/Grid/unrecoverable_not_cached"
+        self.set_up_grid(num_clients=1, num_servers=2)
+        c0 = self.g.clients[0]
+        c0.encoding_params['happy'] = 2
+        d = c0.upload(upload.Data("data" * 100, convergence=""))
+        def _uploaded(ur):
+            self.delete_shares_numbered(ur.get_uri(), range(0,10))
+            url = self.client_baseurls[0] + "uri/" + urllib.quote(ur.get_uri())
+            factory = HTTPClientGETFactory(url, method="GET")
+            reactor.connectTCP("localhost", self.client_webports[0], factory)
+            d2 = self.shouldFail(error.Error, "GET unrecoverable", "410",
+                                 lambda: factory.deferred)
+            d2.addCallback(lambda ign: factory.response_headers)
+            return d2
+        d.addCallback(_uploaded)
+        def _check(headers):
+            self.failIfIn("cache-control", headers)
+            self.failIfIn("etag", headers)
+        d.addCallback(_check)
+        return d
+
     def test_blacklist(self):
         # download from a blacklisted URI, get an error
         self.basedir = "web/Grid/blacklist"
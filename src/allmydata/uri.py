@@ -707,6 +707,69 @@ class ImmutableDirectoryURIVerifier(DirectoryURIVerifier):
     INNER_URI_CLASS=CHKFileVerifierURI
 
 
+# A sharded directory is rooted at an MDMF file that holds an index of
+# "shards", each of which is an ordinary mutable directory. The caps below
+# refer to that root index file.
+
+class ShardedDirectoryURI(_DirectoryBaseURI):
+    implements(IDirectoryURI)
+
+    BASE_STRING='URI:DIR2-SHARDED:'
+    BASE_STRING_RE=re.compile('^'+BASE_STRING)
+    INNER_URI_CLASS=WriteableMDMFFileURI
+
+    def __init__(self, filenode_uri=None):
+        if filenode_uri:
+            assert not filenode_uri.is_readonly()
+        _DirectoryBaseURI.__init__(self, filenode_uri)
+
+    def is_readonly(self):
+        return False
+
+    def get_readonly(self):
+        return ReadonlyShardedDirectoryURI(self._filenode_uri.get_readonly())
+
+    def get_verify_cap(self):
+        return ShardedDirectoryURIVerifier(self._filenode_uri.get_verify_cap())
+
+
+class ReadonlyShardedDirectoryURI(_DirectoryBaseURI):
+    implements(IReadonlyDirectoryURI)
+
+    BASE_STRING='URI:DIR2-SHARDED-RO:'
+    BASE_STRING_RE=re.compile('^'+BASE_STRING)
+    INNER_URI_CLASS=ReadonlyMDMFFileURI
+
+    def __init__(self, filenode_uri=None):
+        if filenode_uri:
+            assert filenode_uri.is_readonly()
+        _DirectoryBaseURI.__init__(self, filenode_uri)
+
+    def is_readonly(self):
+        return True
+
+    def get_readonly(self):
+        return self
+
+    def get_verify_cap(self):
+        return ShardedDirectoryURIVerifier(self._filenode_uri.get_verify_cap())
+
+
+class ShardedDirectoryURIVerifier(MDMFDirectoryURIVerifier):
+    implements(IVerifierURI)
+    BASE_STRING='URI:DIR2-SHARDED-Verifier:'
+    BASE_STRING_RE=re.compile('^'+BASE_STRING)
+    INNER_URI_CLASS=MDMFVerifierURI
+
+
+def wrap_sharded_dirnode_cap(filecap):
+    if isinstance(filecap, WriteableMDMFFileURI):
+        return ShardedDirectoryURI(filecap)
+    if isinstance(filecap, ReadonlyMDMFFileURI):
+        return ReadonlyShardedDirectoryURI(filecap)
+    raise AssertionError("cannot interpret as a sharded directory cap: %s" % filecap.__class__)
+
+
 class UnknownURI:
     def __init__(self, uri, error=None):
         self._uri = uri
@@ -801,6 +864,16 @@ def from_string(u, deep_immutable=False, name=u"<unknown name>"):
             kind = "URI:DIR2-MDMF-RO readcap to a mutable directory"
         elif s.startswith('URI:DIR2-MDMF-Verifier:'):
             return MDMFDirectoryURIVerifier.init_from_string(s)
+        elif s.startswith('URI:DIR2-SHARDED:'):
+            if can_be_writeable:
+                return ShardedDirectoryURI.init_from_string(s)
+            kind = "URI:DIR2-SHARDED directory writecap"
+        elif s.startswith('URI:DIR2-SHARDED-RO:'):
+            if can_be_mutable:
+                return ReadonlyShardedDirectoryURI.init_from_string(s)
+            kind = "URI:DIR2-SHARDED-RO readcap to a mutable directory"
+        elif s.startswith('URI:DIR2-SHARDED-Verifier:'):
+            return ShardedDirectoryURIVerifier.init_from_string(s)
         elif s.startswith('x-tahoe-future-test-writeable:') and not can_be_writeable:
             # For testing how future writeable caps would behave in read-only contexts.
             kind = "x-tahoe-future-test-writeable: testing cap"
@@ -92,37 +92,88 @@ class ReopenableNamedTemporaryFile:
     def shutdown(self):
         remove(self.name)
 
+# The node sets this from its [node]tempdir.encrypt option, in the same way
+# that it sets tempfile.tempdir from [node]tempdir.
+encrypt_temporary_files = True
+
 class EncryptedTemporaryFile:
+    """I am a temporary file whose contents are encrypted on disk with
+    AES-128 in CTR mode, under a random key that is only held in memory. If
+    encrypt_temporary_files was false when I was created, my contents are
+    stored in the clear instead (which is only appropriate if the temporary
+    directory is on a filesystem that is itself encrypted, such as an
+    encrypted tmpfs).
+
+    Clients such as the SFTP frontend read and write me sequentially in small
+    chunks. To keep that cheap, I keep the cipher positioned where the last
+    operation left off rather than making a new one for each call, and I
+    collect sequential writes in a buffer that is encrypted and written out
+    WRITE_BUFFER_SIZE bytes at a time."""
     # not implemented: next, readline, readlines, xreadlines, writelines
 
+    WRITE_BUFFER_SIZE = 256*1024
+
     def __init__(self):
         self.file = tempfile.TemporaryFile()
-        self.key = os.urandom(16)  # AES-128
+        if encrypt_temporary_files:
+            self.key = os.urandom(16)  # AES-128
+        else:
+            self.key = None
+        self._cipher = None
+        self._cipher_offset = None  # the offset that self._cipher will process next
+        # Buffered writes are not yet in self.file, whose position stays at
+        # the offset where they start.
+        self._buffer = []
+        self._buffered = 0
 
     def _crypt(self, offset, data):
-        offset_big = offset // 16
-        offset_small = offset % 16
-        iv = binascii.unhexlify("%032x" % offset_big)
-        cipher = AES(self.key, iv=iv)
-        cipher.process("\x00"*offset_small)
-        return cipher.process(data)
+        if self.key is None:
+            return data
+        if offset != self._cipher_offset:
+            offset_big = offset // 16
+            offset_small = offset % 16
+            iv = binascii.unhexlify("%032x" % offset_big)
+            self._cipher = AES(self.key, iv=iv)
+            self._cipher.process("\x00"*offset_small)
+        self._cipher_offset = offset + len(data)
+        return self._cipher.process(data)
+
+    def _flush_buffer(self):
+        if self._buffered == 0:
+            return
+        plaintext = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        index = self.file.tell()
+        self.file.write(self._crypt(index, plaintext))
 
     def close(self):
+        self._buffer = []
+        self._buffered = 0
         self.file.close()
 
     def flush(self):
+        self._flush_buffer()
         self.file.flush()
 
     def seek(self, offset, whence=0):  # 0 = SEEK_SET
+        if whence == 0 and self._buffered > 0 and offset == self.tell():
+            # this continues a sequential write, so keep buffering
+            return
+        self._flush_buffer()
         self.file.seek(offset, whence)
 
     def tell(self):
-        offset = self.file.tell()
+        offset = self.file.tell() + self._buffered
         return offset
 
     def read(self, size=-1):
         """A read must not follow a write, or vice-versa, without an intervening seek."""
-        index = self.file.tell()
+        index = self.tell()
+        if self._buffered > 0:
+            self._flush_buffer()
+            # the underlying file needs a seek between a write and a read
+            self.file.seek(index)
         ciphertext = self.file.read(size)
         plaintext = self._crypt(index, ciphertext)
         return plaintext
@@ -131,13 +182,15 @@ class EncryptedTemporaryFile:
         """A read must not follow a write, or vice-versa, without an intervening seek.
         If seeking and then writing causes a 'hole' in the file, the contents of the
         hole are unspecified."""
-        index = self.file.tell()
-        ciphertext = self._crypt(index, plaintext)
-        self.file.write(ciphertext)
+        self._buffer.append(plaintext)
+        self._buffered += len(plaintext)
+        if self._buffered >= self.WRITE_BUFFER_SIZE:
+            self._flush_buffer()
 
     def truncate(self, newsize):
         """Truncate or extend the file to 'newsize'. If it is extended, the contents after the
         old end-of-file are unspecified. The file position after this operation is unspecified."""
+        self._flush_buffer()
         self.file.truncate(newsize)
 
 
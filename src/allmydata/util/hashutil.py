@@ -91,6 +91,7 @@ MUTABLE_STORAGEINDEX_TAG = "allmydata_mutable_readkey_to_storage_index_v1"
 # dirnodes
 DIRNODE_CHILD_WRITECAP_TAG = "allmydata_mutable_writekey_and_salt_to_dirnode_child_capkey_v1"
 DIRNODE_CHILD_SALT_TAG = "allmydata_dirnode_child_rwcap_to_salt_v1"
+DIRNODE_SHARD_TAG = "allmydata_dirnode_child_name_to_shard_v1"
 
 def storage_index_hash(key):
     # storage index is truncated to 128 bits (16 bytes). We're only hashing a
@@ -182,6 +183,8 @@ def mutable_rwcap_key_hash(iv, writekey):
     return tagged_pair_hash(DIRNODE_CHILD_WRITECAP_TAG, iv, writekey, KEYLEN)
 def mutable_rwcap_salt_hash(writekey):
     return tagged_hash(DIRNODE_CHILD_SALT_TAG, writekey, IVLEN)
+def dirnode_shard_hash(name_utf8):
+    return tagged_hash(DIRNODE_SHARD_TAG, name_utf8)
 
 def ssk_writekey_hash(privkey):
     return tagged_hash(MUTABLE_WRITEKEY_TAG, privkey, KEYLEN)
@@ -344,6 +344,7 @@ class DeepCheckResultsRenderer(rend.Page, ResultsBase, ReloadMixin):
         data["finished"] = self.monitor.is_finished()
         res = self.monitor.get_status()
         data["root-storage-index"] = res.get_root_storage_index_string()
+        data["resumed"] = res.is_resumed()
         c = res.get_counters()
         data["count-objects-checked"] = c["count-objects-checked"]
         data["count-objects-healthy"] = c["count-objects-healthy"]
@@ -364,6 +365,11 @@ class DeepCheckResultsRenderer(rend.Page, ResultsBase, ReloadMixin):
     def render_root_storage_index(self, ctx, data):
         return self.monitor.get_status().get_root_storage_index_string()
 
+    def render_resumed_p(self, ctx, data):
+        if self.monitor.get_status().is_resumed():
+            return ctx.tag
+        return ""
+
     def data_objects_checked(self, ctx, data):
         return self.monitor.get_status().get_counters()["count-objects-checked"]
     def data_objects_healthy(self, ctx, data):
@@ -495,6 +501,7 @@ class DeepCheckAndRepairResultsRenderer(rend.Page, ResultsBase, ReloadMixin):
         data = {}
         data["finished"] = self.monitor.is_finished()
         data["root-storage-index"] = res.get_root_storage_index_string()
+        data["resumed"] = res.is_resumed()
         c = res.get_counters()
         data["count-objects-checked"] = c["count-objects-checked"]
 
@@ -534,6 +541,11 @@ class DeepCheckAndRepairResultsRenderer(rend.Page, ResultsBase, ReloadMixin):
     def render_root_storage_index(self, ctx, data):
         return self.monitor.get_status().get_root_storage_index_string()
 
+    def render_resumed_p(self, ctx, data):
+        if self.monitor.get_status().is_resumed():
+            return ctx.tag
+        return ""
+
     def data_objects_checked(self, ctx, data):
         return self.monitor.get_status().get_counters()["count-objects-checked"]
 
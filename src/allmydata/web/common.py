@@ -14,8 +14,8 @@ from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
      MustBeReadonlyError, MustNotBeUnknownRWError, SDMF_VERSION, MDMF_VERSION
 from allmydata.mutable.common import UnrecoverableFileError
-from allmydata.util import abbreviate
-from allmydata.util.hashutil import timing_safe_compare
+from allmydata.util import abbreviate, base32
+from allmydata.util.hashutil import timing_safe_compare, sha1
 from allmydata.util.time_format import format_time, format_delta
 from allmydata.util.encodingutil import to_str, quote_output
 
@@ -88,6 +88,79 @@ def get_mutable_type(file_format): # accepts result of get_format()
         return None
 
 
+def forget_check_results(client, node):
+    """For t=check&force=true: make the check ask the storage servers even if
+    the client remembers a recent healthy result for this node."""
+    cache = client.get_check_results_cache()
+    si = node.get_storage_index()
+    if cache and si:
+        cache.discard(si)
+
+# An immutable file or directory never changes, so a response for a URL that
+# names one by its cap may be kept by caches for as long as they like (a year
+# being the longest lifetime HTTP/1.1 allows).
+IMMUTABLE_CACHE_CONTROL = "max-age=31536000, immutable"
+
+def get_immutable_etag(node):
+    """Return a string that identifies the contents of the immutable file or
+    directory 'node', for use in ETags. This is the storage index (which is
+    derived from the verify cap), or for literal objects, which have none, a
+    hash of the cap (which holds the whole contents)."""
+    si = node.get_storage_index()
+    if si:
+        return base32.b2a(si)
+    return "LIT:" + base32.b2a(sha1(node.get_readonly_uri()).digest())
+
+def set_immutable_etag(req, etag, cache_forever=False):
+    """Set the ETag for a view of an immutable file or directory.
+    'cache_forever' is True when the request names the object by its cap,
+    rather than by a path through directories that might change.
+
+    I return True if the client made a conditional request (with
+    If-None-Match or If-Modified-Since) for something it already has, in
+    which case the response code has been set to 304 and no body should be
+    sent. An object named by its cap can never have been modified since the
+    client last saw it, so any well-formed If-Modified-Since date is good
+    enough. If-Modified-Since is ignored for paths through directories,
+    since the name may have been bound to a different object since then.
+
+    When I return False, the caller must use set_immutable_cache_control()
+    itself, once it knows that the response will be a success.
+    """
+    if not _is_not_modified(req, etag, cache_forever):
+        return False
+    if cache_forever:
+        set_immutable_cache_control(req)
+    return True
+
+def _is_not_modified(req, etag, cache_forever):
+    if req.setETag(etag):
+        return True
+    if not cache_forever:
+        return False
+    modified_since = req.getHeader("if-modified-since")
+    if modified_since and not req.getHeader("if-none-match"):
+        try:
+            http.stringToDatetime(modified_since.split(";", 1)[0])
+        except ValueError:
+            return False
+        req.setResponseCode(http.NOT_MODIFIED)
+        return True
+    return False
+
+def set_immutable_cache_control(req):
+    """Tell caches that they can keep this response indefinitely. Only use
+    this for a 200, 206 or 304 response: an error (such as a 410 for a file
+    whose shares cannot be found right now) may go away later."""
+    req.setHeader("cache-control", IMMUTABLE_CACHE_CONTROL)
+
+def clear_cache_headers(req):
+    """Remove the ETag and Cache-Control headers from a response that has
+    turned into an error, before it is sent."""
+    req.responseHeaders.removeHeader("cache-control")
+    # setETag() keeps the tag aside until the headers are written
+    req.etag = None
+
 def parse_offset_arg(offset):
     # XXX: This will raise a ValueError when invoked on something that
     # is not an integer. Is that okay? Or do we want a better error
@@ -324,6 +397,7 @@ class MyExceptionHandler(appserver.DefaultExceptionHandler):
     def simple(self, ctx, text, code=http.BAD_REQUEST):
         req = IRequest(ctx)
         req.setResponseCode(code)
+        clear_cache_headers(req)
         #req.responseHeaders.setRawHeaders("content-encoding", [])
         #req.responseHeaders.setRawHeaders("content-disposition", [])
         req.setHeader("content-type", "text/plain;charset=utf-8")
@@ -335,6 +409,7 @@ class MyExceptionHandler(appserver.DefaultExceptionHandler):
         req.finishRequest(False)
 
     def renderHTTP_exception(self, ctx, f):
+        clear_cache_headers(IRequest(ctx))
         try:
             text, code = humanize_failure(f)
         except:
@@ -0,0 +1,144 @@
+
+from collections import OrderedDict
+from twisted.internet import defer
+
+from allmydata.interfaces import IFileNode
+from allmydata.util import log
+
+
+class _Entry:
+    def __init__(self, version, children, size):
+        self.version = version # None for immutable directories
+        self.children = children
+        self.size = size
+        self.json = None
+        # The t=json rendering includes the current size of each mutable
+        # file, which can change without the directory changing, so it is
+        # only kept when there are no mutable files in the directory.
+        self.json_cacheable = not [node for (node, metadata) in children.values()
+                                   if IFileNode.providedBy(node) and node.is_mutable()]
+
+
+class DirectoryCache:
+    """I remember the children of recently listed directories, and their
+    t=json renderings, so that clients that poll the same directories do not
+    make the node fetch and decode them every time.
+
+    Immutable directories never change, so their entries stay good for as
+    long as I keep them. An entry for a mutable directory remembers the
+    version it was read from, and is only used after a cheap check (reading
+    the signed prefix of each share of that version) shows that the version
+    is still current. Entries are indexed by the directory's cap, so
+    read-only and read-write views are kept apart.
+
+    Renderings of directories that contain mutable files are not kept, since
+    they include the sizes of those files.
+
+    Once the directories I hold (and their renderings) add up to more than
+    max_size bytes, I discard the least recently used ones.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict() # cap -> _Entry, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def list(self, dirnode):
+        """Return a Deferred that fires with the children of 'dirnode', as
+        from its list() method."""
+        d = self._get_entry(dirnode)
+        d.addCallback(lambda entry: entry.children)
+        return d
+
+    def get_json(self, dirnode, render):
+        """Return a Deferred that fires with the t=json rendering of
+        'dirnode', which is made by calling render(dirnode, children) if I
+        do not have it already."""
+        d = self._get_entry(dirnode)
+        def _got(entry):
+            if not entry.json_cacheable:
+                return render(dirnode, entry.children)
+            if entry.json is None:
+                entry.json = render(dirnode, entry.children)
+                if self._entries.get(dirnode.get_uri()) is entry:
+                    self._size += len(entry.json)
+                    self._prune()
+            return entry.json
+        d.addCallback(_got)
+        return d
+
+    def get_size(self):
+        return self._size
+
+    def _get_entry(self, dirnode):
+        key = dirnode.get_uri()
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._fetch(dirnode, key)
+        if entry.version is None:
+            self._touch(key, entry)
+            return defer.succeed(entry)
+        d = entry.version.is_current()
+        def _checked(current):
+            if current:
+                self._touch(key, entry)
+                return entry
+            self._discard(key, entry)
+            return self._fetch(dirnode, key)
+        d.addCallback(_checked)
+        return d
+
+    def _fetch(self, dirnode, key):
+        self.misses += 1
+        if not dirnode.is_mutable():
+            d = dirnode.list()
+            d.addCallback(lambda children:
+                          self._add(key, _Entry(None, children,
+                                                dirnode.get_size() or 0)))
+            return d
+        d = dirnode.get_best_version()
+        def _got_version(version):
+            if version is None:
+                # this directory cannot be cached
+                d2 = dirnode.list()
+                d2.addCallback(lambda children: _Entry(None, children, 0))
+                return d2
+            d2 = dirnode.list_version(version)
+            d2.addCallback(lambda children:
+                           self._add(key, _Entry(version, children,
+                                                 version.get_size())))
+            return d2
+        d.addCallback(_got_version)
+        return d
+
+    def _add(self, key, entry):
+        old = self._entries.get(key)
+        if old is not None:
+            self._discard(key, old)
+        if entry.size <= self._max_size:
+            self._entries[key] = entry
+            self._size += entry.size
+            self._prune()
+        return entry
+
+    def _touch(self, key, entry):
+        self.hits += 1
+        if self._entries.get(key) is entry:
+            # move it to the end, as the most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+
+    def _discard(self, key, entry):
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+            self._size -= entry.size + len(entry.json or "")
+
+    def _prune(self):
+        while self._size > self._max_size and self._entries:
+            (key, entry) = self._entries.popitem(last=False)
+            self._size -= entry.size + len(entry.json or "")
+            log.msg(format="DirectoryCache: discarding %(size)d bytes",
+                    size=entry.size, level=log.NOISY,
+                    facility="tahoe.webish")
@@ -26,7 +26,9 @@ from allmydata.web.common import text_plain, WebError, \
      boolean_of_arg, get_arg, get_root, parse_replace_arg, \
      should_create_intermediate_directories, \
      getxmlfile, RenderMixin, humanize_failure, convert_children_json, \
-     get_format, get_mutable_type, get_filenode_metadata, render_time
+     get_format, get_mutable_type, get_filenode_metadata, render_time, \
+     forget_check_results, get_immutable_etag, set_immutable_etag, \
+     set_immutable_cache_control
 from allmydata.web.filenode import ReplaceMeMixin, \
      FileNodeHandler, PlaceHolderNodeHandler
 from allmydata.web.check_results import CheckResultsRenderer, \
@@ -158,21 +160,29 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         # t=info contains variable ophandles, t=rename-form contains the name
         # of the child being renamed. Neither is allowed an ETag.
         FIXED_OUTPUT_TYPES =  ["", "json", "uri", "readonly-uri"]
+        # only an immutable directory named by its cap never changes
+        cache_forever = not self.node.is_mutable() and self.parentnode is None
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
-            si = self.node.get_storage_index()
-            if si and req.setETag('DIR:%s-%s' % (base32.b2a(si), t or "")):
+            etag = 'DIR:%s-%s' % (get_immutable_etag(self.node), t or "")
+            if set_immutable_etag(req, etag, cache_forever=cache_forever):
                 return ""
 
         if not t:
             # render the directory as HTML, using the docFactory and Nevow's
             # whole templating thing.
             return DirectoryAsHTML(self.node,
-                                   self.client.mutable_file_default)
+                                   self.client.mutable_file_default,
+                                   self.client.get_directory_cache(),
+                                   cache_forever=cache_forever)
 
         if t == "json":
-            return DirectoryJSONMetadata(ctx, self.node)
+            return DirectoryJSONMetadata(ctx, self.node,
+                                         self.client.get_directory_cache(),
+                                         cache_forever=cache_forever)
         if t == "info":
             return MoreInfo(self.node)
+        if t in ("uri", "readonly-uri") and cache_forever:
+            set_immutable_cache_control(req)
         if t == "uri":
             return DirectoryURI(ctx, self.node)
         if t == "readonly-uri":
@@ -444,6 +454,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
+        if boolean_of_arg(get_arg(req, "force", "false")):
+            forget_check_results(self.client, self.node)
         if repair:
             d = self.node.check_and_repair(Monitor(), verify, add_lease)
             d.addCallback(self._maybe_literal, CheckAndRepairResultsRenderer)
@@ -464,11 +476,26 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         verify = boolean_of_arg(get_arg(ctx, "verify", "false"))
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
+        # with a journal, an operation that was interrupted by a restart is
+        # resumed when it is started again with the same ophandle
+        journal = self.client.get_deep_check_journal()
+        ophandle = get_arg(ctx, "ophandle")
+        if journal and not IOpHandleTable(ctx).has_ophandle(ophandle):
+            journal = journal.start_operation(ophandle, self.node,
+                                              verify, repair, add_lease)
+        else:
+            journal = None
+        skip_healthy_within = self.client.deep_check_skip_healthy_within
+        force = boolean_of_arg(get_arg(ctx, "force", "false"))
         if repair:
-            monitor = self.node.start_deep_check_and_repair(verify, add_lease)
+            monitor = self.node.start_deep_check_and_repair(verify, add_lease,
+                                                            journal,
+                                                            skip_healthy_within,
+                                                            force)
             renderer = DeepCheckAndRepairResultsRenderer(self.client, monitor)
         else:
-            monitor = self.node.start_deep_check(verify, add_lease)
+            monitor = self.node.start_deep_check(verify, add_lease, journal,
+                                                 skip_healthy_within, force)
             renderer = DeepCheckResultsRenderer(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
@@ -476,7 +503,11 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         verify = boolean_of_arg(get_arg(ctx, "verify", "false"))
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
-        walker = DeepCheckStreamer(ctx, self.node, verify, repair, add_lease)
+        forget_results = None
+        if boolean_of_arg(get_arg(ctx, "force", "false")):
+            forget_results = self.client.get_check_results_cache()
+        walker = DeepCheckStreamer(ctx, self.node, verify, repair, add_lease,
+                                   forget_results)
         monitor = self.node.deep_traverse(walker)
         walker.setMonitor(monitor)
         # register to hear stopProducing. The walker ignores pauseProducing.
@@ -581,9 +612,12 @@ class DirectoryAsHTML(rend.Page):
     docFactory = getxmlfile("directory.xhtml")
     addSlash = True
 
-    def __init__(self, node, default_mutable_format):
+    def __init__(self, node, default_mutable_format, cache=None,
+                 cache_forever=False):
         rend.Page.__init__(self)
         self.node = node
+        self.cache = cache
+        self.cache_forever = cache_forever
 
         assert default_mutable_format in (MDMF_VERSION, SDMF_VERSION)
         self.default_mutable_format = default_mutable_format
@@ -591,7 +625,10 @@ class DirectoryAsHTML(rend.Page):
     def beforeRender(self, ctx):
         # attempt to get the dirnode's children, stashing them (or the
         # failure that results) for later use
-        d = self.node.list()
+        if self.cache:
+            d = self.cache.list(self.node)
+        else:
+            d = self.node.list()
         def _good(children):
             # Deferreds don't optimize out tail recursion, and the way
             # Nevow's flattener handles Deferreds doesn't take this into
@@ -610,6 +647,10 @@ class DirectoryAsHTML(rend.Page):
                 else:
                     output.append(item)
             self.dirnode_children = output
+            if self.cache_forever:
+                # a listing that failed is still rendered (with a 200), so
+                # only the successful one may be cached
+                set_immutable_cache_control(IRequest(ctx))
             return ctx
         def _bad(f):
             text, code = humanize_failure(f)
@@ -869,50 +910,59 @@ class DirectoryAsHTML(rend.Page):
         req = IRequest(ctx)
         return get_arg(req, "results", "")
 
-def DirectoryJSONMetadata(ctx, dirnode):
-    d = dirnode.list()
-    def _got(children):
-        kids = {}
-        for name, (childnode, metadata) in children.iteritems():
-            assert IFilesystemNode.providedBy(childnode), childnode
-            rw_uri = childnode.get_write_uri()
-            ro_uri = childnode.get_readonly_uri()
-            if IFileNode.providedBy(childnode):
-                kiddata = ("filenode", get_filenode_metadata(childnode))
-            elif IDirectoryNode.providedBy(childnode):
-                kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
-            else:
-                kiddata = ("unknown", {})
-
-            kiddata[1]["metadata"] = metadata
-            if rw_uri:
-                kiddata[1]["rw_uri"] = rw_uri
-            if ro_uri:
-                kiddata[1]["ro_uri"] = ro_uri
-            verifycap = childnode.get_verify_cap()
-            if verifycap:
-                kiddata[1]['verify_uri'] = verifycap.to_string()
-
-            kids[name] = kiddata
-
-        drw_uri = dirnode.get_write_uri()
-        dro_uri = dirnode.get_readonly_uri()
-        contents = { 'children': kids }
-        if dro_uri:
-            contents['ro_uri'] = dro_uri
-        if drw_uri:
-            contents['rw_uri'] = drw_uri
-        verifycap = dirnode.get_verify_cap()
-        if verifycap:
-            contents['verify_uri'] = verifycap.to_string()
-        contents['mutable'] = dirnode.is_mutable()
-        data = ("dirnode", contents)
-        json = simplejson.dumps(data, indent=1) + "\n"
-        return json
-    d.addCallback(_got)
+def DirectoryJSONMetadata(ctx, dirnode, cache=None, cache_forever=False):
+    if cache:
+        d = cache.get_json(dirnode, render_directory_json)
+    else:
+        d = dirnode.list()
+        d.addCallback(lambda children: render_directory_json(dirnode, children))
+    if cache_forever:
+        def _cache_forever(json):
+            set_immutable_cache_control(IRequest(ctx))
+            return json
+        d.addCallback(_cache_forever)
     d.addCallback(text_plain, ctx)
     return d
 
+def render_directory_json(dirnode, children):
+    kids = {}
+    for name, (childnode, metadata) in children.iteritems():
+        assert IFilesystemNode.providedBy(childnode), childnode
+        rw_uri = childnode.get_write_uri()
+        ro_uri = childnode.get_readonly_uri()
+        if IFileNode.providedBy(childnode):
+            kiddata = ("filenode", get_filenode_metadata(childnode))
+        elif IDirectoryNode.providedBy(childnode):
+            kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
+        else:
+            kiddata = ("unknown", {})
+
+        kiddata[1]["metadata"] = metadata
+        if rw_uri:
+            kiddata[1]["rw_uri"] = rw_uri
+        if ro_uri:
+            kiddata[1]["ro_uri"] = ro_uri
+        verifycap = childnode.get_verify_cap()
+        if verifycap:
+            kiddata[1]['verify_uri'] = verifycap.to_string()
+
+        kids[name] = kiddata
+
+    drw_uri = dirnode.get_write_uri()
+    dro_uri = dirnode.get_readonly_uri()
+    contents = { 'children': kids }
+    if dro_uri:
+        contents['ro_uri'] = dro_uri
+    if drw_uri:
+        contents['rw_uri'] = drw_uri
+    verifycap = dirnode.get_verify_cap()
+    if verifycap:
+        contents['verify_uri'] = verifycap.to_string()
+    contents['mutable'] = dirnode.is_mutable()
+    data = ("dirnode", contents)
+    json = simplejson.dumps(data, indent=1) + "\n"
+    return json
+
 
 def DirectoryURI(ctx, dirnode):
     return text_plain(dirnode.get_uri(), ctx)
@@ -1096,15 +1146,24 @@ class ManifestStreamer(dirnode.DeepStats):
 
     def add_node(self, node, path):
         dirnode.DeepStats.add_node(self, node, path)
-        d = {"path": path,
-             "cap": node.get_uri()}
-
+        d = {"path": path}
         if IDirectoryNode.providedBy(node):
             d["type"] = "directory"
         elif IFileNode.providedBy(node):
             d["type"] = "file"
         else:
             d["type"] = "unknown"
+        self._write_unit(node, d)
+
+    def enter_directory(self, parent, children):
+        for (shardnum, shard) in enumerate(dirnode.get_directory_shards(parent)):
+            self._write_unit(shard, {"type": "directory-shard",
+                                     "directory": parent.get_uri(),
+                                     "shard": shardnum})
+        return dirnode.DeepStats.enter_directory(self, parent, children)
+
+    def _write_unit(self, node, d):
+        d["cap"] = node.get_uri()
 
         v = node.get_verify_cap()
         if v:
@@ -1138,12 +1197,15 @@ class ManifestStreamer(dirnode.DeepStats):
 class DeepCheckStreamer(dirnode.DeepStats):
     implements(IPushProducer)
 
-    def __init__(self, ctx, origin, verify, repair, add_lease):
+    def __init__(self, ctx, origin, verify, repair, add_lease,
+                 forget_results=None):
         dirnode.DeepStats.__init__(self, origin)
         self.req = IRequest(ctx)
         self.verify = verify
         self.repair = repair
         self.add_lease = add_lease
+        # a CheckResultsCache to discard each node from, for force=true
+        self.forget_results = forget_results
 
     def setMonitor(self, monitor):
         self.monitor = monitor
@@ -1177,6 +1239,8 @@ class DeepCheckStreamer(dirnode.DeepStats):
         data["repaircap"] = r or ""
 
         si = node.get_storage_index()
+        if si and self.forget_results:
+            self.forget_results.discard(si)
         if si:
             si = base32.b2a(si)
         data["storage-index"] = si or ""
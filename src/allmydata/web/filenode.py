@@ -1,8 +1,11 @@
 
+import os
 import simplejson
 
+from zope.interface import implements
 from twisted.web import http, static
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
 from nevow import url, rend
 from nevow.inevow import IRequest
 
@@ -18,7 +21,9 @@ from allmydata.blacklist import FileProhibited, ProhibitedNode
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
      MyExceptionHandler, parse_replace_arg, parse_offset_arg, \
-     get_format, get_mutable_type, get_filenode_metadata
+     get_format, get_mutable_type, get_filenode_metadata, \
+     forget_check_results, get_immutable_etag, set_immutable_etag, \
+     set_immutable_cache_control, clear_cache_headers
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
@@ -154,6 +159,15 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         raise WebError("Files have no children, certainly not named %s"
                        % quote_output(name, encoding='utf-8'))
 
+    def _cache_forever(self):
+        # only an immutable file named by its cap is certain never to change
+        return not self.node.is_mutable() and self.parentnode is None
+
+    def _set_immutable_etag(self, req, t):
+        etag = '%s-%s' % (get_immutable_etag(self.node), t or "")
+        return set_immutable_etag(req, etag,
+                                  cache_forever=self._cache_forever())
+
     def render_GET(self, ctx):
         req = IRequest(ctx)
         t = get_arg(req, "t", "").strip()
@@ -163,9 +177,11 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
             # if the client already has the ETag then we can
             # short-circuit the whole process.
-            si = self.node.get_storage_index()
-            if si and req.setETag('%s-%s' % (base32.b2a(si), t or "")):
+            if self._set_immutable_etag(req, t):
                 return ""
+            if t and self._cache_forever():
+                # these are computed from the cap alone, so cannot fail
+                set_immutable_cache_control(req)
 
         if not t:
             # just get the contents
@@ -182,7 +198,8 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             # with itself, and echo back the same bytes that we were given.
             filename = get_arg(req, "filename", self.name) or "unknown"
             d = self.node.get_best_readable_version()
-            d.addCallback(lambda dn: FileDownloader(dn, filename))
+            d.addCallback(lambda dn: FileDownloader(dn, filename,
+                                                    self._cache_forever()))
             return d
         if t == "json":
             # We do this to make sure that fields like size and
@@ -217,9 +234,12 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         t = get_arg(req, "t", "").strip()
         if t:
             raise WebError("HEAD file: bad t=%s" % t)
+        if not self.node.is_mutable() and self._set_immutable_etag(req, t):
+            return ""
         filename = get_arg(req, "filename", self.name) or "unknown"
         d = self.node.get_best_readable_version()
-        d.addCallback(lambda dn: FileDownloader(dn, filename))
+        d.addCallback(lambda dn: FileDownloader(dn, filename,
+                                                self._cache_forever()))
         return d
 
     def render_PUT(self, ctx):
@@ -301,6 +321,8 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
+        if boolean_of_arg(get_arg(req, "force", "false")):
+            forget_check_results(self.client, self.node)
         if repair:
             d = self.node.check_and_repair(Monitor(), verify, add_lease)
             d.addCallback(self._maybe_literal, CheckAndRepairResultsRenderer)
@@ -346,11 +368,168 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
 
+# A multipart/byteranges response reads up to MAX_PARALLEL_RANGES of its
+# ranges at once. A range that is waiting for its turn to be sent holds on to
+# about RANGE_BUFFER_SIZE bytes (plus any segment that was already on its
+# way) before its download is paused.
+MAX_PARALLEL_RANGES = 4
+RANGE_BUFFER_SIZE = 128*1024
+
+# A Range header that still asks for more than MAX_RANGES parts once its
+# overlapping and adjacent ranges have been merged is ignored, and the whole
+# file is sent instead, so that a short request cannot make us read and send
+# far more than the file.
+MAX_RANGES = 16
+
+def merge_ranges(ranges):
+    """Return the inclusive (first, last) byte ranges in 'ranges' in
+    ascending order, with any that overlap or touch merged, so that no byte
+    is sent twice (RFC 7233 allows this)."""
+    merged = []
+    for (first, last) in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append( (first, last) )
+    return merged
+
+class RangePart:
+    """I am the consumer for one part of a multipart/byteranges response.
+    Until it is my turn to be sent, I keep what my producer gives me, and
+    pause it once I have RANGE_BUFFER_SIZE bytes. After that, I pass the
+    data (and the flow control) straight through to the request."""
+    implements(IConsumer)
+
+    def __init__(self, header, first, size):
+        self.header = header
+        self.first = first
+        self.size = size
+        self._read_d = None
+        self._request = None
+        self._producer = None
+        self._streaming = False
+        self._paused = False
+        self._buffer = []
+        self._buffered = 0
+
+    def start_reading(self, filenode):
+        self._read_d = filenode.read(self, self.first, self.size)
+
+    def start_sending(self, req):
+        """Write everything I have kept so far to the request, then send
+        the rest as it arrives. I return a Deferred that fires when my range
+        has been read completely."""
+        if self._buffer:
+            req.write("".join(self._buffer))
+            self._buffer = []
+        self._request = req
+        if self._producer is not None:
+            if self._paused:
+                self._paused = False
+                self._producer.resumeProducing()
+            # the request will pause the producer again if it must
+            req.registerProducer(self._producer, self._streaming)
+        return self._read_d
+
+    def stop(self):
+        """Abandon a part that has not been sent yet."""
+        self._buffer = []
+        if self._read_d is None or self._request is not None:
+            return
+        if self._producer is not None:
+            self._producer.stopProducing()
+        self._read_d.addErrback(lambda f: None)
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        if self._request is not None:
+            self._request.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        if self._request is not None:
+            self._request.unregisterProducer()
+        self._producer = None
+
+    def write(self, data):
+        if self._request is not None:
+            self._request.write(data)
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if (self._buffered >= RANGE_BUFFER_SIZE and self._streaming and
+            self._producer is not None and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+class MultipartRangeWriter:
+    """I send several ranges of a file as a multipart/byteranges response
+    (RFC 7233, appendix A). The downloads of later ranges are started while
+    the earlier ones are still being sent (MAX_PARALLEL_RANGES at a time),
+    so that a download node has requests for their segments queued up, but
+    the parts are written to the request in the order they are given to
+    me."""
+
+    def __init__(self, filenode, ranges, filesize, ctype):
+        self._filenode = filenode
+        self._boundary = base32.b2a(os.urandom(15))
+        self._parts = []
+        for (first, last) in ranges:
+            header = ("--%s\r\n"
+                      "Content-Type: %s\r\n"
+                      "Content-Range: bytes %d-%d/%d\r\n"
+                      "\r\n" % (self._boundary, ctype, first, last, filesize))
+            if self._parts:
+                # the CRLF at the end of the previous part's data belongs to
+                # the delimiter
+                header = "\r\n" + header
+            self._parts.append(RangePart(header, first, last - first + 1))
+        self._trailer = "\r\n--%s--\r\n" % self._boundary
+        self._next_to_read = 0
+
+    def get_content_type(self):
+        return "multipart/byteranges; boundary=%s" % self._boundary
+
+    def get_content_length(self):
+        return (sum([len(p.header) + p.size for p in self._parts])
+                + len(self._trailer))
+
+    def start(self, req):
+        """Send all the parts to 'req'. I return a Deferred that fires when
+        they have been written."""
+        for i in range(MAX_PARALLEL_RANGES):
+            self._start_next_read()
+        return self._send_part(req, 0)
+
+    def stop(self):
+        for p in self._parts:
+            p.stop()
+
+    def _start_next_read(self):
+        if self._next_to_read < len(self._parts):
+            self._parts[self._next_to_read].start_reading(self._filenode)
+            self._next_to_read += 1
+
+    def _send_part(self, req, i):
+        if i == len(self._parts):
+            req.write(self._trailer)
+            return defer.succeed(None)
+        part = self._parts[i]
+        req.write(part.header)
+        d = part.start_sending(req)
+        def _sent(ign):
+            self._start_next_read()
+            return self._send_part(req, i+1)
+        d.addCallback(_sent)
+        return d
+
+
 class FileDownloader(rend.Page):
-    def __init__(self, filenode, filename):
+    def __init__(self, filenode, filename, cache_forever=False):
         rend.Page.__init__(self)
         self.filenode = filenode
         self.filename = filename
+        self.cache_forever = cache_forever
 
     def parse_range_header(self, range):
         # Parse a byte ranges according to RFC 2616 "14.35.1 Byte
@@ -419,49 +598,79 @@ class FileDownloader(rend.Page):
             req.setHeader("content-disposition",
                           'attachment; filename="%s"' % self.filename)
 
+        if self.filenode.is_mutable():
+            # a mutable version is identified by its sequence number and
+            # root hash. (Immutable files got their ETag before we started
+            # looking for their shares, in FileNodeHandler.render_GET.)
+            si = self.filenode.get_storage_index()
+            etag = '%s-%d-%s' % (base32.b2a(si),
+                                 self.filenode.get_sequence_number(),
+                                 base32.b2a(self.filenode.get_root_hash()))
+            if req.setETag(etag):
+                return ""
+
         filesize = self.filenode.get_size()
         assert isinstance(filesize, (int,long)), filesize
         first, size = 0, None
         contentsize = filesize
+        multipart = None
         req.setHeader("accept-ranges", "bytes")
 
-        # TODO: for mutable files, use the roothash. For LIT, hash the data.
-        # or maybe just use the URI for CHK and LIT.
         rangeheader = req.getHeader('range')
         if rangeheader:
             ranges = self.parse_range_header(rangeheader)
 
-            # ranges = None means the header didn't parse, so ignore
-            # the header as if it didn't exist.  If is more than one
-            # range, then just return the first for now, until we can
-            # generate multipart/byteranges.
+            # ranges = None means the header didn't parse (or, below, that
+            # it asked for too many parts), so ignore the header as if it
+            # didn't exist. Ranges that start beyond the end of the file are
+            # dropped, and the rest are truncated to fit.
             if ranges is not None:
-                first, last = ranges[0]
-
-                if first >= filesize:
+                ranges = merge_ranges([(max(0, r_first), min(filesize-1, r_last))
+                                       for (r_first, r_last) in ranges
+                                       if r_first < filesize])
+                if not ranges:
                     raise WebError('First beyond end of file',
                                    http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                else:
-                    first = max(0, first)
-                    last = min(filesize-1, last)
+                if len(ranges) > MAX_RANGES:
+                    ranges = None
 
-                    req.setResponseCode(http.PARTIAL_CONTENT)
+            if ranges is not None:
+                req.setResponseCode(http.PARTIAL_CONTENT)
+                if len(ranges) == 1:
+                    first, last = ranges[0]
                     req.setHeader('content-range',"bytes %s-%s/%s" %
                                   (str(first), str(last),
                                    str(filesize)))
                     contentsize = last - first + 1
                     size = contentsize
+                else:
+                    multipart = MultipartRangeWriter(self.filenode, ranges,
+                                                     filesize, ctype)
+                    req.setHeader("content-type",
+                                  multipart.get_content_type())
+                    contentsize = multipart.get_content_length()
 
         req.setHeader("content-length", b"%d" % contentsize)
+        if self.cache_forever:
+            # The headers are not sent until the first byte of the file is
+            # written, so if the download fails before then, _error can
+            # still take this back.
+            set_immutable_cache_control(req)
         if req.method == "HEAD":
             return ""
 
         finished = []
         def _request_finished(ign):
             finished.append(True)
+            if multipart:
+                # stop downloading any parts we no longer have a use for
+                multipart.stop()
         req.notifyFinish().addBoth(_request_finished)
 
-        d = self.filenode.read(req, first, size)
+        if multipart:
+            d = multipart.start(req)
+        else:
+            d = self.filenode.read(req, first, size)
 
         def _finished(ign):
             if not finished:
@@ -483,12 +692,18 @@ class FileDownloader(rend.Page):
                 # error message small to improve the chances of having our
                 # error response be shorter than the intended results.
                 #
-                # We don't have a lot of options, unfortunately.
+                # We don't have a lot of options, unfortunately. We do drop
+                # the connection afterwards, so that nothing (in particular
+                # a cache that was told to keep this response forever)
+                # mistakes the truncated body for a complete one.
                 req.write("problem during download\n")
+                transport = req.transport
                 req.finish()
+                transport.loseConnection()
             else:
                 # We haven't written anything yet, so we can provide a
                 # sensible error message.
+                clear_cache_headers(req)
                 eh = MyExceptionHandler()
                 eh.renderHTTP_exception(ctx, f)
         d.addCallbacks(_finished, _error)
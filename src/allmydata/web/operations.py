@@ -42,6 +42,9 @@ class OphandleTable(rend.Page, service.Service):
         del self.timers
         return service.Service.stopService(self)
 
+    def has_ophandle(self, ophandle):
+        return ophandle in self.handles
+
     def add_monitor(self, ctx, monitor, renderer):
         ophandle = get_arg(ctx, "ophandle")
         assert ophandle
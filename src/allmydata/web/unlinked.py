@@ -5,10 +5,26 @@ from twisted.internet import defer
 from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
+from allmydata.dirnode import MAX_DIRECTORY_SHARDS
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
      convert_children_json, WebError, get_format, get_mutable_type
 from allmydata.web import status
 
+def get_shards_arg(req):
+    shards = get_arg(req, "shards", None)
+    if not shards:
+        return None
+    try:
+        shards = int(shards)
+    except ValueError:
+        shards = 0
+    # every shard is a mutable file, with an RSA key of its own
+    if shards < 1 or shards > MAX_DIRECTORY_SHARDS:
+        raise WebError("invalid shards= argument: %r (must be between 1 and %d)"
+                       % (get_arg(req, "shards"), MAX_DIRECTORY_SHARDS),
+                       http.BAD_REQUEST)
+    return shards
+
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
     uploadable = FileHandle(req.content, client.convergence)
@@ -34,7 +50,7 @@ def PUTUnlinkedCreateDirectory(req, client):
     mt = None
     if file_format:
         mt = get_mutable_type(file_format)
-    d = client.create_dirnode(version=mt)
+    d = client.create_dirnode(version=mt, shards=get_shards_arg(req))
     d.addCallback(lambda dirnode: dirnode.get_uri())
     # XXX add redirect_to_result
     return d
@@ -118,7 +134,7 @@ def POSTUnlinkedCreateDirectory(req, client):
     mt = None
     if file_format:
         mt = get_mutable_type(file_format)
-    d = client.create_dirnode(version=mt)
+    d = client.create_dirnode(version=mt, shards=get_shards_arg(req))
     redirect = get_arg(req, "redirect_to_result", "false")
     if boolean_of_arg(redirect):
         def _then_redir(res):
@@ -137,7 +153,8 @@ def POSTUnlinkedCreateDirectoryWithChildren(req, client):
     req.content.seek(0)
     kids_json = req.content.read()
     kids = convert_children_json(client.nodemaker, kids_json)
-    d = client.create_dirnode(initial_children=kids)
+    d = client.create_dirnode(initial_children=kids,
+                              shards=get_shards_arg(req))
     redirect = get_arg(req, "redirect_to_result", "false")
     if boolean_of_arg(redirect):
         def _then_redir(res):